@@ -85,6 +85,10 @@ if __name__ == "__main__":
 	cfg.cache('awe-instance-data/cells.dat')            # cell definitions
 	cfg.cache('awe-instance-data/CellIndices.dat')      # cell atoms to use when assigning
 	cfg.cache('awe-instance-data/StructureIndices.dat') # walker atoms to use when assigning
+	if os.path.exists('awe-instance-data/processed.top'):
+		cfg.cache('awe-instance-data/processed.top') # topology preprocessed by awe-prepare
+	if os.path.exists('awe-instance-data/cells.idx'):
+		cfg.cache('awe-instance-data/cells.idx')      # cell index built by awe-prepare
 
         # initialize the weights randomly
 	weights   = np.random.random((nstates,nwalkers))
@@ -5,9 +5,19 @@ set -o verbose
 CONF_IN=structure.pdb
 CONF_OUT=structure2.pdb
 ASSIGNMENT=cell2.dat
+ASSIGNMENT_TOP=cell2.top
+ASSIGNMENT_FRAMES=cell2.frames
+TOP_CELLS=top-cells
+ASSIGN_FRAMES=assign-frames
 DESIRED_FILES="$CONF_OUT $ASSIGNMENT"
 RESULTFILE=results.tar
 WALKER=walker.pkl
+WALKER_BIN=walker.bin
+CONF_BIN_OUT=structure2.bin
+TOPOLOGY=topology.pdb
+CONVERT=awe-walker.py
+GMX_TOPOLOGY=processed.top
+CELL_INDEX=cells.idx
 CLEANUP="traj* *.tpr"
 
 ### disable gmx automatic backups.
@@ -16,6 +26,9 @@ export GMX_MAXBACKUP=-1
 export GMXLIB=$PWD/gmxtopologies
 ### assume each worker is allocated one processor
 NPROCS=1
+### the binary transport converts the walkers with python (2 or 3, no numpy needed),
+### set PYTHON in the worker environment to choose the interpreter
+PYTHON=${PYTHON:-}
 
 puts() {
 	echo "================================================================================"
@@ -32,11 +45,66 @@ prelude() {
 	echo
 }
 
+### a task runs the walkers $WALKER_BIN.<id>.<k> one after the other,
+### or the single walker $CONF_IN.<id> with the pdb transport
 prepare-filenames() {
-	structure=`ls $CONF_IN.*`
-	id="${structure##*.}"
-	mv -f "$CONF_IN.$id" $CONF_IN
-	mv -f "$WALKER.$id" $WALKER
+	if ls $WALKER_BIN.* >/dev/null 2>&1; then
+		TRANSPORT=binary
+		walker=`ls $WALKER_BIN.* | head -n 1`
+		walker="${walker#$WALKER_BIN.}"
+		id="${walker%%.*}"
+		WALKERS=`ls $WALKER_BIN.$id.* | sed 's/.*\.//' | sort -n`
+	else
+		TRANSPORT=pdb
+		structure=`ls $CONF_IN.*`
+		id="${structure##*.}"
+		mv -f "$CONF_IN.$id" $CONF_IN
+		mv -f "$WALKER.$id" $WALKER
+		WALKERS=0
+	fi
+	RESULTS=""
+}
+
+### the binary transport needs a python interpreter on the worker; the
+### master decides the transport, so a worker without one cannot fall back
+check-python() {
+	if [ $TRANSPORT != binary ]; then
+		return
+	fi
+	for candidate in $PYTHON python python3 python2; do
+		if $candidate -c 'import array, struct, sys' >/dev/null 2>&1; then
+			PYTHON=$candidate
+			puts "Converting walkers with `$PYTHON -c 'import sys; print(sys.executable)'`"
+			return
+		fi
+	done
+	puts "ERROR: the binary transport needs python (2 or 3) on the worker, none found in PATH=$PATH" >&2
+	puts "ERROR: install python, set PYTHON in the worker environment, or run awe-wq --transport pdb" >&2
+	exit 3
+}
+
+select-walker() {
+	if [ $TRANSPORT = binary ]; then
+		puts "Walker $1 of task $id"
+		mv -f "$WALKER_BIN.$id.$1" $WALKER_BIN
+		rm -f $CONF_OUT $ASSIGNMENT $ASSIGNMENT_TOP $ASSIGNMENT_FRAMES
+	fi
+}
+
+unpack-walker() {
+	if [ $TRANSPORT = binary ]; then
+		puts "Writing binary walker to $CONF_IN"
+		$PYTHON $CONVERT to-pdb $TOPOLOGY $WALKER_BIN $CONF_IN
+		echo
+	fi
+}
+
+pack-walker() {
+	if [ $TRANSPORT = binary ]; then
+		puts "Writing $CONF_OUT to binary walker"
+		$PYTHON $CONVERT from-pdb $WALKER_BIN $CONF_OUT $CONF_BIN_OUT
+		echo
+	fi
 }
 
 check-initial() {
@@ -48,18 +116,50 @@ check-initial() {
 run-md() {
 	puts "Running simulation"
 	echo $GMXLIB
-	./pdb2gmx -f $CONF_IN -ff amber96 -water none
-	./grompp -f sim.mdp
+	if [ -f $GMX_TOPOLOGY ]; then
+		### preprocessed by awe-prepare
+		./grompp -f sim.mdp -c $CONF_IN -p $GMX_TOPOLOGY
+	else
+		./pdb2gmx -f $CONF_IN -ff amber96 -water none
+		./grompp -f sim.mdp
+	fi
 	./mdrun -s topol.tpr -c $CONF_OUT -nt $NPROCS
 	echo
 }
 
 assign() {
 	puts "Assigning trajectory"
-	./awe-assign cells.dat CellIndices.dat traj.xtc StructureIndices.dat $ASSIGNMENT
+	### the master asks for the nearest cells with $TOP_CELLS
+	### and for the cell of every frame with $ASSIGN_FRAMES
+	options=""
+	if [ -f $TOP_CELLS ]; then
+		options="$options --top `cat $TOP_CELLS` $ASSIGNMENT_TOP"
+	fi
+	if [ -f $ASSIGN_FRAMES ]; then
+		options="$options --frames $ASSIGNMENT_FRAMES"
+	fi
+	if [ -f $CELL_INDEX ]; then
+		./awe-assign $options cells.dat CellIndices.dat traj.xtc StructureIndices.dat $ASSIGNMENT $CELL_INDEX
+	else
+		./awe-assign $options cells.dat CellIndices.dat traj.xtc StructureIndices.dat $ASSIGNMENT
+	fi
 	echo
 }
 
+collect-result() {
+	if [ $TRANSPORT = binary ]; then
+		mv -f $CONF_BIN_OUT "$CONF_BIN_OUT.$1"
+		mv -f $ASSIGNMENT "$ASSIGNMENT.$1"
+		RESULTS="$RESULTS $CONF_BIN_OUT.$1 $ASSIGNMENT.$1"
+		for optional in $ASSIGNMENT_TOP $ASSIGNMENT_FRAMES; do
+			if [ -f $optional ]; then
+				mv -f $optional "$optional.$1"
+				RESULTS="$RESULTS $optional.$1"
+			fi
+		done
+	fi
+}
+
 check-result() {
         puts "Generated files:"
 	ls
@@ -70,7 +170,11 @@ check-result() {
 
 package() {
 	puts "Packaging results"
-	tar cvf "$RESULTFILE.$id" $CONF_OUT $ASSIGNMENT $WALKER
+	if [ $TRANSPORT = binary ]; then
+		tar cvf "$RESULTFILE.$id" $RESULTS
+	else
+		tar cvf "$RESULTFILE.$id" $CONF_OUT $ASSIGNMENT $WALKER `ls $ASSIGNMENT_TOP $ASSIGNMENT_FRAMES 2>/dev/null || true`
+	fi
 	ls "$RESULTFILE.$id"
 	echo
 }
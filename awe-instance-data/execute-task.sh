@@ -5,8 +5,15 @@ source env.sh
 prelude
 check-initial
 prepare-filenames
-run-md
-assign
-check-result
+check-python
+for walker in $WALKERS; do
+	select-walker $walker
+	unpack-walker
+	run-md
+	assign
+	pack-walker
+	check-result
+	collect-result $walker
+done
 package
 cleanup
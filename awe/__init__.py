@@ -4,31 +4,63 @@ This file is part of AWE
 Copyright (C) 2012- University of Notre Dame
 This software is distributed under the GNU General Public License.
 See the file COPYING for details.
+
+The submodules of awe, and the names it exports from them, are imported
+on first access: `import awe` only loads this file, and `awe.resample`
+does not load the Work Queue bindings or matplotlib.  ProDy and
+work_queue are themselves imported by the first structure parsed and
+the first Work Queue master (see awe.structures and awe.workqueue).
 """
 
-from io import trace, log
-from util import typecheck, typecheckfn
+import sys
+import types
+
+
+_SUBMODULES = ('assign', 'aweclasses', 'bundle', 'checkpoint', 'coordinates', 'instrument',
+               'io', 'localqueue', 'replication', 'resample', 'stats', 'structures',
+               'transport', 'util', 'voronoi', 'workqueue')
+
+### name -> submodule it is exported from
+_EXPORTS = dict(trace          = 'io',
+                log            = 'io',
+                typecheck      = 'util',
+                typecheckfn    = 'util',
+                configure      = 'util',
+                Walker         = 'aweclasses',
+                AWE            = 'aweclasses',
+                Cell           = 'aweclasses',
+                System         = 'aweclasses',
+                SinkStates     = 'aweclasses',
+                WalkerEnsemble = 'aweclasses',
+                Config         = 'workqueue',
+                time           = 'stats',
+                PDB            = 'structures')
+
 
-import stats
-import aweclasses
-import workqueue
-import io
-import resample
-import structures
+class _LazyPackage(types.ModuleType):
 
-from aweclasses import Walker, AWE, Cell, System, SinkStates
-from workqueue import Config
-from stats import time
-from structures import PDB
+    """
+    The awe package, importing a submodule or an exported name the first
+    time it is accessed
+    """
 
-import voronoi
+    def __getattr__(self, name):
+        if name in _SUBMODULES:
+            __import__('%s.%s' % (self.__name__, name))
+            return sys.modules['%s.%s' % (self.__name__, name)]
+        if name in _EXPORTS:
+            value = getattr(getattr(self, _EXPORTS[name]), name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError, "'module' object has no attribute '%s'" % name
 
-import prody
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_SUBMODULES) | set(_EXPORTS))
 
-### compatibility with different versions of prody
-try:
-    prody.setVerbosity('error')
-except AttributeError:
-    prody.confProDy(verbosity='error')
 
-stats.time.start()
+### replace this module by the lazy one, which keeps it alive: its
+### functions refer to the globals of this module
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update((k, v) for k, v in globals().items() if k != '_package')
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -0,0 +1,470 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+Assignment of many structures to their nearest cell on the master.
+
+The workers assign one structure at a time with awe-assign.  After the
+cells are redefined (awe-import-gens, awe-define-regions) the whole
+ensemble has to be assigned again, which this module does in batches:
+
+  For centered structures X and Y of N atoms, the rmsd after the optimal
+  rotation (Kabsch) is
+
+    rmsd^2 = (|X|^2 + |Y|^2 - 2 (s1 + s2 + d s3)) / N
+
+  where s1 >= s2 >= s3 are the singular values of the 3x3 covariance
+  X'Y and d is the sign of its determinant (-1 for a reflection).
+
+The covariances of a block of walkers against a block of cells are one
+matrix product, and their singular values one stacked numpy.linalg
+call, so no Python loop runs per pair.  This computes the same rmsd as
+cassign/src/rmsd_calc.c, and like awe-assign ties go to the lowest cell.
+
+Cells are stored either as text (awe-import-gens --text) or in a binary
+file that is memory mapped instead of parsed (see cassign/src/celldata.h):
+
+  char    magic[4]  'AWEC'
+  uint32  version
+  uint64  ncells, ncoords, ndims
+  (zeros up to byte 64)
+  float32 coords    [ncells][ncoords][ndims]
+  (zeros up to a multiple of 8 bytes)
+  float64 centroids [ncells][ndims]
+  float64 norms     [ncells]   squared norm of the centered coordinates
+
+in little endian byte order.  Both formats are read by *load_cells* and
+by awe-assign.
+
+Besides the nearest cell, awe-assign --top <k> writes the k nearest
+cells of a structure, nearest first, as records of
+
+  int32   cell
+  float32 rmsd
+
+(TOP_DTYPE), which *unpack_top* reads and *Assigner.top* computes.
+
+awe-assign --frames assigns every frame of the trajectory and writes the
+runs of consecutive frames in the same cell as records of
+
+  int32   cell
+  int32   count
+
+(FRAMES_DTYPE).  The master appends them to a FrameLog, from which
+*count_transitions* counts the transitions between the cells of
+consecutive frames without keeping the trajectories.
+"""
+
+import numpy as np
+
+import multiprocessing
+import struct
+
+
+### walker coordinates are read from PDB files, in Angstrom, and the
+### cells from MSMBuilder, in nm
+ANGSTROM = 0.1
+
+### number of (walker, cell) pairs computed at once, about 200 bytes each
+CHUNKSIZE = 2**16
+
+CELLS_MAGIC   = b'AWEC'
+CELLS_VERSION = 1
+CELLS_HEADER  = 64
+_CELLS_FORMAT = struct.Struct('<4sIQQQ')
+
+### the nearest cells written by awe-assign --top
+TOP_DTYPE     = np.dtype([('cell', '<i4'), ('rmsd', '<f4')])
+
+### the cells of every frame written by awe-assign --frames
+FRAMES_DTYPE  = np.dtype([('cell', '<i4'), ('count', '<i4')])
+
+### a FrameLog record: walker id, iteration, color, number of runs, weight, then the runs
+_FRAMES_RECORD = struct.Struct('<qiiid')
+
+
+def _cells_layout(ncells, ncoords, ndims):
+    """
+    Offsets of the coordinates, centroids, and norms, and the size of a binary cells file
+    """
+    coords    = CELLS_HEADER
+    centroids = coords + 4 * ncells * ncoords * ndims
+    centroids = (centroids + 7) // 8 * 8
+    norms     = centroids + 8 * ncells * ndims
+    return coords, centroids, norms, norms + 8 * ncells
+
+
+def is_binary_cells(path):
+    with open(path, 'rb') as fd:
+        return fd.read(len(CELLS_MAGIC)) == CELLS_MAGIC
+
+
+def save_cells(path, coords):
+    """
+    Write the (ncells, ncoords, ndims) *coords* to the binary cells file at *path*
+    """
+    coords    = np.ascontiguousarray(coords, dtype='<f4')
+    shape     = coords.shape
+    values    = coords.astype(float)
+    centroids = values.mean(axis=1)
+    norms     = ((values - centroids[:,np.newaxis,:])**2).sum(axis=2).sum(axis=1)
+
+    offsets   = _cells_layout(*shape)
+    with open(path, 'wb') as fd:
+        fd.write(_CELLS_FORMAT.pack(CELLS_MAGIC, CELLS_VERSION, *shape).ljust(CELLS_HEADER, b'\0'))
+        fd.write(coords.tostring())
+        fd.write(b'\0' * (offsets[1] - fd.tell()))
+        fd.write(centroids.astype('<f8').tostring())
+        fd.write(norms.astype('<f8').tostring())
+
+
+def map_cells(path):
+    """
+    Read-only memory maps of the coordinates, centroids, and norms of the binary cells file at *path*
+    """
+    with open(path, 'rb') as fd:
+        header = fd.read(_CELLS_FORMAT.size)
+    magic, version, ncells, ncoords, ndims = _CELLS_FORMAT.unpack(header)
+    if magic != CELLS_MAGIC or version != CELLS_VERSION:
+        raise ValueError, '%s: not a version %d binary cells file' % (path, CELLS_VERSION)
+
+    shape   = ncells, ncoords, ndims
+    offsets = _cells_layout(*shape)
+    coords    = np.memmap(path, dtype='<f4', mode='r', offset=offsets[0], shape=shape)
+    centroids = np.memmap(path, dtype='<f8', mode='r', offset=offsets[1], shape=(ncells, ndims))
+    norms     = np.memmap(path, dtype='<f8', mode='r', offset=offsets[2], shape=(ncells,))
+    return coords, centroids, norms
+
+
+def load_cells(path):
+    """
+    The (ncells, ncoords, ndims) coordinates of the cells file at *path*
+    written by awe-import-gens, memory mapped if it is binary
+    """
+    if is_binary_cells(path):
+        return map_cells(path)[0]
+
+    header = dict()
+    with open(path) as fd:
+        for _ in xrange(3):
+            key, value = fd.readline().split(':')
+            header[key.strip()] = int(value)
+        fd.readline()
+        coords = np.fromfile(fd, sep=' ')
+
+    shape = header['ncells'], header['ncoords'], header['ndims']
+    if coords.size != np.prod(shape):
+        raise ValueError, '%s: expected %d values for %s but found %d' % (path, np.prod(shape), shape, coords.size)
+    return coords.reshape(shape)
+
+
+def unpack_top(data):
+    """
+    The nearest cells in the string *data* written by awe-assign --top
+    """
+    if len(data) % TOP_DTYPE.itemsize:
+        raise ValueError, 'Nearest cells of %d bytes are not a whole number of records' % len(data)
+    return np.frombuffer(data, dtype=TOP_DTYPE).copy()
+
+
+def unpack_frames(data):
+    """
+    The runs of cells in the string *data* written by awe-assign --frames
+    """
+    if len(data) % FRAMES_DTYPE.itemsize:
+        raise ValueError, 'Frame assignments of %d bytes are not a whole number of records' % len(data)
+    return np.frombuffer(data, dtype=FRAMES_DTYPE).copy()
+
+
+def expand_frames(runs):
+    """
+    The cell of each frame of the *runs*
+    """
+    return np.repeat(runs['cell'], runs['count'])
+
+
+class FrameLog(object):
+
+    """
+    Append-only file of the frame assignments of the walkers, one
+    record per walker result:
+
+      int64   walker id
+      int32   iteration
+      int32   color
+      int32   number of runs
+      float64 weight
+      FRAMES_DTYPE runs[number of runs]
+
+    in little endian byte order.  A walker that is run again after
+    recovering a checkpoint has a record for each run; *read_frames*
+    keeps the last.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd  = None
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_fd'] = None
+        return odict
+
+    def append(self, wid, iteration, color, weight, runs):
+        if self._fd is None:
+            self._fd = open(self.path, 'ab')
+        runs = np.asarray(runs, dtype=FRAMES_DTYPE)
+        self._fd.write(_FRAMES_RECORD.pack(wid, iteration, color, len(runs), weight))
+        self._fd.write(runs.tostring())
+        self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+def read_frames(path):
+    """
+    The records of the FrameLog at *path* as a list of (walker id,
+    iteration, color, weight, runs), the last one of each walker, in the
+    order they were written.  A partially written last record is ignored.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    records = dict()
+    offset  = 0
+    while offset + _FRAMES_RECORD.size <= len(data):
+        wid, iteration, color, nruns, weight = _FRAMES_RECORD.unpack_from(data, offset)
+        start  = offset + _FRAMES_RECORD.size
+        offset = start + nruns * FRAMES_DTYPE.itemsize
+        if offset > len(data): break
+        runs   = np.frombuffer(data[start:offset], dtype=FRAMES_DTYPE)
+        records.pop(wid, None)
+        records[wid] = (wid, iteration, color, weight, runs)
+    return sorted(records.values(), key=lambda r: (r[1], r[0]))
+
+
+def count_transitions(records, ncells, lag=1, weighted=True, color=None):
+    """
+    The (ncells, ncells) counts of the transitions from the cell of a
+    frame to the cell *lag* frames later, within each walker of the
+    *records* (as returned by *read_frames*), weighted by the walker
+    weights if *weighted*.  Only the walkers of *color* are counted if
+    it is given.
+    """
+    counts = np.zeros(ncells * ncells)
+    for wid, iteration, c, weight, runs in records:
+        if color is not None and c != color: continue
+        cells = expand_frames(runs)
+        if len(cells) <= lag: continue
+        pairs  = cells[:-lag] * ncells + cells[lag:]
+        counts += np.bincount(pairs, minlength=ncells * ncells) * (weight if weighted else 1.)
+    return counts.reshape(ncells, ncells)
+
+
+def load_indices(path):
+    """
+    The atom indices in the file at *path*, as given to awe-assign
+    """
+    return np.atleast_1d(np.loadtxt(path, dtype=int))
+
+
+def center(coords):
+    """
+    A copy of the (n, natoms, ndims) *coords* with the centroid of each structure at the origin
+    """
+    coords = np.asarray(coords, dtype=float)
+    return coords - coords.mean(axis=1)[:,np.newaxis,:]
+
+
+def _rmsd_block(X, GX, Y, GY):
+    """
+    The (len(X), len(Y)) rmsds between the centered structures *X* and
+    *Y* with squared norms *GX* and *GY*
+    """
+    nx, natoms, ndim = X.shape
+    ny = len(Y)
+
+    ### C[i,j] = X[i]' Y[j] for all pairs at once
+    C = np.dot(X.transpose(0,2,1).reshape(nx * ndim, natoms),
+               Y.transpose(1,0,2).reshape(natoms, ny * ndim))
+    C = C.reshape(nx, ndim, ny, ndim).transpose(0,2,1,3)
+
+    s = np.linalg.svd(C, compute_uv=False)
+    d = np.where(np.linalg.det(C) > 0, 1., -1.)
+    s[...,-1] *= d
+
+    msd = (GX[:,np.newaxis] + GY[np.newaxis,:] - 2 * s.sum(axis=-1)) / natoms
+    return np.sqrt(np.maximum(msd, 0))
+
+
+### the Assigner of the pool processes, set by _init_worker
+_WORKER = None
+
+def _init_worker(assigner):
+    global _WORKER
+    _WORKER = assigner
+
+def _call_block(args):
+    method, coords = args[:2]
+    return getattr(_WORKER, method)(coords, *args[2:])
+
+
+class Assigner(object):
+
+    """
+    Assign structures to the nearest of *cells*, a (ncells, natoms, ndims) array.
+
+    Parameters:
+      *chunksize* : number of (structure, cell) pairs computed at once, bounding the memory used
+      *processes* : assign blocks of *blocksize* structures on this many processes, 0 to assign serially
+      *blocksize* : number of structures sent to a process at once
+      *centroids*, *norms* : of the cells if they are known, as in a binary cells file
+    """
+
+    @classmethod
+    def from_file(cls, path, indices=None, **kws):
+        """
+        An Assigner to the atoms *indices* of the cells in the file at
+        *path*.  The centroids and norms of a binary file are used if
+        all its atoms are selected.
+        """
+        if not is_binary_cells(path):
+            cells = load_cells(path)
+            return cls(cells if indices is None else cells[:, indices], **kws)
+
+        cells, centroids, norms = map_cells(path)
+        if indices is None or np.array_equal(indices, np.arange(cells.shape[1])):
+            return cls(cells, centroids=centroids, norms=norms, **kws)
+        return cls(cells[:, indices], **kws)
+
+    def __init__(self, cells, chunksize=CHUNKSIZE, processes=0, blocksize=1024, centroids=None, norms=None):
+        if centroids is None:
+            self.cells = center(cells)
+            self.norms = (self.cells**2).sum(axis=2).sum(axis=1)
+        else:
+            self.cells = np.asarray(cells, dtype=float) - np.asarray(centroids)[:,np.newaxis,:]
+            self.norms = np.array(norms, dtype=float)
+        self.chunksize = chunksize
+        self.processes = processes
+        self.blocksize = blocksize
+        self._pool     = None
+
+    def __getstate__(self):
+        """
+        The process pool cannot be pickled, it is recreated on demand
+        """
+        odict = self.__dict__.copy()
+        odict['_pool'] = None
+        return odict
+
+    @property
+    def ncells(self): return len(self.cells)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, _init_worker, (self,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _chunks(self, n):
+        """
+        Structures and cells per chunk for *n* structures
+        """
+        ncells = max(1, min(self.ncells, self.chunksize))
+        nwalk  = max(1, min(n, self.chunksize // ncells))
+        return nwalk, ncells
+
+    def _check(self, coords):
+        coords = center(coords)
+        if coords.shape[1:] != self.cells.shape[1:]:
+            raise ValueError, 'Structures of shape %s cannot be compared to cells of shape %s' % (coords.shape[1:], self.cells.shape[1:])
+        return coords
+
+    def rmsd(self, coords):
+        """
+        The (len(coords), ncells) rmsds of each structure of *coords* to each cell
+        """
+        X      = self._check(coords)
+        GX     = (X**2).sum(axis=2).sum(axis=1)
+        result = np.empty((len(X), self.ncells))
+
+        nwalk, ncells = self._chunks(len(X))
+        for i in xrange(0, len(X), nwalk):
+            for j in xrange(0, self.ncells, ncells):
+                result[i:i+nwalk, j:j+ncells] = _rmsd_block(X[i:i+nwalk], GX[i:i+nwalk],
+                                                            self.cells[j:j+ncells], self.norms[j:j+ncells])
+        return result
+
+    def _assign(self, X):
+        GX   = (X**2).sum(axis=2).sum(axis=1)
+        best = np.zeros(len(X), dtype=int)
+        dist = np.empty(len(X))
+        dist.fill(np.inf)
+
+        nwalk, ncells = self._chunks(len(X))
+        for i in xrange(0, len(X), nwalk):
+            for j in xrange(0, self.ncells, ncells):
+                r    = _rmsd_block(X[i:i+nwalk], GX[i:i+nwalk], self.cells[j:j+ncells], self.norms[j:j+ncells])
+                k    = r.argmin(axis=1)
+                d    = r[np.arange(len(r)), k]
+                less = d < dist[i:i+nwalk]           # the earlier cell wins a tie
+                best[i:i+nwalk][less] = j + k[less]
+                dist[i:i+nwalk][less] = d[less]
+        return best, dist
+
+    def _top(self, X, k):
+        GX    = (X**2).sum(axis=2).sum(axis=1)
+        k     = min(k, self.ncells)
+        top   = np.empty((len(X), k), dtype=TOP_DTYPE)
+
+        nwalk, ncells = self._chunks(len(X))
+        for i in xrange(0, len(X), nwalk):
+            cells = np.zeros((len(X[i:i+nwalk]), 0), dtype=int)
+            dists = np.zeros((len(cells), 0))
+            for j in xrange(0, self.ncells, ncells):
+                r     = _rmsd_block(X[i:i+nwalk], GX[i:i+nwalk], self.cells[j:j+ncells], self.norms[j:j+ncells])
+                cells = np.hstack((cells, np.tile(j + np.arange(r.shape[1]), (len(r), 1))))
+                dists = np.hstack((dists, r))
+                ### the best so far come first and have the lower cells, so a stable sort breaks ties as awe-assign
+                order = np.argsort(dists, axis=1, kind='mergesort')[:, :k]
+                rows  = np.arange(len(dists))[:, np.newaxis]
+                cells = cells[rows, order]
+                dists = dists[rows, order]
+            top[i:i+nwalk]['cell'] = cells
+            top[i:i+nwalk]['rmsd'] = dists
+        return top
+
+    def _map(self, fn, X, *args):
+        if self.processes <= 0 or len(X) <= self.blocksize:
+            return [fn(X, *args)]
+        return self.pool.map(_call_block, [(fn.__name__, X[i:i+self.blocksize]) + args
+                                           for i in xrange(0, len(X), self.blocksize)])
+
+    def assign(self, coords):
+        """
+        The nearest cell of each structure of *coords* and its rmsd
+        """
+        results = self._map(self._assign, self._check(coords))
+        return (np.concatenate([a for a, _ in results]),
+                np.concatenate([d for _, d in results]))
+
+    def top(self, coords, k):
+        """
+        The (len(coords), k) TOP_DTYPE array of the *k* nearest cells of
+        each structure of *coords*, nearest first, as awe-assign --top
+        """
+        return np.concatenate(self._map(self._top, self._check(coords), k))
@@ -6,23 +6,45 @@ This software is distributed under the GNU General Public License.
 See the file COPYING for details.
 """
 
-import io, stats, workqueue
+import io, stats, workqueue, transport, assign, instrument
+from bundle import FixedBundle
 from util import typecheck, returns
-import structures, util
+import structures, util, coordinates
 
 import trax
 
 import numpy as np
 import cPickle as pickle
 
-import os, time, shutil
-from collections import defaultdict
+import os, time, shutil, multiprocessing, hashlib
+from collections import defaultdict, namedtuple
 
 
 _WALKER_ID = 0
 _DEFAULT_COLOR = -1
+_NONE = -1          # stored in the WalkerEnsemble for a missing cellid or assignment
+_NOTOP = np.array((_NONE, np.nan), dtype=assign.TOP_DTYPE)     # and for a missing nearest cell
 DEFAULT_CORE = -1
 
+
+def new_walker_ids(n):
+    """
+    Reserve *n* consecutive walker ids
+    """
+    global _WALKER_ID
+    ids = np.arange(_WALKER_ID, _WALKER_ID + n)
+    _WALKER_ID += n
+    return ids
+
+
+def resume_walker_ids(nextid):
+    """
+    Continue numbering walkers from *nextid*, after recovering a checkpoint
+    """
+    global _WALKER_ID
+    _WALKER_ID = max(_WALKER_ID, int(nextid))
+
+
 class Walker(object):
 
     """
@@ -34,9 +56,14 @@ class Walker(object):
       *start*      : starting coordinates
       *end*        : ending coordinates
       *assignment* : int
+      *topcells*   : the nearest cells of *end* and their rmsds (awe.assign.TOP_DTYPE), if they were reported
     """
 
-    def __init__(self, start=None, end=None, assignment=None, color=_DEFAULT_COLOR, weight=None, wid=None, cellid=None, initid=None):
+    _parentid = None    # walkers pickled before parents were tracked
+    _topcells = None    # or before the nearest cells were reported
+
+    def __init__(self, start=None, end=None, assignment=None, color=_DEFAULT_COLOR, weight=None, wid=None, cellid=None, initid=None,
+                 parentid=None, topcells=None):
 
         assert not (start is None and end is None), 'start = %s, end = %s' % (start, end)
 
@@ -46,6 +73,8 @@ class Walker(object):
         self._color      = color
         self._weight     = weight
         self._cellid     = cellid
+        self._parentid   = parentid
+        self._topcells   = topcells
 
         if wid is None:
             global _WALKER_ID
@@ -85,7 +114,8 @@ class Walker(object):
                       weight     = weight,
                       wid        = wid,
                       cellid     = cid,
-                      initid     = self._initid)
+                      initid     = self._initid,
+                      parentid   = self._id)
 
 
     @property
@@ -97,6 +127,9 @@ class Walker(object):
     @property
     def initid(self):    return self._initid
 
+    @property
+    def parentid(self):   return self._parentid
+
     @property
     def start(self):      return self._start
 
@@ -112,6 +145,12 @@ class Walker(object):
     @assignment.setter
     def assignment(self, asn):   self._assignment = asn
 
+    @property
+    def topcells(self):   return self._topcells
+
+    @topcells.setter
+    def topcells(self, top):     self._topcells = top
+
     @property
     def color(self):      return self._color
 
@@ -147,6 +186,71 @@ class Walker(object):
 
 
 
+TRANSPORTS = ('binary', 'pdb')
+
+def result_path(tag):
+    """
+    Where the result archive of the task with *tag* is saved.  The tag
+    lists the walkers of the task, so it is hashed to keep the file name
+    short.
+    """
+    outfile = tag.split('|')[0]
+    return '%s.%s' % (outfile, hashlib.sha1(tag).hexdigest())
+
+### the result of a walker: *topcells* (awe.assign.TOP_DTYPE) and
+### *frames* (awe.assign.FRAMES_DTYPE) are None unless the workers report
+### them, see AWE(topcells=k, frames=True)
+Result = namedtuple('Result', 'wid cellid coords topcells frames')
+
+@instrument.instrumented('decode_result')
+def decode_result(tag):
+    """
+    Load the result archive of the task with *tag*, then delete it.
+    Returns a list of Result, one for each walker of the task.
+
+    This runs in the decoder processes of AWE(decode_workers=n), so it
+    only depends on the archive.
+    """
+
+    import tarfile
+    path    = result_path(tag)
+    results = []
+    tar     = tarfile.open(path)
+    try:
+        names = set(tar.getnames())
+
+        def optional(name, unpack):
+            return unpack(tar.extractfile(name).read()) if name in names else None
+
+        ### binary walkers: structure2.bin.<k>, cell2.dat.<k>, and the optional
+        ### cell2.top.<k> and cell2.frames.<k> for the k-th walker of the task
+        for name in sorted(names):
+            if not name.startswith(workqueue.RESULT_WALKER): continue
+            suffix         = name[len(workqueue.RESULT_WALKER):]
+            header, coords = transport.unpack_walker(tar.extractfile(name).read())
+            cellstring     = tar.extractfile(workqueue.RESULT_CELL + suffix).read()
+            results.append(Result(header['id'], int(cellstring), coords,
+                                  optional(workqueue.RESULT_TOP    + suffix, assign.unpack_top),
+                                  optional(workqueue.RESULT_FRAMES + suffix, assign.unpack_frames)))
+
+        if not results:
+            cellstring     = tar.extractfile(workqueue.RESULT_CELL     ).read()
+            walkerstr      = tar.extractfile(workqueue.WORKER_WALKER_NAME).read()
+            pdbstring      = tar.extractfile(workqueue.RESULT_POSITIONS).read()
+            with instrument.span('pdb parse'):
+                coords     = structures.PDB(pdbstring).coords
+            with instrument.span('unpickle'):
+                wid        = pickle.loads(walkerstr).id
+            results.append(Result(wid, int(cellstring), coords,
+                                  optional(workqueue.RESULT_TOP,    assign.unpack_top),
+                                  optional(workqueue.RESULT_FRAMES, assign.unpack_frames)))
+    finally:
+        tar.close()
+
+    os.unlink(path)
+    return results
+
+
 class AWE(object):
 
     """
@@ -158,12 +262,16 @@ class AWE(object):
 
     # @typecheck(wqconfig=workqueue.Config, system=System, iterations=int)
     def __init__(self, wqconfig=None, system=None, iterations=-1, resample=None,
-                 traxlogger = None, checkpointfreq=1):
+                 traxlogger = None, checkpointfreq=1, pipeline=False, transport='binary',
+                 decode_workers=0, decode_batchsize=64, bundle=1, topcells=0, frames=False):
 
         self._print_start_screen()
+
+        ### fork the decoders before the task backend starts any threads
+        self.decode_batchsize = decode_batchsize
+        self._decoder = multiprocessing.Pool(decode_workers) if decode_workers > 0 else None
         
-	self.statslogger = stats.StatsLogger('debug/task_stats.log.gz')
-        self.transitionslogger = stats.StatsLogger('debug/cell-transitions.log.gz')
+	self.statslogger = stats.MetricsLogger('debug/task_stats.dat')
 
         self.wq         = workqueue.WorkQueue(wqconfig, statslogger=self.statslogger)
         self.system     = system
@@ -179,6 +287,26 @@ class AWE(object):
         self.traxlogger = traxlogger or trax.SimpleTransactional(checkpoint = 'debug/trax.cpt',
                                                                  log        = 'debug/trax.log')
         self.checkpointfreq = checkpointfreq
+        self.pipeline       = pipeline
+
+        ### 'binary': walkers are sent as awe.transport buffers and the
+        ###           worker fills in the topology PDB (see execute-task.sh)
+        ### 'pdb'   : walkers are sent as PDB text and a pickled Walker
+        assert transport in TRANSPORTS, 'Unknown transport %r' % transport
+        self.transport       = transport
+        self._transportfiles = None
+
+        ### walkers per task: an int, or an awe.bundle.IBundle such as AdaptiveBundle
+        if isinstance(bundle, int):
+            bundle = FixedBundle(bundle)
+        self.bundle = bundle
+        self.wq.task_listeners.append(self._task_returned)
+
+        ### the workers also report the *topcells* nearest cells of each walker,
+        ### and if *frames* the cell of every frame, which is kept in the FrameLog
+        self.topcells = topcells
+        self.frames   = frames
+        self.framelog = assign.FrameLog('debug/cell-frames.dat')
 
         self._firstrun  = True
 
@@ -204,9 +332,13 @@ class AWE(object):
 
         print start_str
 
+    @instrument.instrumented('checkpoint')
     def checkpoint(self):
+        t0  = time.time()
         cpt = self.traxlogger.cpt_path
-        if os.path.exists(cpt):
+
+        ### incremental checkpoints are a directory and keep their own history
+        if os.path.isfile(cpt):
             shutil.move(cpt, cpt + '.last')
         chk = dict(system         = self.system,
                    iterations     = self.iterations,
@@ -214,41 +346,80 @@ class AWE(object):
                    resample       = self.resample,
                    checkpointfreq = self.checkpointfreq
                    )
-        chk['_firstrun'] = self._firstrun
-        self.traxlogger.checkpoint(chk)
+        chk['_firstrun']     = self._firstrun
+        chk['_nextwalkerid'] = _WALKER_ID
+        with instrument.span('trax.checkpoint'):
+            self.traxlogger.checkpoint(chk)
+
+        nbytes = getattr(self.traxlogger, 'written', None)
+        if nbytes is None:
+            nbytes = os.path.getsize(cpt)
+        self.stats.checkpoint(nbytes, time.time() - t0)
+
+        ### the metrics on disk are at least as recent as the checkpoint
+        self.statslogger.flush()
 
 
     def logwalker(self, walker):
-        self.traxlogger.log(walker)
+        with instrument.span('trax.log'):
+            self.traxlogger.log(walker)
 
     def _trax_log_recover(self, obj, value):
         print 'Recovering walker', value.id
         obj['system'].set_walker(value)
 
+    @instrument.instrumented('recover')
     def recover(self):
         cpt = self.traxlogger.cpt_path
         if os.path.exists(cpt):
             print 'Recovering', cpt
+            t0    = time.time()
             parms = self.traxlogger.recover(self._trax_log_recover)
+            nextwalkerid = parms.pop('_nextwalkerid', None)
             for a in parms.iterkeys():
                 setattr(self, a, parms[a])
 
+            ### the walker ids are not part of older checkpoints
+            if nextwalkerid is None and len(self.system.ensemble) > 0:
+                nextwalkerid = self.system.ensemble.ids.max() + 1
+            resume_walker_ids(nextwalkerid or 0)
+
+            elapsed = time.time() - t0
+            print 'Recovered iteration', self.iteration, 'with', len(self.system.ensemble), 'walkers in', elapsed, 's'
+            self.stats.recover(elapsed)
+
 
     def _submit(self):
+        self._submit_walkers([w for w in self.system.walkers if w.end is None])
 
-        for walker in self.system.walkers:
-            if walker.end is None:
-                task = self._new_task(walker)
-                self.wq.submit(task)
+    @instrument.instrumented('submit')
+    def _submit_walkers(self, walkers):
+        """
+        Submit the *walkers* in bundles of the size chosen by self.bundle
+        """
+        if not walkers: return
+        if self.transport == 'binary':
+            k    = self.bundle.size(len(walkers), self.wq.active_workers())
+        else:
+            k    = 1    # a PDB task carries a single walker
+        nbundles = (len(walkers) + k - 1) // k
+        self.statslogger.update(time.time(), 'AWE', 'bundle_size', k)
 
-    @typecheck(Walker)
-    @returns(workqueue.WQ.Task)
-    def _new_task(self, walker):
+        for i in xrange(nbundles):
+            task = self._new_task(walkers[i::nbundles])
+            self.wq.submit(task)
+
+    def _task_returned(self, task):
+        self.bundle.update(task, len(self.decode_from_task_tag(task.tag)['walkerids']))
+
+    @typecheck(list)
+    @returns(workqueue.TASK_TYPES)
+    def _new_task(self, walkers):
 	self.currenttask += 1
         task = self.wq.new_task()
-        tag  = self.encode_task_tag(walker)
+        tag  = self.encode_task_tag(walkers)
         task.specify_tag(tag)
-        self.marshal_to_task(walker, task)
+        self.marshal_to_task(walkers, task)
         return task
 
     def _try_duplicate_tasks(self):
@@ -256,11 +427,11 @@ class AWE(object):
         while self.wq.can_duplicate_tasks():
             i += 1
             if i > 20: break
-            tag    = self.wq.select_tag()
+            tag     = self.wq.select_tag()
             if tag is None: break
-            wid    = self.decode_from_task_tag(tag)['walkerid']
-            walker = self.system.walker(wid)
-            task   = self._new_task(walker)
+            wids    = self.decode_from_task_tag(tag)['walkerids']
+            walkers = [self.system.walker(wid) for wid in wids]
+            task    = self._new_task(walkers)
             self.wq.submit(task)
 
     def _recv(self):
@@ -268,11 +439,16 @@ class AWE(object):
         print time.asctime(), 'Receiving tasks'
         system = self.system
         self.stats.time_barrier('start')
-        while not self.wq.empty:
-            walker = self.wq.recv(self.marshal_from_task)
-            system.set_walker(walker)
-            self.logwalker(walker)
-            self._try_duplicate_tasks()
+        if self._decoder is None:
+            while not self.wq.empty:
+                for walker in self.wq.recv(self.marshal_from_task):
+                    system.set_walker(walker)
+                    self.logwalker(walker)
+                self._try_duplicate_tasks()
+        else:
+            for batch in self.wq.recv_batches(decode_result, self._decoder, self.decode_batchsize):
+                self._apply(batch)
+                self._try_duplicate_tasks()
         self.stats.time_barrier('stop')
         self.wq.clear()
         print system
@@ -281,7 +457,8 @@ class AWE(object):
     def _resample(self):
 
         self.stats.time_resample('start')
-        self.system = self.resample(self.system)
+        with instrument.span('resample'):
+            self.system = self.resample(self.system)
         self.stats.time_resample('stop')
             
 
@@ -297,12 +474,15 @@ class AWE(object):
             self._firstrun = False
 
         assert len(self.system.cells  ) > 0
-        assert len(self.system.walkers) > 0
+        assert len(self.system.ensemble) > 0
 
         t = time.time()
         self.statslogger.update(t, 'AWE', 'start_unix_time', t)
 
         try:
+            if self.pipeline:
+                self._run_pipelined()
+
             while self.iteration < self.iterations:
 
                 if self.iteration % self.checkpointfreq == 0:
@@ -311,10 +491,10 @@ class AWE(object):
 
                 self.iteration += 1
 
-                print time.asctime(), 'Iteration', self.iteration, 'with', len(self.system.walkers), 'walkers'
+                print time.asctime(), 'Iteration', self.iteration, 'with', len(self.system.ensemble), 'walkers'
                 runtime = stats.time.time()
                 self.statslogger.update(runtime, 'AWE', 'iteration', self.iteration)
-                self.statslogger.update(runtime, 'AWE', 'walkers', len(self.system.walkers))
+                self.statslogger.update(runtime, 'AWE', 'walkers', len(self.system.ensemble))
 
                 self.stats.time_iter('start')
 
@@ -323,95 +503,323 @@ class AWE(object):
                 self._resample()
 
                 self.stats.time_iter('stop')
+                instrument.iteration(self.iteration)
 
 
         except KeyboardInterrupt:
             pass
 
+        finally:
+            self.statslogger.flush()
+            self.wq.stats.save()
+
         # except Exception, e:
         #     print 'Failed:', e
         #     import sys
         #     sys.exit(1)
 
 
+    def _run_pipelined(self):
+        """
+        Run the iterations without a global barrier: a cell is resampled
+        as soon as the walkers launched from it have returned, and its
+        new walkers are submitted right away.  Walkers that move to a cell
+        whose own walkers are still running wait there and are resampled
+        with them.  Each generation is resampled separately: a cell may
+        hold the walkers of several iterations.  An iteration ends once
+        no walker of that generation is running.
+        """
+
+        if self.iteration >= self.iterations: return
+
+        if self.iteration % self.checkpointfreq == 0:
+            print time.asctime(), 'Checkpointing to', self.traxlogger.cpt_path
+            self.checkpoint()
+
+        self._origin      = dict()             # walker id -> cell it was launched from
+        self._generation  = dict()             # walker id -> iteration it was launched in
+        self._outstanding = defaultdict(int)   # iteration -> number of running walkers
+        self._pending     = dict()             # (cell, generation) -> running walkers launched from it
+        self._inbox       = dict()             # (cell, generation) -> returned walkers waiting to be resampled
+        self._cellwait    = dict()             # (cell, generation) -> time its first walker returned
+        self._weight      = self.system.weights.sum()
+
+        print time.asctime(), 'Pipelined iterations from', self.iteration + 1, 'with', len(self.system.ensemble), 'walkers'
+        self.stats.time_iter('start')
+
+        generation = self.iteration + 1
+        returned   = [w for w in self.system.walkers if w.end is not None]
+        self._launch([w for w in self.system.walkers if w.end is None], generation)
+        for walker in returned:
+            self._generation[walker.id] = generation
+            self._inbox.setdefault((walker.assignment, generation), []).append(walker.id)
+        for key in self._inbox.keys():
+            if key not in self._pending:
+                self._resample_cell(*key)
+
+        if self._decoder is None:
+            while not self.wq.empty:
+                for walker in self.wq.recv(self.marshal_from_task):
+                    self.system.set_walker(walker)
+                    self.logwalker(walker)
+                    self._arrive(walker)
+                self._try_duplicate_tasks()
+                self._end_iterations()
+        else:
+            for batch in self.wq.recv_batches(decode_result, self._decoder, self.decode_batchsize):
+                for walker in self._apply(batch):
+                    self._arrive(walker)
+                self._try_duplicate_tasks()
+                self._end_iterations()
+
+        self._end_iterations()
+
+    def _launch(self, walkers, generation):
+        for walker in walkers:
+            self._origin[walker.id]     = walker.assignment
+            self._generation[walker.id] = generation
+            self._pending.setdefault((walker.assignment, generation), set()).add(walker.id)
+            self._outstanding[generation] += 1
+        self._submit_walkers(list(walkers))
+
+    def _arrive(self, walker):
+        wid        = walker.id
+        generation = self._generation[wid]
+        origin     = self._origin.pop(wid), generation
+        target     = walker.assignment, generation
+        self._outstanding[generation] -= 1
+        self._pending[origin].discard(wid)
+        if not self._pending[origin]:
+            del self._pending[origin]
+        self._inbox.setdefault(target, []).append(wid)
+        self._cellwait.setdefault(origin, time.time())
+
+        for key in set([origin, target]):
+            if key not in self._pending and key in self._inbox:
+                self._resample_cell(*key)
+
+        ### all the walkers launched from *origin* moved on
+        if origin not in self._pending:
+            self._cellwait.pop(origin, None)
+
+    @instrument.instrumented('resample_cell')
+    def _resample_cell(self, cid, generation):
+        """
+        Resample the returned walkers of *generation* in the cell *cid*
+        and launch their successors in the next generation
+        """
+        wids  = self._inbox.pop((cid, generation))
+        ens   = self.system.ensemble
+        local = self.system.clone(cells={cid : self.system.cell(cid)}, ensemble=ens.select(ens.rows(wids)))
+        for wid in wids:
+            del self._generation[wid]
+
+        if (cid, generation) in self._cellwait:
+            self.stats.cell_barrier(time.time() - self._cellwait.pop((cid, generation)))
+
+        self.stats.time_resample('start')
+        resampled = self.resample.resample_cell(local)
+        self.stats.time_resample('stop')
+
+        ens.remove(wids)
+        ens.update(resampled.ensemble)
+
+        if generation + 1 <= self.iterations:
+            self._launch(resampled.walkers, generation + 1)
+
+    def _end_iterations(self):
+        """
+        Close the iterations that have no running walkers left
+        """
+        running = [g for g, n in self._outstanding.iteritems() if n > 0]
+        lowest  = min(running) if running else max(self._outstanding.keys() or [self.iteration]) + 1
+
+        while self.iteration + 1 < lowest and self.iteration < self.iterations:
+            self.iteration += 1
+            self.stats.time_iter('stop')
+
+            weight = self.system.weights.sum()
+            assert abs(weight - self._weight) <= 1e-6 * max(1., abs(self._weight)), \
+                'Total weight not conserved in iteration %d: %s != %s' % (self.iteration, weight, self._weight)
+
+            self.resample.end_iteration(self.system)
+            self.wq.clear_completed()
+            self._outstanding.pop(self.iteration, None)
+
+            print time.asctime(), 'Finished iteration', self.iteration, 'with', len(self.system.ensemble), 'walkers'
+            runtime = stats.time.time()
+            self.statslogger.update(runtime, 'AWE', 'iteration', self.iteration)
+            self.statslogger.update(runtime, 'AWE', 'walkers', len(self.system.ensemble))
+            instrument.iteration(self.iteration)
+
+            if self.iteration < self.iterations:
+                if self.iteration % self.checkpointfreq == 0:
+                    print time.asctime(), 'Checkpointing to', self.traxlogger.cpt_path
+                    self.checkpoint()
+                self.stats.time_iter('start')
+
+
     # @typecheck(int, int)
     # @returns(str)
-    def encode_task_tag(self, walker):
-        tag = '%(outfile)s|%(cellid)d|%(weight)f|%(walkerid)d' % {
+    def encode_task_tag(self, walkers):
+        """
+        The cell and weight are those of the first of the *walkers*
+        """
+        tag = '%(outfile)s|%(cellid)d|%(weight)f|%(walkerids)s' % {
             'outfile' : os.path.join(self.wq.tmpdir, workqueue.RESULT_NAME),
-            'cellid'  : walker.assignment,
-            'weight'  : walker.weight,
-            'walkerid' : walker.id}
+            'cellid'  : walkers[0].assignment,
+            'weight'  : walkers[0].weight,
+            'walkerids' : ','.join(str(w.id) for w in walkers)}
 
         return tag
 
     @typecheck(str)
     @returns(dict)
     def decode_from_task_tag(self, tag):
-        split = tag.split('|')
-        outfile, cellid, weight, walkerid = tag.split('|')
-        return {'cellid'   : int(cellid)   ,
-                'weight'   : float(weight) ,
-                'walkerid' : int(walkerid) ,
-                'outfile'  : outfile       }
+        outfile, cellid, weight, walkerids = tag.split('|')
+        walkerids = map(int, walkerids.split(','))
+        return {'cellid'    : int(cellid)   ,
+                'weight'    : float(weight) ,
+                'walkerid'  : walkerids[0]  ,
+                'walkerids' : walkerids     ,
+                'outfile'   : outfile       }
 
         
 
-    @typecheck(int, workqueue.WQ.Task)
-    def marshal_to_task(self, walker, task):
-        
+    def _setup_transport(self):
+        """
+        Write the topology template and list the files the worker needs
+        to convert binary walkers, and the number of nearest cells to
+        report
+        """
+        self._transportfiles = []
+
+        if self.topcells > 0:
+            top = os.path.join(self.wq.tmpdir, workqueue.WORKER_TOP_CELLS_NAME)
+            with open(top, 'w') as fd:
+                fd.write('%d\n' % self.topcells)
+            self._transportfiles.append(workqueue.WQFile(top, remotepath=workqueue.WORKER_TOP_CELLS_NAME))
+
+        if self.frames:
+            flag = os.path.join(self.wq.tmpdir, workqueue.WORKER_FRAMES_NAME)
+            open(flag, 'w').close()
+            self._transportfiles.append(workqueue.WQFile(flag, remotepath=workqueue.WORKER_FRAMES_NAME))
+
+        if self.transport != 'binary':
+            return
+
+        topology = os.path.join(self.wq.tmpdir, workqueue.WORKER_TOPOLOGY_NAME)
+        with open(topology, 'w') as fd:
+            fd.write(str(self.system.topology))
+
+        converter = os.path.splitext(transport.__file__)[0] + '.py'
+        self._transportfiles += [
+            workqueue.WQFile(topology , remotepath=workqueue.WORKER_TOPOLOGY_NAME),
+            workqueue.WQFile(converter, remotepath=workqueue.WORKER_CONVERTER_NAME)
+            ]
+
+    @typecheck(list, workqueue.TASK_TYPES)
+    @instrument.instrumented('marshal_to_task')
+    def marshal_to_task(self, walkers, task):
+
+        if self._transportfiles is None:
+            self._setup_transport()
+
+        for wqf in self._transportfiles:
+            wqf.add_to_task(task)
+
+        if self.transport == 'binary':
+            ### walker.bin.<task>.<k> for the k-th walker of the task, referring
+            ### to its coordinates by digest (see awe.workqueue.BlobCache)
+            for k, walker in enumerate(walkers):
+                digest = self.wq.stage_blob(task, transport.pack_coords(walker.start))
+                wdat   = transport.pack_reference(walker, digest)
+                task.specify_buffer(wdat, '%s.%d.%d' % (workqueue.WORKER_WALKER_BINARY, self.currenttask, k), cache=False)
 
-        ### create the pdb
-        top        = self.system.topology
-        top.coords = walker.start
-        pdbdat     = str(top)
+        else:
+            walker, = walkers
 
-        ### send walker to worker
-        wdat = pickle.dumps(walker)
-        task.specify_buffer(pdbdat, workqueue.WORKER_POSITIONS_NAME+"."+str(self.currenttask), cache=False)
-        task.specify_buffer(wdat  , workqueue.WORKER_WALKER_NAME+"."+str(self.currenttask)   , cache=False)
+            ### create the pdb
+            with instrument.span('pdb render'):
+                pdbdat = self.system.template.render(walker.start)
+
+            ### send walker to worker
+            with instrument.span('pickle'):
+                wdat   = pickle.dumps(walker)
+            task.specify_buffer(pdbdat, workqueue.WORKER_POSITIONS_NAME+"."+str(self.currenttask), cache=False)
+            task.specify_buffer(wdat  , workqueue.WORKER_WALKER_NAME+"."+str(self.currenttask)   , cache=False)
 
         ### specify output
         self.specify_task_output_file(task)
 
     def specify_task_output_file(self, task):
-        output = os.path.join(self.wq.tmpdir, task.tag)
+        output = result_path(task.tag)
         task.specify_output_file(output, remote_name = workqueue.WORKER_RESULTS_NAME+"."+str(self.currenttask), cache=False)
 
-    @typecheck(workqueue.WQ.Task)
-    @returns(Walker)
+    @instrument.instrumented('log transition')
+    def _transition(self, wid, assignment, cellid):
+        print time.asctime(), 'Iteration', self.iteration, '/', self.iterations, \
+              'Walker', wid, \
+              'transition', assignment, '->', cellid, \
+              self.wq.tasks_in_queue(), 'tasks remaining'
+        t = time.time()
+        self.statslogger.update(t, 'TRANSITION', 'iteration', self.iteration)
+        self.statslogger.update(t, 'TRANSITION', 'walker'   , wid)
+        self.statslogger.update(t, 'TRANSITION', 'from'     , assignment)
+        self.statslogger.update(t, 'TRANSITION', 'to'       , cellid)
+
+    @instrument.instrumented('log frames')
+    def _log_frames(self, wid, color, weight, frames):
+        if frames is None: return
+        ### the iteration the walker was launched in, which is ahead of self.iteration when pipelined
+        iteration = getattr(self, '_generation', {}).get(wid, self.iteration)
+        self.framelog.append(wid, iteration, color, weight, frames)
+
+    @typecheck(workqueue.TASK_TYPES)
+    @returns(list)
+    @instrument.instrumented('marshal_from_task')
     def marshal_from_task(self, result):
 
-        import tarfile
-        tar = tarfile.open(result.tag)
-        try:
-            walkerstr         = tar.extractfile(workqueue.WORKER_WALKER_NAME).read()
-            pdbstring         = tar.extractfile(workqueue.RESULT_POSITIONS).read()
-            cellstring        = tar.extractfile(workqueue.RESULT_CELL     ).read()
-        finally:
-            tar.close()
+        walkers = []
+        for r in decode_result(result.tag):
+            walker = self.system.walker(r.wid)
 
-        pdb               = structures.PDB(pdbstring)
-        coords            = pdb.coords
-        cellid            = int(cellstring)
+            self._transition(r.wid, walker.assignment, r.cellid)
+            self._log_frames(r.wid, walker.color, walker.weight, r.frames)
 
-        walker            = pickle.loads(walkerstr)
+            walker.end        = r.coords
+            walker.assignment = r.cellid
+            walker.topcells   = r.topcells
+            walkers.append(walker)
 
-        transition = walker.assignment != cellid
-        print time.asctime(), 'Iteration', self.iteration, '/', self.iterations, \
-              'Walker', walker.id, \
-              'transition', walker.assignment, '->', cellid, \
-              self.wq.tasks_in_queue(), 'tasks remaining'
-        self.transitionslogger.update(time.time(), 'AWE', 'cell_transition',
-                                      'iteration %s from %s to %s %s' % \
-                                          (self.iteration, walker.assignment, cellid, transition))
+        return walkers
 
-        walker.end        = coords
-        walker.assignment = cellid
-
-        os.unlink(result.tag)
-        return walker
+    @instrument.instrumented('apply')
+    def _apply(self, batch):
+        """
+        Store a batch of Results decoded by *decode_result* in the
+        System.  Returns the walkers.
+        """
+        t0      = time.time()
+        ens     = self.system.ensemble
+        wids    = [r.wid for r in batch]
+        rows    = ens.rows(wids)
+        cellids = np.array([r.cellid for r in batch], dtype=int)
+
+        for wid, assignment, cellid in zip(wids, ens.assignments[rows], cellids):
+            self._transition(wid, assignment, cellid)
+        for r, color, weight in zip(batch, ens.colors[rows], ens.weights[rows]):
+            self._log_frames(r.wid, color, weight, r.frames)
+
+        ens.finish(wids, cellids, np.array([r.coords for r in batch]),
+                   topcells=[r.topcells for r in batch])
+
+        walkers = [ens.walker(wid) for wid in wids]
+        for walker in walkers:
+            self.logwalker(walker)
 
+        self.wq.stats.ingest('apply', len(batch), time.time() - t0)
+        return walkers
 
 
 
@@ -449,24 +857,539 @@ class Cell(object):
 
 
 
+def _column(name, settable=False):
+    """
+    Property for a read-only view of the occupied rows of the column
+    *name*.  If *settable*, assigning to the property writes the column.
+    """
+    def get(self):
+        view = getattr(self, '_' + name)[:self._count]
+        view.flags.writeable = False
+        return view
+
+    def set(self, values):
+        getattr(self, '_' + name)[:self._count] = values
+        self._modified()
+
+    return property(get, set if settable else None)
+
+
+class WalkerEnsemble(object):
+
+    """
+    Columnar storage of the walkers in a System.
+
+    The scalar attributes of the walkers are kept in parallel numpy
+    arrays.  Weights, colors, and per-cell or per-color selections are
+    then array operations instead of loops over Walker objects.  The
+    column properties return read-only views; bulk updates are written
+    by assigning to *assignments*, *colors* or *weights*, e.g.
+
+        ens.colors = newcolors
+
+    Every change of the columns increments *version*.
+
+    The coordinates live in a memory-mapped coordinates.CoordinateStore
+    and each walker only holds the slots of its starting and ending
+    frames.  Ensembles derived from this one by *select* and *restart*
+    share the store, and a restarted walker starts from the slot its
+    parent ended in.
+
+    Relevant fields are:
+
+      *ids*, *initids*, *cellids*, *assignments*, *colors* : int arrays
+      *parentids*  : id of the walker each one was restarted from, or -1
+      *weights*    : float array
+      *topcells*   : (nwalkers, k) awe.assign.TOP_DTYPE array of the nearest cells of the
+                     ending coordinates, if the workers report them; missing cells are -1
+      *start*      : (nwalkers, natoms, ndim) copy of the starting coordinates
+      *end*        : (nwalkers, natoms, ndim) copy of the ending coordinates, valid where *hasend*
+    """
+
+    _INT_FIELDS  = ('id', 'initid', 'cellid', 'assignment', 'color', 'parentid')
+    _SLOT_FIELDS = ('startslot', 'endslot')
+    _VALUE_FIELDS = ('weight', 'hasend', 'topcells')
+
+    def __init__(self, capacity=64, store=None):
+        self._capacity = max(1, capacity)
+        self._count    = 0
+        self._index    = dict()
+
+        self._id         = np.zeros(self._capacity, dtype=int)
+        self._initid     = np.zeros(self._capacity, dtype=int)
+        self._cellid     = np.zeros(self._capacity, dtype=int)
+        self._assignment = np.zeros(self._capacity, dtype=int)
+        self._color      = np.zeros(self._capacity, dtype=int)
+        self._parentid   = np.zeros(self._capacity, dtype=int)
+        self._weight     = np.zeros(self._capacity, dtype=float)
+        self._hasend     = np.zeros(self._capacity, dtype=bool)
+        self._startslot  = np.zeros(self._capacity, dtype=int)
+        self._endslot    = np.zeros(self._capacity, dtype=int)
+
+        ### as wide as the most nearest cells reported
+        self._topcells   = np.zeros((self._capacity, 0), dtype=assign.TOP_DTYPE)
+
+        ### created once the shape of the coordinates is known
+        self._store      = store
+
+        self._version    = 0
+
+    def __del__(self):
+        try:
+            self._release(np.arange(self._count))
+        except Exception:
+            pass                # interpreter shutdown
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, wid):
+        return wid in self._index
+
+    def __str__(self):
+        return '<WalkerEnsemble: nwalkers=%d, natoms=%s>' % (len(self), self.natoms)
+
+    def __repr__(self): return str(self)
+
+
+    def __getstate__(self):
+        """
+        Only pickle the occupied rows, with their coordinates instead of the store
+        """
+        n = self._count
+        odict = self.__dict__.copy()
+        del odict['_index']
+        del odict['_store']
+        odict.pop('_walkercache', None)
+        odict.pop('_version', None)
+        for name in self._INT_FIELDS + self._SLOT_FIELDS + self._VALUE_FIELDS:
+            odict['_' + name] = odict['_' + name][:n].copy()
+        for name in self._SLOT_FIELDS:
+            del odict['_' + name]
+        odict['_start']    = self.start
+        odict['_end']      = self.end
+        odict['_capacity'] = max(1, n)
+        return odict
+
+    def __setstate__(self, odict):
+        if '_parentid' not in odict:
+            odict['_parentid'] = _NONE * np.ones_like(odict['_id'])
+        if '_topcells' not in odict:
+            odict['_topcells'] = np.zeros((len(odict['_id']), 0), dtype=assign.TOP_DTYPE)
+        start = odict.pop('_start')
+        end   = odict.pop('_end')
+        n     = odict['_count']
+        self.__dict__.update(odict)
+        self._startslot = _NONE * np.ones(len(self._id), dtype=int)
+        self._endslot   = _NONE * np.ones(len(self._id), dtype=int)
+        self._store     = None
+        self._version   = 0
+        if self._capacity > len(self._id):
+            self._resize(self._capacity)
+        if start is not None:
+            self._alloc_coords(start.shape[1:], start.dtype)
+            self._startslot[:n] = self._store.store(start[:n])
+            ends = np.where(self._hasend[:n])[0]
+            self._endslot[ends] = self._store.store(end[ends])
+        self._reindex()
+
+    def _reindex(self):
+        self._index = dict(zip(self._id[:self._count].tolist(), xrange(self._count)))
+
+    def _modified(self):
+        self._version += 1
+
+    @property
+    def version(self):
+        """
+        Number of changes of the columns, to tell if derived data is stale
+        """
+        return self._version
+
+
+    @property
+    def store(self): return self._store
+
+    @property
+    def natoms(self):
+        return None if self._store is None else self._store.shape[0]
+
+    @property
+    def ndim(self):
+        return None if self._store is None else self._store.shape[1]
+
+    ### column views over the occupied rows
+    ids         = _column('id')
+    initids     = _column('initid')
+    cellids     = _column('cellid')
+    assignments = _column('assignment', settable=True)
+    colors      = _column('color',      settable=True)
+    parentids   = _column('parentid')
+    weights     = _column('weight',     settable=True)
+    hasend      = _column('hasend')
+    topcells    = _column('topcells')
+    startslots  = _column('startslot')
+    endslots    = _column('endslot')
+    start       = property(lambda self: self.start_at(slice(None)))
+    end         = property(lambda self: self.end_at(slice(None)))
+
+    def start_at(self, rows):
+        """
+        A copy of the starting coordinates of the walkers at *rows*
+        """
+        if self._store is None: return None
+        return self._store.gather(self.startslots[rows])
+
+    def end_at(self, rows):
+        """
+        A copy of the ending coordinates of the walkers at *rows*
+        """
+        if self._store is None: return None
+        return self._store.gather(self.endslots[rows])
+
+    @property
+    def topk(self):
+        """
+        Number of nearest cells kept per walker
+        """
+        return self._topcells.shape[1]
+
+    def set_topcells(self, rows, topcells):
+        """
+        Store the nearest cells *topcells* (a sequence of TOP_DTYPE
+        arrays, or None) of the walkers at *rows*, widening the column if
+        needed
+        """
+        self._topcells[rows] = _NOTOP
+        self._modified()
+        if topcells is None: return
+
+        k = max([0] + [len(t) for t in topcells if t is not None])
+        if k > self.topk:
+            wider = np.empty((self._capacity, k), dtype=assign.TOP_DTYPE)
+            wider.fill(_NOTOP)
+            wider[:, :self.topk] = self._topcells
+            self._topcells = wider
+        for i, top in zip(rows, topcells):
+            if top is not None:
+                self._topcells[i, :len(top)] = top
+
+    def topcells_at(self, i):
+        """
+        The nearest cells of the walker at row *i*, or None if they were not reported
+        """
+        top = self._topcells[i]
+        top = top[top['cell'] != _NONE]
+        return top.copy() if len(top) else None
+
+
+    def _alloc_coords(self, shape, dtype):
+        self._store = coordinates.CoordinateStore(shape, dtype=dtype, capacity=2 * self._capacity)
+
+    def _resize(self, capacity):
+        def grow(a):
+            b = np.zeros((capacity,) + a.shape[1:], dtype=a.dtype)
+            n = min(len(a), capacity)
+            b[:n] = a[:n]
+            return b
+
+        for name in self._INT_FIELDS + self._SLOT_FIELDS + self._VALUE_FIELDS:
+            setattr(self, '_' + name, grow(getattr(self, '_' + name)))
+        self._capacity = capacity
+
+    def _reserve(self, n):
+        """
+        Make sure there is room for *n* more walkers
+        """
+        need = self._count + n
+        if need > self._capacity:
+            self._resize(max(need, 2 * self._capacity))
+
+    def _release(self, rows):
+        if self._store is None: return
+        self._store.decref(self._startslot[rows])
+        self._store.decref(self._endslot  [rows])
+
+    def _put(self, slots, i, coords):
+        """
+        Write *coords* in the slot of row *i* of *slots*, which gets a
+        slot of its own if it shares one
+        """
+        slot = slots[i]
+        if slot >= 0 and np.may_share_memory(coords, self._store[slot]):
+            return              # a walker of this ensemble written back
+        if slot >= 0 and self._store.refcount(slot) == 1:
+            self._store[slot] = coords
+        else:
+            self._store.decref([slot])
+            slots[i] = self._store.store([coords])[0]
+
+
+    def row(self, wid):
+        return self._index[wid]
+
+    def rows(self, wids):
+        index = self._index
+        return np.fromiter((index[w] for w in wids), dtype=int, count=len(wids))
+
+    def finish(self, wids, assignments, end, topcells=None):
+        """
+        Record the final *assignments* and *end* coordinates of the
+        walkers *wids*, and their nearest cells *topcells* if given
+        """
+        rows = self.rows(wids)
+        self._assignment[rows] = assignments
+        self._store.decref(self._endslot[rows])
+        self._endslot   [rows] = self._store.store(end)
+        self._hasend    [rows] = True
+        self._modified()
+        self.set_topcells(rows, topcells)
+
+    def set(self, walker):
+        """
+        Add the *walker*, or overwrite the row of a walker with the same id
+        """
+        coords = walker.start if walker.start is not None else walker.end
+        if self._store is None:
+            self._alloc_coords(coords.shape, coords.dtype)
+
+        i = self._index.get(walker.id)
+        if i is None:
+            self._reserve(1)
+            i = self._count
+            self._count += 1
+            self._index[walker.id] = i
+            self._startslot[i] = _NONE
+            self._endslot  [i] = _NONE
+
+        self._id        [i] = walker.id
+        self._initid    [i] = walker.initid
+        self._cellid    [i] = _NONE if walker.cellid     is None else walker.cellid
+        self._assignment[i] = _NONE if walker.assignment is None else walker.assignment
+        self._color     [i] = walker.color
+        self._parentid  [i] = _NONE if walker.parentid   is None else walker.parentid
+        self._weight    [i] = np.nan if walker.weight is None else walker.weight
+        self._modified()
+
+        if walker.start is not None:
+            self._put(self._startslot, i, walker.start)
+        if walker.end is not None:
+            self._put(self._endslot, i, walker.end)
+            self._hasend[i] = True
+            self.set_topcells([i], [walker.topcells])
+        else:
+            self._store.decref([self._endslot[i]])
+            self._endslot[i] = _NONE
+            self._hasend [i] = False
+            self.set_topcells([i], None)
+
+    def append(self, ids, initids, cellids, assignments, colors, weights, start, end=None, parentids=_NONE):
+        """
+        Append a block of new walkers given as arrays
+        """
+        n = len(ids)
+        if n == 0: return
+        if self._store is None:
+            self._alloc_coords(start.shape[1:], start.dtype)
+
+        startslots = self._store.store(start)
+        endslots   = self._store.store(end) if end is not None else _NONE
+        self._append_slots(ids, initids, cellids, assignments, colors, weights, startslots, endslots, parentids)
+
+    def _append_slots(self, ids, initids, cellids, assignments, colors, weights, startslots, endslots, parentids):
+        """
+        Append a block of walkers whose coordinates are already in the
+        store, taking over a reference to the slots
+        """
+        n = len(ids)
+        self._reserve(n)
+        i, j = self._count, self._count + n
+        self._id        [i:j] = ids
+        self._initid    [i:j] = initids
+        self._cellid    [i:j] = cellids
+        self._assignment[i:j] = assignments
+        self._color     [i:j] = colors
+        self._parentid  [i:j] = parentids
+        self._weight    [i:j] = weights
+        self._startslot [i:j] = startslots
+        self._endslot   [i:j] = endslots
+        self._hasend    [i:j] = self._endslot[i:j] >= 0
+        self._topcells  [i:j] = _NOTOP
+
+        self._count = j
+        self._index.update(zip(self._id[i:j].tolist(), xrange(i, j)))
+        self._modified()
+
+    def _share(self, other, rows):
+        """
+        Append the walkers of *other* at *rows*, sharing the coordinates
+        if both ensembles use the same store and copying them otherwise
+        """
+        if len(rows) == 0: return
+        if self._store is None:
+            self._store = other._store
+
+        startslots = other.startslots[rows]
+        endslots   = np.where(other.hasend[rows], other.endslots[rows], _NONE)
+        if self._store is other._store:
+            self._store.incref(startslots)
+            self._store.incref(endslots)
+        else:
+            startslots = self._store.store(other._store.gather(startslots))
+            ends       = endslots >= 0
+            endslots[ends] = self._store.store(other._store.gather(endslots[ends]))
+
+        i = self._count
+        self._append_slots(other.ids[rows], other.initids[rows], other.cellids[rows], other.assignments[rows],
+                           other.colors[rows], other.weights[rows], startslots, endslots, other.parentids[rows])
+        if other.topk > 0:
+            self.set_topcells(np.arange(i, self._count), list(other.topcells[rows]))
+
+    def update(self, other):
+        """
+        Merge the walkers of *other* into this ensemble, overwriting
+        walkers that have the same id
+        """
+        if len(other) == 0: return
+        known = np.fromiter((w in self._index for w in other.ids), dtype=bool, count=len(other))
+        for k in np.where(known)[0]:
+            self.set(other._walker_at(k))
+        self._share(other, np.where(~known)[0])
+
+    def select(self, which):
+        """
+        A new ensemble with the walkers at the rows given by *which*
+        (a boolean mask or an array of row indices), sharing the store
+        """
+        which = np.asarray(which)
+        if which.dtype == bool:
+            which = np.where(which)[0]
+
+        ens = WalkerEnsemble(capacity=len(which), store=self._store)
+        if self._store is None or len(which) == 0: return ens
+        ens._share(self, which)
+        return ens
+
+    def remove(self, wids):
+        """
+        Remove the walkers with the given ids.  The last rows are moved
+        into the freed ones, so previously obtained views become stale.
+        """
+        for wid in wids:
+            i    = self._index.pop(wid)
+            last = self._count - 1
+            self._release([i])
+            if i != last:
+                for name in self._INT_FIELDS + self._SLOT_FIELDS + self._VALUE_FIELDS:
+                    a    = getattr(self, '_' + name)
+                    a[i] = a[last]
+                self._index[self._id[i]] = i
+            self._count -= 1
+            self._modified()
+
+    def groupby(self, *columns):
+        """
+        Segment the walkers by the values of the given *columns*
+        (e.g. 'assignments', 'colors').
+
+        Returns (order, starts, counts): the row indices sorted by key,
+        and the offset and length of each segment in *order*.
+        """
+        keys = [getattr(self, c) for c in columns]
+        if len(self) == 0:
+            empty = np.zeros(0, dtype=int)
+            return empty, empty, empty
+
+        order  = np.lexsort(keys[::-1])
+        keyed  = np.array([k[order] for k in keys])
+        change = np.any(keyed[:, 1:] != keyed[:, :-1], axis=0)
+        starts = np.concatenate(([0], np.where(change)[0] + 1))
+        counts = np.diff(np.append(starts, len(order)))
+        return order, starts, counts
+
+
+    def restart(self, rows, weights):
+        """
+        A new ensemble of walkers restarted from the ends of the walkers
+        at *rows*, with the given *weights*.  This is the vectorized
+        version of Walker.restart.  The new walkers start from the
+        slots their parents ended in.
+        """
+        ens = WalkerEnsemble(capacity=len(rows), store=self._store)
+        if len(rows) == 0: return ens
+        assert self.hasend[rows].all()
+        slots = self.endslots[rows]
+        self._store.incref(slots)
+        ens._append_slots(new_walker_ids(len(rows)), self.initids[rows], self.cellids[rows],
+                          self.assignments[rows], self.colors[rows], weights, slots, _NONE, self.ids[rows])
+        return ens
+
+    def _frame(self, slot):
+        """
+        A copy of the frame at *slot*, or None for a missing one
+        """
+        return None if slot == _NONE else self._store[slot].copy()
+
+    def _walker_at(self, i, start=None, end=None):
+        cellid     = self._cellid[i]
+        assignment = self._assignment[i]
+        weight     = self._weight[i]
+        if start is None:                     start = self._frame(self._startslot[i])
+        if end   is None and self._hasend[i]: end   = self._frame(self._endslot[i])
+        return Walker(start      = start,
+                      end        = end,
+                      assignment = None if assignment == _NONE else int(assignment),
+                      color      = int(self._color[i]),
+                      weight     = None if np.isnan(weight) else float(weight),
+                      wid        = int(self._id[i]),
+                      cellid     = None if cellid == _NONE else int(cellid),
+                      initid     = int(self._initid[i]),
+                      parentid   = None if self._parentid[i] == _NONE else int(self._parentid[i]),
+                      topcells   = self.topcells_at(i))
+
+    def walker(self, wid):
+        """
+        A Walker for the row of *wid*.  Its coordinates are copies, so
+        they outlive the slots of the store, which are reused once the
+        walker is removed.
+        """
+        return self._walker_at(self._index[wid])
+
+    _walkercache = None     # (version, walkers) of the last call to *walkers*
+
+    def walkers(self):
+        """
+        A Walker for each row, with copies of the coordinates gathered at
+        once.  The list and the walkers are reused until the ensemble
+        changes, so they must not be modified.
+        """
+        if self._walkercache is None or self._walkercache[0] != self._version:
+            hasstart     = self.startslots != _NONE
+            starts, ends = self.start, self.end
+            walkers      = [self._walker_at(i, starts[i] if hasstart[i] else None, ends[i] if self._hasend[i] else None)
+                            for i in xrange(self._count)]
+            self._walkercache = self._version, walkers
+        return self._walkercache[1]
+
+
 class System(object):
 
-    def __init__(self, topology=None, cells=None):
+    def __init__(self, topology=None, cells=None, ensemble=None):
         self._topology = topology
         self._cells    = cells or dict()
-        self._walkers  = dict()
+        self._ensemble = ensemble if ensemble is not None else WalkerEnsemble()
 
 
     def __str__(self):
         return '<System: topology=%s, ncells=%s, nwalkers=%s>' % \
-            (type(self.topology), len(self._cells), len(self._walkers))
+            (type(self._topology), len(self._cells), len(self._ensemble))
 
     def __repr__(self):
         return 'System(topology=%r, cells=%r)' % (self._topology, self._cells)
 
     def __iadd__(self, other):
         self._cells.update(other._cells)
-        self._walkers.update(other._walkers)
+        self._ensemble.update(other._ensemble)
 
         return self
 
@@ -474,6 +1397,16 @@ class System(object):
     @property
     def topology(self): return self._topology.copy()
 
+    @property
+    def template(self):
+        """
+        The structures.PDBTemplate of the topology, shared by all clones
+        """
+        return self._topology.template()
+
+    @property
+    def ensemble(self): return self._ensemble
+
     @property
     @returns(list)
     def cells(self):
@@ -482,17 +1415,17 @@ class System(object):
     @property
     @returns(list)
     def walkers(self):
-        return self._walkers.values()
+        return self._ensemble.walkers()
 
     @property
     # @returns(np.array)
     def weights(self):
-        return np.array(map(lambda w: w.weight, self.walkers))
+        return self._ensemble.weights.copy()
 
     @property
     @returns(set)
     def colors(self):
-        return set(map(lambda w: w.color, self.walkers))
+        return set(np.unique(self._ensemble.colors).tolist())
 
     @typecheck(Cell)
     def add_cell(self, cell):
@@ -506,7 +1439,7 @@ class System(object):
 
     @returns(Walker)
     def walker(self, wid):
-        return self._walkers[wid]
+        return self._ensemble.walker(wid)
 
     @typecheck(Walker)
     def add_walker(self, walker):
@@ -515,7 +1448,7 @@ class System(object):
 
     @typecheck(Walker)
     def set_walker(self, walker):
-        self._walkers[walker.id] = walker
+        self._ensemble.set(walker)
 
     @returns(Cell)
     def cell(self, i):
@@ -525,23 +1458,31 @@ class System(object):
     def has_cell(self, i):
         return i in self._cells
 
+    def cores(self, cellids):
+        """
+        The core of each cell id in the array *cellids*
+        """
+        ids   = np.array(self._cells.keys(), dtype=int)
+        cores = np.array([c.core for c in self._cells.itervalues()], dtype=int)
+        order = np.argsort(ids)
+        pos   = np.searchsorted(ids, cellids, sorter=order).clip(0, max(0, len(ids) - 1))
+        rows  = order[pos]
+        if not (ids[rows] == cellids).all():
+            raise KeyError, 'Unknown cells: %s' % np.setdiff1d(cellids, ids)
+        return cores[rows]
+
     # @returns(System)
     def filter_by_cell(self, cell):
-        ws     = filter(lambda w: w.assignment == cell.id, self.walkers)
-        newsys = self.clone(cells={cell.id:self.cell(cell.id)})
-        for w in ws: newsys.add_walker(w)
-        return newsys
+        ens    = self._ensemble.select(self._ensemble.assignments == cell.id)
+        return self.clone(cells={cell.id:self.cell(cell.id)}, ensemble=ens)
 
     # @returns(System)
     def filter_by_color(self, color):
-        ws     = filter(lambda w: w.color == color, self.walkers)
-        newsys = self.clone()
-
-        for w in ws:
-            newsys.add_walker(w)
+        ens    = self._ensemble.select(self._ensemble.colors == color)
+        newsys = self.clone(cells=False, ensemble=ens)
 
-            cell = self.cell(w.assignment)
-            newsys.set_cell(cell)
+        for a in np.unique(ens.assignments):
+            newsys.set_cell(self.cell(a))
 
         return newsys
 
@@ -552,16 +1493,21 @@ class System(object):
         cs     = {}
         for c in cells: cs[c.id] = c
 
-        newsys = self.clone(cells=cs)
-        for w in self.walkers:
-            if w.assignment in cs:
-                newsys.add_walker(w)
-
-        return newsys
+        ens    = self._ensemble.select(np.in1d(self._ensemble.assignments, cs.keys()))
+        return self.clone(cells=cs, ensemble=ens)
 
-    def clone(self, cells=True):
-        _cells = self._cells if cells else dict()
-        return System(topology=self.topology, cells=_cells)
+    def clone(self, cells=True, ensemble=None):
+        """
+        A System sharing the topology of this one.  *cells* may be
+        True (share the cells), False, or a dict of cells to use.
+        """
+        if cells is True:
+            _cells = self._cells
+        elif cells:
+            _cells = cells
+        else:
+            _cells = dict()
+        return System(topology=self._topology, cells=_cells, ensemble=ensemble)
 
 
 class SinkStates(object):
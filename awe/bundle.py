@@ -0,0 +1,97 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+Number of walkers to run in each task.
+
+A task runs its walkers one after the other (see execute-task.sh), so a
+bundle of K walkers pays the dispatch and file staging overhead once
+instead of K times, at the cost of parallelism.
+"""
+
+import math
+
+
+class IBundle(object):
+
+    """
+    Interface used by awe.aweclasses.AWE
+    """
+
+    def update(self, task, nwalkers):
+        """
+        A successful *task* that ran *nwalkers* returned
+        """
+        pass
+
+    def size(self, nwalkers, workers):
+        """
+        Number of walkers per task to run *nwalkers* on *workers*
+        """
+        raise NotImplementedError
+
+
+class FixedBundle(IBundle):
+
+    def __init__(self, size=1):
+        assert size >= 1
+        self._size = size
+
+    def size(self, nwalkers, workers):
+        return self._size
+
+
+class AdaptiveBundle(IBundle):
+
+    """
+    Choose K so that the overhead of a task is at most the fraction
+    *overhead* of its running time, without leaving workers idle:
+
+      K = o (1 - f) / (f w)
+
+    where o is the time a task spends outside its command (staging the
+    inputs, returning the outputs) and w is the command time per walker,
+    both exponentially weighted averages with factor *alpha*.  K is at
+    most *maxsize*, and at most the number of walkers per worker.  Until a
+    task has returned K is 1.
+    """
+
+    def __init__(self, overhead=0.1, maxsize=16, alpha=0.2):
+        assert 0 < overhead < 1
+        assert 0 < alpha <= 1
+        self.overhead = overhead
+        self.maxsize  = maxsize
+        self.alpha    = alpha
+
+        self._taskoverhead = None   # seconds per task
+        self._walkertime   = None   # seconds per walker
+
+    def _average(self, mean, value):
+        return value if mean is None else (1 - self.alpha) * mean + self.alpha * value
+
+    def update(self, task, nwalkers):
+        try:
+            execution = task.cmd_execution_time
+        except AttributeError:
+            execution = task.computation_time      # older cctools
+        execution = execution / 10.**6
+        total     = (task.finish_time - task.send_input_start) / 10.**6
+
+        self._taskoverhead = self._average(self._taskoverhead, max(0., total - execution))
+        self._walkertime   = self._average(self._walkertime, execution / max(1, nwalkers))
+
+    def size(self, nwalkers, workers):
+        if self._walkertime is None:
+            return 1
+
+        f = self.overhead
+        if self._walkertime > 0:
+            k = int(math.ceil(self._taskoverhead * (1 - f) / (f * self._walkertime)))
+        else:
+            k = self.maxsize
+        return max(1, min(k, self.maxsize, nwalkers // max(1, workers)))
@@ -0,0 +1,324 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+Incremental checkpoints of an AWE run.
+
+A checkpoint directory holds:
+
+  base.<n>.npz  : the columns and coordinates of the WalkerEnsemble
+  base.pkl      : the rest of the state (the System without its walkers,
+                  the resampler, the iteration, ...) and the number <n>
+  journal.pkl   : an append-only stream of pickled records since the base
+
+The journal records are the walker results passed to *log* and, at each
+*checkpoint*, the changes to the ensemble since the previous one, and
+the cells of the System if they changed (e.g. by awe-reassign).  A
+walker restarted from a walker whose end is already known only records
+its parent id instead of its coordinates, so a delta is mostly scalars.
+Every *compact* checkpoints the journal is folded into a new base.
+
+Everything is pickled at the highest protocol, so arrays are written as
+raw bytes.  The interface is the one of trax.SimpleTransactional used by
+AWE: *cpt_path*, *checkpoint*, *log*, and *recover*.
+"""
+
+from aweclasses import WalkerEnsemble
+import instrument
+
+import numpy as np
+import cPickle as pickle
+
+import os, time
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+_COLUMNS = ('ids', 'initids', 'cellids', 'assignments', 'colors', 'parentids', 'weights', 'hasend')
+_TOP     = 'topcells'      # (nwalkers, k) nearest cells, not part of older checkpoints
+
+
+class CheckpointException (Exception): pass
+
+
+class IncrementalCheckpoint(object):
+
+    """
+    Parameters:
+      *path*    : checkpoint directory
+      *compact* : write a new base every *compact* checkpoints
+    """
+
+    def __init__(self, path='debug/checkpoint', compact=10):
+        self._path     = path
+        self._compact  = compact
+
+        self._base     = -1       # number of the current base
+        self._deltas   = 0        # deltas in the journal
+        self._journal  = None
+        self._prev     = None     # columns of the ensemble at the last checkpoint
+        self._previds  = set()
+        self._cells    = None     # cells of the System at the last checkpoint
+        self._ended    = set()    # walkers of the last checkpoint whose result was logged since
+        self._bytes    = 0
+
+        self.written   = 0        # bytes written by the last checkpoint and the results before it
+        self.recovered = None     # seconds spent in the last recovery
+
+    @property
+    def cpt_path(self): return self._path
+
+    def _file(self, name):
+        return os.path.join(self._path, name)
+
+    def _write(self, record):
+        data = pickle.dumps(record, PROTOCOL)
+        self._journal.write(data)
+        self._journal.flush()
+        self._bytes += len(data)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+    def checkpoint(self, value):
+        """
+        Save *value*, the dict of the AWE state including the 'system'
+        """
+        if self._prev is None or self._deltas >= self._compact:
+            self._write_base(value)
+        else:
+            self._write_delta(value)
+        self._snapshot(value['system'].ensemble)
+        self._cells = _cells(value['system'])
+
+        self.written = self._bytes
+        self._bytes  = 0
+
+    def _split(self, value):
+        """
+        The state without the walkers, and the ensemble
+        """
+        system = value['system']
+        params = dict(value)
+        params['system'] = system.clone(ensemble=WalkerEnsemble())
+        return params, system.ensemble
+
+    def _snapshot(self, ens):
+        self._prev    = dict((c, getattr(ens, c).copy()) for c in _COLUMNS + (_TOP,))
+        self._previds = set(self._prev['ids'].tolist())
+        self._ended   = set()
+
+    @instrument.instrumented('checkpoint base')
+    def _write_base(self, value):
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+        params, ens = self._split(value)
+        base        = self._base + 1
+        arrays      = self._file('base.%d.npz' % base)
+
+        columns = dict((c, getattr(ens, c)) for c in _COLUMNS + (_TOP,))
+        if ens.start is not None:
+            columns['start'] = ens.start
+            columns['end']   = ens.end
+        with open(arrays, 'wb') as fd:
+            np.savez(fd, **columns)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        ### renaming the pickle commits the new base
+        tmp = self._file('base.pkl.tmp')
+        with open(tmp, 'wb') as fd:
+            pickle.dump(dict(base=base, params=params), fd, PROTOCOL)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp, self._file('base.pkl'))
+        self._bytes += os.path.getsize(arrays) + os.path.getsize(self._file('base.pkl'))
+
+        old = self._file('base.%d.npz' % self._base)
+        if os.path.exists(old):
+            os.unlink(old)
+
+        self.close()
+        self._journal = open(self._file('journal.pkl'), 'wb')
+        self._base    = base
+        self._deltas  = 0
+        self._write(('base', base))
+
+    @instrument.instrumented('checkpoint delta')
+    def _write_delta(self, value):
+        params, ens = self._split(value)
+        del params['system']
+        prev        = self._prev
+        cells       = _cells(value['system'])
+
+        ids     = ens.ids
+        removed = np.setdiff1d(prev['ids'], ids)
+
+        ### rows that are new or whose scalars changed
+        new     = ~np.in1d(ids, prev['ids'])
+        common  = np.where(~new)[0]
+        order   = np.argsort(prev['ids'])
+        before  = order[np.searchsorted(prev['ids'], ids[common], sorter=order)]
+        changed = np.zeros(len(ids), dtype=bool)
+        for c in _COLUMNS:
+            a, b = getattr(ens, c)[common], prev[c][before]
+            changed[common] |= ~((a == b) | ((a != a) & (b != b)))     # nan weights are equal
+        a, b = ens.topcells[common], prev[_TOP][before]
+        if a.shape[1] != b.shape[1]:
+            changed[common] |= ens.hasend[common]
+        else:
+            changed[common] |= ((a['cell'] != b['cell']) | ((a['rmsd'] != b['rmsd']) & (a['cell'] >= 0))).any(axis=1)
+        rows    = np.where(new | changed)[0]
+
+        ### walkers whose end is in the ensemble when this delta is replayed
+        endknown = np.array(sorted(set(prev['ids'][prev['hasend']].tolist()) | self._ended), dtype=int)
+
+        linked   = new[rows] & np.in1d(ens.parentids[rows], endknown)
+        starts   = rows[new[rows] & ~linked]
+        ends     = rows[ens.hasend[rows] & ~np.in1d(ids[rows], endknown)]
+
+        delta = dict(removed  = removed,
+                     columns  = dict((c, getattr(ens, c)[rows]) for c in _COLUMNS + (_TOP,)),
+                     startids = ids[starts],
+                     start    = ens.start_at(starts) if len(starts) else None,
+                     endids   = ids[ends],
+                     end      = ens.end_at(ends) if len(ends) else None)
+        if cells != self._cells:
+            delta['cells'] = cells
+        self._write(('checkpoint', params, delta))
+        self._deltas += 1
+
+    def log(self, walker):
+        """
+        Record the result of *walker*.  Walkers started since the last
+        checkpoint are saved with the next one instead.
+        """
+        if self._journal is None:
+            raise CheckpointException, 'Cannot log walker %d before the first checkpoint' % walker.id
+        if walker.id not in self._previds:
+            return
+        self._write(('result', walker.id, walker.assignment, walker.end, walker.topcells))
+        self._ended.add(walker.id)
+
+
+    def recover(self, value_handler):
+        """
+        Rebuild the state saved by *checkpoint*.  *value_handler*(state,
+        walker) is called with each walker whose result was logged.
+        Returns the state dict.
+        """
+        t0 = time.time()
+        self.close()
+
+        with open(self._file('base.pkl'), 'rb') as fd:
+            saved = pickle.load(fd)
+        self._base = saved['base']
+        state      = saved['params']
+        ens        = state['system'].ensemble
+
+        with open(self._file('base.%d.npz' % self._base), 'rb') as fd:
+            arrays = np.load(fd)
+            if 'start' in arrays.files:
+                columns = dict((c, arrays[c]) for c in _COLUMNS + (_TOP,) if c in arrays.files)
+                _append(ens, columns, arrays['start'], arrays['end'])
+
+        self._snapshot(ens)
+        self._cells  = _cells(state['system'])
+        self._deltas = 0
+
+        path = self._file('journal.pkl')
+        good = 0
+        with open(path, 'rb') as fd:
+            while True:
+                try:
+                    record = pickle.load(fd)
+                except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+                    break
+                if good == 0 and record != ('base', self._base):
+                    break                                      # the journal of an older base
+                self._replay(state, record, value_handler)
+                good = fd.tell()
+
+        ### drop a partially written record
+        self._journal = open(path, 'r+b' if good else 'wb')
+        self._journal.truncate(good)
+        self._journal.seek(good)
+        if not good:
+            self._write(('base', self._base))
+        self._bytes = 0
+
+        self.recovered = time.time() - t0
+        return state
+
+    def _replay(self, state, record, value_handler):
+        kind = record[0]
+        ens  = state['system'].ensemble
+
+        if kind == 'result':
+            wid, assignment, end = record[1:4]
+            walker            = ens.walker(wid)
+            walker.end        = end
+            walker.assignment = assignment
+            walker.topcells   = record[4] if len(record) > 4 else None
+            value_handler(state, walker)
+            self._ended.add(wid)
+
+        elif kind == 'checkpoint':
+            _, params, delta = record
+            state.update(params)
+            if 'cells' in delta:
+                state['system'] = state['system'].clone(cells=delta['cells'], ensemble=ens)
+                self._cells     = delta['cells']
+
+            columns  = delta['columns']
+            wids     = columns['ids'].tolist()
+            startids = dict(zip(delta['startids'].tolist(), xrange(len(delta['startids']))))
+            endids   = dict(zip(delta['endids'  ].tolist(), xrange(len(delta['endids'  ]))))
+
+            ### look up the coordinates before any walker is replaced
+            start, end = [], []
+            for wid, parent, hasend in zip(wids, columns['parentids'].tolist(), columns['hasend'].tolist()):
+                if wid in startids:
+                    start.append(delta['start'][startids[wid]])
+                elif wid in ens:
+                    start.append(ens.walker(wid).start.copy())
+                else:
+                    start.append(ens.walker(parent).end.copy())
+
+                if wid in endids:
+                    end.append(delta['end'][endids[wid]])
+                elif hasend:
+                    end.append(ens.walker(wid).end.copy())
+                else:
+                    end.append(np.zeros_like(start[-1]))
+
+            ens.remove(delta['removed'].tolist() + [w for w in wids if w in ens])
+            if wids:
+                _append(ens, columns, np.array(start), np.array(end))
+
+            self._snapshot(ens)
+            self._deltas += 1
+
+        elif kind != 'base':
+            raise CheckpointException, 'Unknown journal record %r' % kind
+
+
+def _cells(system):
+    return dict((c.id, c) for c in system.cells)
+
+
+def _append(ens, columns, start, end):
+    ens.append(columns['ids'], columns['initids'], columns['cellids'], columns['assignments'],
+               columns['colors'], columns['weights'], start, parentids=columns['parentids'])
+    hasend = columns['hasend']
+    top    = columns.get(_TOP)
+    ens.finish(columns['ids'][hasend], columns['assignments'][hasend], end[hasend],
+               topcells = None if top is None else list(top[hasend]))
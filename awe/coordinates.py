@@ -0,0 +1,146 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+
+import numpy as np
+
+import os, tempfile
+
+
+class CoordinateStore(object):
+
+    """
+    Coordinate frames of a fixed shape in slots of a memory-mapped file.
+
+    Slots are reference counted so that a restarted walker shares the
+    frame its parent ended on instead of copying it.  Slots whose count
+    drops to zero go on a free list and are reused before the file grows.
+    The file is unlinked as soon as it is mapped, so it disappears with
+    the store; pages that are not used are left to the operating system.
+
+    Parameters:
+      *shape*     : (natoms, ndim) of a frame
+      *dtype*     : type of the coordinates
+      *capacity*  : initial number of slots
+      *directory* : where to create the file (default: CoordinateStore.directory,
+                    or the system temporary directory)
+    """
+
+    directory = None
+
+    def __init__(self, shape, dtype=float, capacity=64, directory=None):
+        self._shape    = tuple(shape)
+        self._dtype    = np.dtype(dtype)
+        self._capacity = 0
+
+        fd, path = tempfile.mkstemp(prefix='awe-coords.', dir=directory or CoordinateStore.directory)
+        self._file = os.fdopen(fd, 'w+b')
+        os.unlink(path)
+
+        self._refs = np.zeros(0, dtype=np.int32)
+        self._free = []
+        self._map  = None
+        self._grow(max(1, capacity))
+
+    shape = property(lambda self: self._shape)
+    dtype = property(lambda self: self._dtype)
+
+    @property
+    def nslots(self):
+        """
+        Number of slots in use
+        """
+        return self._capacity - len(self._free)
+
+    @property
+    def nbytes(self):
+        return self._capacity * self._framesize
+
+    @property
+    def _framesize(self):
+        return int(np.prod(self._shape)) * self._dtype.itemsize
+
+    def _grow(self, capacity):
+        """
+        Extend the file and map it again.  Frames handed out earlier stay
+        valid: they map the same file.
+        """
+        if self._map is not None:
+            self._map.flush()
+        self._file.truncate(capacity * self._framesize)
+        self._map  = np.memmap(self._file, dtype=self._dtype, mode='r+', shape=(capacity,) + self._shape)
+
+        refs = np.zeros(capacity, dtype=np.int32)
+        refs[:self._capacity] = self._refs
+        self._refs = refs
+        self._free.extend(xrange(capacity - 1, self._capacity - 1, -1))
+        self._capacity = capacity
+
+    def alloc(self, n):
+        """
+        Reserve *n* slots with a reference count of one
+        """
+        if n > len(self._free):
+            self._grow(max(self._capacity + n - len(self._free), 2 * self._capacity))
+        slots = np.array(self._free[-n:][::-1] if n else [], dtype=int)
+        del self._free[len(self._free) - n:]
+        self._refs[slots] = 1
+        return slots
+
+    def incref(self, slots):
+        slots = np.asarray(slots, dtype=int)
+        np.add.at(self._refs, slots[slots >= 0], 1)
+
+    def decref(self, slots):
+        """
+        Release the *slots*, negative ones are ignored
+        """
+        slots = np.asarray(slots, dtype=int)
+        slots = slots[slots >= 0]
+        if len(slots) == 0: return
+        np.subtract.at(self._refs, slots, 1)
+        assert (self._refs[slots] >= 0).all(), 'Released a free coordinate slot'
+        freed = np.unique(slots[self._refs[slots] == 0])
+        self._free.extend(freed.tolist())
+
+    def refcount(self, slot):
+        return int(self._refs[slot])
+
+    def store(self, coords):
+        """
+        Copy a block of frames into new slots.  Returns the slots.
+        """
+        coords = np.asarray(coords)
+        slots  = self.alloc(len(coords))
+        if len(slots):
+            self._map[slots] = coords
+        return slots
+
+    def gather(self, slots):
+        """
+        Copy the frames at *slots* into a new array, zeros where a slot is negative
+        """
+        slots = np.asarray(slots, dtype=int)
+        out   = np.zeros((len(slots),) + self._shape, dtype=self._dtype)
+        valid = slots >= 0
+        if valid.any():
+            out[valid] = self._map[slots[valid]]
+        return out
+
+    def __getitem__(self, slot):
+        """
+        The frame at *slot*, as a view into the file
+        """
+        return self._map[slot]
+
+    def __setitem__(self, slot, coords):
+        self._map[slot] = coords
+
+    def close(self):
+        self._map  = None
+        self._file.close()
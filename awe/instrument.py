@@ -0,0 +1,234 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+Opt-in profiling of the stages of the master.
+
+A stage is marked with a span, as a context manager or a decorator:
+
+    with instrument.span('pdb render'):
+        ...
+
+    @instrument.instrumented('marshal_to_task')
+    def marshal_to_task(self, walkers, task):
+        ...
+
+Spans are disabled by default: *span* then checks a flag and returns a
+shared no-op context manager, and an instrumented function calls the
+original one.  Once enabled with *enable*, each span records its start
+and duration in the process that enabled it (forked decoders and
+resamplers do not record).  *iteration* closes an iteration: it prints
+the inclusive and exclusive time of each stage, appends the folded
+stacks of the iteration (flamegraph.pl, speedscope) to *folded*, and its
+spans as Chrome trace events (chrome://tracing, Perfetto) to *trace*.
+"""
+
+import atexit
+import functools
+import json
+import os
+import thread
+import threading
+import time as systime
+from collections import defaultdict
+
+
+_ENABLED  = False
+_RECORDER = None
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ('recorder', 'name', 'args', 'start', 'child')
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name     = name
+        self.args     = args
+
+    def __enter__(self):
+        self.child = 0.
+        self.recorder.stack().append(self)
+        self.start = systime.time()
+        return self
+
+    def __exit__(self, *exc):
+        end      = systime.time()
+        stack    = self.recorder.stack()
+        duration = end - self.start
+        path     = ';'.join(s.name for s in stack)
+        stack.pop()
+        if stack:
+            stack[-1].child += duration
+        self.recorder.record(self, path, duration)
+        return False
+
+
+class _Recorder(object):
+
+    def __init__(self, trace, folded, verbose):
+        self.trace   = trace
+        self.folded  = folded
+        self.verbose = verbose
+        self.pid     = os.getpid()
+        self.t0      = systime.time()
+
+        self._local  = threading.local()
+        self._lock   = threading.Lock()
+        self._reset()
+
+        self._tracefd = None
+        self._nevents = 0
+        if trace:
+            self._makedirs(trace)
+            self._tracefd = open(trace, 'w')
+            self._tracefd.write('[\n')
+
+    def _reset(self):
+        self._events    = list()               # (name, start, duration, thread, args)
+        self._inclusive = defaultdict(float)   # name -> seconds
+        self._exclusive = defaultdict(float)   # name -> seconds
+        self._calls     = defaultdict(int)     # name -> number of spans
+        self._stacks    = defaultdict(float)   # folded stack -> exclusive seconds
+        self._since     = systime.time()
+
+    def _makedirs(self, path):
+        prefix = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(prefix):
+            os.makedirs(prefix)
+
+    def stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = list()
+            return self._local.stack
+
+    def record(self, span, path, duration):
+        exclusive = duration - span.child
+        with self._lock:
+            self._events.append((span.name, span.start, duration, thread.get_ident(), span.args))
+            self._inclusive[span.name] += duration
+            self._exclusive[span.name] += exclusive
+            self._calls[span.name]     += 1
+            self._stacks[path]         += exclusive
+
+    def flush(self, label):
+        with self._lock:
+            events, inclusive, exclusive, calls, stacks = \
+                self._events, self._inclusive, self._exclusive, self._calls, self._stacks
+            wall = systime.time() - self._since
+            self._reset()
+
+        if self.verbose and calls:
+            print 'Profile of %s: %.3f s' % (label, wall)
+            print '\t%-24s %10s %10s %8s %8s' % ('stage', 'total (s)', 'self (s)', 'self %', 'calls')
+            for name in sorted(exclusive, key=exclusive.get, reverse=True):
+                print '\t%-24s %10.4f %10.4f %8.2f %8d' % \
+                    (name, inclusive[name], exclusive[name], 100 * exclusive[name] / max(wall, 1e-9), calls[name])
+
+        if self.folded and stacks:
+            self._makedirs(self.folded)
+            with open(self.folded, 'a') as fd:
+                for path, seconds in sorted(stacks.iteritems()):
+                    fd.write('%s;%s %d\n' % (label, path, int(round(1e6 * seconds))))
+
+        if self._tracefd is not None:
+            for name, start, duration, tid, args in events:
+                event = dict(name=name, cat='awe', ph='X', pid=self.pid, tid=tid,
+                             ts=1e6 * (start - self.t0), dur=1e6 * duration,
+                             args=dict(args or {}, iteration=label))
+                self._write_event(event)
+            self._write_event(dict(name=label, cat='awe', ph='i', s='g', pid=self.pid,
+                                   tid=thread.get_ident(), ts=1e6 * (systime.time() - self.t0)))
+            self._tracefd.flush()
+
+    def _write_event(self, event):
+        ### the JSON array format: a viewer accepts the file before it is closed
+        if self._nevents > 0:
+            self._tracefd.write(',\n')
+        self._tracefd.write(json.dumps(event))
+        self._nevents += 1
+
+    def close(self):
+        self.flush('end')
+        if self._tracefd is not None:
+            self._tracefd.write('\n]\n')
+            self._tracefd.close()
+            self._tracefd = None
+
+
+def enable(trace='debug/trace.json', folded='debug/profile.folded', verbose=True):
+    """
+    Start recording the spans.  *trace* and *folded* may be None to not
+    write the trace events or the folded stacks, and *verbose* False to
+    not print the summary of each iteration.
+    """
+    global _ENABLED, _RECORDER
+    disable()
+    _RECORDER = _Recorder(trace, folded, verbose)
+    _ENABLED  = True
+
+def disable():
+    """
+    Stop recording, writing the spans since the last iteration
+    """
+    global _ENABLED, _RECORDER
+    _ENABLED = False
+    if _RECORDER is not None and _RECORDER.pid == os.getpid():
+        _RECORDER.close()
+    _RECORDER = None
+
+atexit.register(disable)
+
+def enabled():
+    return _ENABLED and _RECORDER.pid == os.getpid()
+
+
+def span(name, **args):
+    """
+    Context manager timing the stage *name*, *args* are added to its trace event
+    """
+    if not _ENABLED or _RECORDER.pid != os.getpid():
+        return _NULL
+    return _Span(_RECORDER, name, args)
+
+def instrumented(name=None):
+    """
+    Decorator timing each call of a function as the stage *name*, by
+    default the name of the function
+    """
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kws):
+            if not _ENABLED or _RECORDER.pid != os.getpid():
+                return fn(*args, **kws)
+            with _Span(_RECORDER, label, None):
+                return fn(*args, **kws)
+
+        return wrapped
+    return decorator
+
+def iteration(n):
+    """
+    Close iteration *n*: summarize and write the spans recorded since the
+    previous one
+    """
+    if _ENABLED and _RECORDER.pid == os.getpid():
+        _RECORDER.flush('iteration %s' % n)
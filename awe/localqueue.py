@@ -0,0 +1,368 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+An in-process stand-in for a Work Queue master.
+
+Tasks are run by a pool of threads on the local machine, each in its
+own sandbox directory, following the work_queue.WorkQueue and
+work_queue.Task API used by awe.workqueue.  Synthetic latency and
+failure injection allow benchmarking the driver loop, task restarts,
+and task duplication on a single machine without cctools.
+"""
+
+import os, platform, random, shutil, subprocess, tempfile, threading, time
+import Queue
+
+
+### values of Task.result
+RESULT_SUCCESS        = 0
+RESULT_INPUT_MISSING  = 1
+RESULT_OUTPUT_MISSING = 2
+RESULT_WORKER_FAILURE = 16   # injected failure: the worker was lost
+
+
+def _microseconds():
+    return int(time.time() * 10**6)
+
+def _expand(path):
+    """
+    Expand the $OS and $ARCH variables the way Work Queue does
+    """
+    return path.replace('$OS', platform.system()).replace('$ARCH', platform.machine())
+
+
+class Task(object):
+
+    """
+    A task for the LocalQueue, mimicking work_queue.Task
+    """
+
+    def __init__(self, command):
+        self.command       = command
+        self.tag           = None
+        self.taskid        = None
+        self.host          = None
+        self.output        = ''
+        self.result        = RESULT_SUCCESS
+        self.return_status = None
+
+        ### times are in microseconds, as in Work Queue
+        self.submit_time           = 0
+        self.finish_time           = 0
+        self.send_input_start      = 0
+        self.send_input_finish     = 0
+        self.receive_output_start  = 0
+        self.receive_output_finish = 0
+        self.cmd_execution_time    = 0
+        self.total_transfer_time   = 0
+        self.total_bytes_transferred = 0
+
+        self._inputs    = []     # (path or None, data or None, remote name, cached)
+        self._outputs   = []     # (local path, remote name)
+        self._process   = None
+        self._cancelled = False
+        self._avoid     = frozenset()   # hosts not to run on
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+    def specify_file(self, local_name, remote_name=None, type=None, cache=True):
+        self._inputs.append((local_name, None, remote_name or os.path.basename(local_name), cache))
+
+    def specify_buffer(self, buffer, remote_name, cache=True):
+        self._inputs.append((None, buffer, remote_name, cache))
+
+    def specify_output_file(self, local_name, remote_name=None, cache=False):
+        self._outputs.append((local_name, remote_name or os.path.basename(local_name)))
+
+    def specify_input_file(self, local_name, remote_name=None, cache=True):
+        self.specify_file(local_name, remote_name=remote_name, cache=cache)
+
+
+class Stats(object):
+
+    """
+    The subset of work_queue stats reported by the LocalQueue
+    """
+
+    def __init__(self, workers):
+        self.workers_ready          = workers
+        self.workers_busy           = 0
+        self.tasks_waiting          = 0
+        self.tasks_running          = 0
+        self.tasks_complete         = 0
+        self.total_tasks_dispatched = 0
+        self.total_tasks_complete   = 0
+        self.total_tasks_cancelled  = 0
+        self.total_tasks_failed     = 0
+        self.total_workers_joined   = workers
+        self.total_workers_removed  = 0
+        self.total_bytes_sent       = 0
+        self.total_bytes_received   = 0
+        self.total_send_time        = 0
+        self.total_receive_time     = 0
+
+    def __str__(self):
+        return ' '.join('%s=%s' % kv for kv in sorted(self.__dict__.iteritems()))
+
+
+class LocalQueue(object):
+
+    """
+    Run tasks on *workers* local threads.  Implements awe.workqueue.IBackend.
+
+    Parameters:
+      *workers*      : number of tasks to run concurrently
+      *latency*      : mean of the exponentially distributed delay (in seconds)
+                       added before each task starts, emulating dispatch
+                       and file transfer
+      *failure_rate* : probability that a task fails as if its worker was lost
+      *sandbox*      : directory under which task sandboxes are created
+      *seed*         : seed for the latency and failure random streams
+    """
+
+    def __init__(self, workers=1, latency=0., failure_rate=0., sandbox=None, seed=None):
+        self.workers      = workers
+        self.latency      = latency
+        self.failure_rate = failure_rate
+        self.sandbox      = sandbox or tempfile.mkdtemp(prefix='awe-local.')
+        self.name         = 'local'
+        self.port         = 0
+
+        self._cachedir    = os.path.join(self.sandbox, 'cache')
+
+        if not os.path.exists(self._cachedir):
+            os.makedirs(self._cachedir)
+
+        self._random   = random.Random(seed)
+        self._lock     = threading.Lock()
+        self._ready    = Queue.Queue()
+        self._done     = Queue.Queue()
+        self._tasks    = dict()            # taskid -> submitted task not yet returned
+        self._taskids  = 0
+        self._stats    = Stats(workers)
+        self._logfile  = None
+
+        self._threads  = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._work, args=('local-%d' % i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def specify_log(self, path):
+        self._logfile = path
+        with open(path, 'a') as fd:
+            fd.write('# timestamp %s\n' % ' '.join(sorted(self._stats.__dict__.iterkeys())))
+
+    def _log_stats(self):
+        if self._logfile is None: return
+        with open(self._logfile, 'a') as fd:
+            values = [v for _, v in sorted(self._stats.__dict__.iteritems())]
+            fd.write('%d %s\n' % (_microseconds(), ' '.join(map(str, values))))
+
+    def new_task(self, command):
+        return Task(command)
+
+    def empty(self):
+        with self._lock:
+            return len(self._tasks) == 0
+
+    def submit(self, task):
+        with self._lock:
+            self._taskids += 1
+            task.taskid        = self._taskids
+            task.submit_time   = _microseconds()
+            task.result        = RESULT_SUCCESS
+            task.return_status = None
+            task.output        = ''
+            task._cancelled    = False
+            task.send_input_start = 0
+            self._tasks[task.taskid] = task
+            self._stats.tasks_waiting += 1
+        self._ready.put(task)
+        return task.taskid
+
+    def wait(self, timeout=5):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                task = self._done.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                return None
+
+            with self._lock:
+                self._stats.tasks_complete -= 1
+                if task._cancelled: continue
+                self._tasks.pop(task.taskid, None)
+
+            self._log_stats()
+            return task
+
+    def cancel_by_tasktag(self, tag):
+        """
+        Cancel one task with *tag* that has not been returned by *wait*.
+        Returns the cancelled task or None.
+        """
+        with self._lock:
+            for task in self._tasks.itervalues():
+                if task.tag == tag and not task._cancelled:
+                    task._cancelled = True
+                    if task._process is not None:
+                        try:
+                            task._process.kill()
+                        except OSError:
+                            pass
+                    self._stats.total_tasks_cancelled += 1
+                    del self._tasks[task.taskid]
+                    return task
+        return None
+
+    def clear(self, running=None):
+        """
+        Completed tasks are not retained, so there is nothing to release
+        """
+        pass
+
+    def invalidate_cache_file(self, name):
+        path = os.path.join(self._cachedir, name)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def avoid_hosts(self, task, hosts):
+        task._avoid = frozenset(hosts)
+
+
+    def _work(self, host):
+        while True:
+            task = self._ready.get()
+
+            ### leave it to another worker, unless all of them are avoided
+            if host in task._avoid and len(task._avoid) < self.workers and not task._cancelled:
+                self._ready.put(task)
+                time.sleep(0.01)
+                continue
+
+            with self._lock:
+                self._stats.tasks_waiting -= 1
+                if task._cancelled: continue
+                self._stats.tasks_running += 1
+                self._stats.workers_ready -= 1
+                self._stats.workers_busy  += 1
+                self._stats.total_tasks_dispatched += 1
+                delay = self._random.expovariate(1. / self.latency) if self.latency > 0 else 0.
+                fail  = self._random.random() < self.failure_rate
+
+            task.host = host
+            try:
+                self._run(task, delay, fail)
+            except Exception, ex:
+                task.result = RESULT_INPUT_MISSING
+                task.output = '%s%s: %s\n' % (task.output, ex.__class__.__name__, ex)
+            task.finish_time = _microseconds()
+
+            with self._lock:
+                self._stats.tasks_running -= 1
+                self._stats.workers_ready += 1
+                self._stats.workers_busy  -= 1
+                if task._cancelled: continue
+                self._stats.total_tasks_complete += 1
+                self._stats.tasks_complete += 1
+                if task.result != RESULT_SUCCESS:
+                    self._stats.total_tasks_failed += 1
+
+            self._done.put(task)
+
+    def _run(self, task, delay, fail):
+        sandbox = tempfile.mkdtemp(prefix='task.', dir=self.sandbox)
+        try:
+            task.send_input_start = _microseconds()
+            time.sleep(delay)
+            sent = self._stage_inputs(task, sandbox)
+            task.send_input_finish = _microseconds()
+
+            if task._cancelled: return
+
+            start = _microseconds()
+            task._process = subprocess.Popen(task.command, shell=True, cwd=sandbox,
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            task.output        = task._process.communicate()[0]
+            task.return_status = task._process.returncode
+            task._process      = None
+            task.cmd_execution_time = _microseconds() - start
+
+            if fail:
+                task.result = RESULT_WORKER_FAILURE
+                return
+
+            task.receive_output_start = _microseconds()
+            received = self._fetch_outputs(task, sandbox)
+            task.receive_output_finish = _microseconds()
+
+            task.total_bytes_transferred = sent + received
+            task.total_transfer_time     = (task.send_input_finish    - task.send_input_start) + \
+                                           (task.receive_output_finish - task.receive_output_start)
+            with self._lock:
+                self._stats.total_bytes_sent     += sent
+                self._stats.total_bytes_received += received
+                self._stats.total_send_time      += task.send_input_finish - task.send_input_start
+                self._stats.total_receive_time   += task.receive_output_finish - task.receive_output_start
+        finally:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+    def _stage_inputs(self, task, sandbox):
+        """
+        Files are linked into the sandbox, buffers are written to it.
+        Cached buffers are written once to a cache shared by the workers
+        and linked, as Work Queue keeps them on a worker.
+        Returns the number of bytes staged.
+        """
+        nbytes = 0
+        for path, data, remote, cached in task._inputs:
+            target = os.path.join(sandbox, remote)
+            if os.path.lexists(target): continue
+            parent = os.path.dirname(target)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            if path is not None:
+                path = os.path.abspath(_expand(path))
+                if not os.path.exists(path):
+                    raise IOError, 'Cannot find input file %s' % path
+                os.symlink(path, target)
+                if os.path.isfile(path):
+                    nbytes += os.path.getsize(path)
+            elif cached:
+                path = os.path.join(self._cachedir, remote)
+                if not os.path.exists(path):
+                    fd, tmp = tempfile.mkstemp(dir=self._cachedir)
+                    with os.fdopen(fd, 'wb') as fd:
+                        fd.write(data)
+                    os.rename(tmp, path)
+                    nbytes += len(data)
+                os.symlink(path, target)
+            else:
+                with open(target, 'wb') as fd:
+                    fd.write(data)
+                nbytes += len(data)
+        return nbytes
+
+    def _fetch_outputs(self, task, sandbox):
+        nbytes = 0
+        for local, remote in task._outputs:
+            source = os.path.join(sandbox, remote)
+            if not os.path.exists(source):
+                task.result = RESULT_OUTPUT_MISSING
+                continue
+            nbytes += os.path.getsize(source)
+            shutil.move(source, local)
+        return nbytes
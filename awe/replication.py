@@ -0,0 +1,106 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+Policies choosing which outstanding task to replicate when workers are idle.
+"""
+
+import heapq, time
+
+
+class IReplicationPolicy(object):
+
+    """
+    Interface used by awe.workqueue.WorkQueue.  *select* returns the tag
+    of the task to replicate next, or None.
+    """
+
+    def submitted(self, tag):
+        """
+        A task with *tag* was submitted, either the original or a replica
+        """
+        pass
+
+    def discard(self, tag):
+        """
+        The tasks with *tag* are done
+        """
+        pass
+
+    def select(self, wq):
+        """
+        *wq* is the awe.workqueue.WorkQueue
+        """
+        raise NotImplementedError
+
+
+class LeastReplicated(IReplicationPolicy):
+
+    """
+    A random task among the least replicated ones
+    """
+
+    def select(self, wq):
+        return wq.tagset.select()
+
+
+class Straggler(IReplicationPolicy):
+
+    """
+    Replicate the tasks that have been running for longer than the
+    *quantile* of the execution times of the completed tasks, the
+    longest running first, then fall back to *LeastReplicated*.
+
+    The running time of a tag is counted from the dispatch of its latest
+    replica, so a replicated task is only replicated again once that
+    replica is itself late.  Tasks are assumed to be dispatched in the
+    order they are submitted: the oldest outstanding submission is
+    checked first and the search stops at the first one that is not late.
+
+    Parameters:
+      *quantile*   : in [0, 1]
+      *minsamples* : number of completed tasks needed before a task can be late
+    """
+
+    def __init__(self, quantile=0.9, minsamples=10):
+        assert 0 <= quantile <= 1
+        self.quantile   = quantile
+        self.minsamples = minsamples
+
+        self._heap     = []        # (submission time, tag)
+        self._latest   = dict()    # tag -> time of its latest submission
+        self._fallback = LeastReplicated()
+
+    def submitted(self, tag):
+        t = time.time()
+        self._latest[tag] = t
+        heapq.heappush(self._heap, (t, tag))
+
+    def discard(self, tag):
+        self._latest.pop(tag, None)
+
+    def _late(self, wq, threshold):
+        now  = time.time()
+        heap = self._heap
+        while heap:
+            t, tag = heap[0]
+            if self._latest.get(tag) != t or tag not in wq.tagset or wq.tagset.count(tag) >= wq.tagset.maxreps:
+                heapq.heappop(heap)
+                continue
+            started = wq.started(tag)
+            if started is None or now - started < threshold:
+                return None
+            return tag
+        return None
+
+    def select(self, wq):
+        if len(wq.stats.execution_times) >= self.minsamples:
+            tag = self._late(wq, wq.stats.execution_quantile(self.quantile))
+            if tag is not None:
+                return tag
+        return self._fallback.select(wq)
@@ -9,9 +9,11 @@ See the file COPYING for details.
 
 from util import typecheck, returns, makedirs_parent
 import aweclasses
+import instrument
 
 import numpy as np
 import itertools
+import multiprocessing
 import time, os
 import textwrap
 
@@ -35,6 +37,27 @@ class IResampler(object):
 
         raise NotImplementedError
 
+    def resample_cell(self, system):
+        """
+        Resample the walkers of a single cell as soon as they are
+        available, for pipelined iterations.  Bookkeeping that spans the
+        whole system is deferred to *end_iteration*.
+
+        Parameters:
+          *system* : an awe.aweclasses.System with the walkers of one cell
+
+        Returns:
+          a new awe.aweclasses.System instance
+        """
+        return self.resample(system)
+
+    def end_iteration(self, system):
+        """
+        Called at the iteration boundaries of pipelined iterations
+        with the current *system*
+        """
+        pass
+
     @typecheck(aweclasses.System)
     @returns(aweclasses.System)
     def __call__(self, s1):
@@ -163,6 +186,159 @@ class OneColor(IResampler):
 
         return newsystem
 
+def split_merge(weights, starts, counts, targetwalkers, rng):
+    """
+    Vectorized split/merge of walkers grouped into segments (e.g. cells).
+
+    This follows the OneColor algorithm for every segment at once:
+    walkers are visited in increasing weight, merged until the
+    accumulated weight reaches the target weight *tw* = W / targetwalkers,
+    then split into floor(accumulated / tw) copies, the remainder being
+    carried on.  A merged walker survives with probability proportional
+    to its weight, as in the sequential pairwise merge rule.
+
+    Parameters:
+      *weights*       : the walker weights, ordered by segment
+      *starts*        : offset of each segment in *weights*
+      *counts*        : length of each (non-empty) segment
+      *targetwalkers* : number of walkers to leave in each segment
+      *rng*           : a numpy.random.RandomState
+
+    Returns:
+      (parents, newweights): the index into *weights* of the parent of
+      each new walker, and the weight of the new walkers
+    """
+
+    weights = np.asarray(weights, dtype=float)
+    starts  = np.asarray(starts, dtype=int)
+    counts  = np.asarray(counts, dtype=int)
+    if len(weights) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+
+    segment = np.repeat(np.arange(len(starts)), counts)
+    last    = starts + counts - 1
+
+    ### visit each segment in increasing weight
+    order   = np.lexsort((weights, segment))
+    w       = weights[order]
+
+    ### cumulative weight within each segment
+    cs      = np.cumsum(w)
+    offset  = cs[starts] - w[starts]
+    S       = cs - offset[segment]
+    W       = S[last]
+    assert (W > 0).all(), 'Cannot resample segments without weight'
+    tw      = W / targetwalkers
+
+    ### number of walkers emitted once the walker at each position is consumed
+    E       = np.floor(S / tw[segment] + 1e-9).astype(int)
+    E[last] = np.maximum(E[last], np.where(counts > 1, E[last - 1], 0) + 1)
+    E       = np.minimum(E, targetwalkers)
+    Eprev   = np.zeros_like(E)
+    Eprev[1:] = E[:-1]
+    Eprev[starts] = 0
+    copies  = E - Eprev
+
+    ### a carrier is chosen for each split event among the walkers merged
+    ##+ since the previous event, and the remainder of the previous carrier
+    events  = np.where(copies > 0)[0]
+    evseg   = segment[events]
+    base    = tw[evseg] * Eprev[events]
+    acc     = S[events] - base
+    target  = base + rng.random_sample(len(events)) * acc
+    pick    = np.searchsorted(cs, target + offset[evseg], side='right')
+    pick    = np.minimum(np.maximum(pick, starts[evseg]), events)
+
+    previous = np.zeros(len(events), dtype=int) - 1
+    previous[1:] = events[:-1]
+    previous[np.r_[True, evseg[1:] != evseg[:-1]]] = -1
+    own     = pick > previous
+
+    ### resolve carriers that are the previous carrier
+    fill    = np.maximum.accumulate(np.where(own, np.arange(len(events)), 0))
+    carrier = pick[fill]
+
+    parents    = np.repeat(order[carrier], copies[events])
+    newweights = np.repeat(tw[evseg], copies[events])
+    return parents, newweights
+
+
+def _split_merge_block(args):
+    weights, starts, counts, targetwalkers, seed = args
+    return split_merge(weights, starts, counts, targetwalkers, np.random.RandomState(seed))
+
+
+def parallel_split_merge(weights, starts, counts, targetwalkers, rng, pool, blocksize=1024):
+    """
+    Run split_merge over blocks of *blocksize* segments on a
+    multiprocessing *pool*.
+
+    Each block gets its own random stream seeded from one draw of *rng*
+    and the block number, so the result only depends on *rng* and
+    *blocksize*, not on the number of processes.
+    """
+
+    if len(starts) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+
+    seed   = rng.randint(2**31 - 1)
+    firsts = np.arange(0, len(starts), blocksize)
+    jobs   = []
+    for block, i in enumerate(firsts):
+        s  = starts[i:i+blocksize]
+        c  = counts[i:i+blocksize]
+        lo = s[0]
+        hi = s[-1] + c[-1]
+        jobs.append((weights[lo:hi], s - lo, c, targetwalkers, [seed, block]))
+
+    results    = pool.map(_split_merge_block, jobs)
+    parents    = np.concatenate([p + starts[i] for (p, _), i in zip(results, firsts)])
+    newweights = np.concatenate([w for _, w in results])
+    return parents, newweights
+
+
+def batch_resample(system, columns, targetwalkers, rng, histfile, pool=None, blocksize=1024):
+    """
+    Resample *system* with split_merge, grouping the walkers by the
+    given ensemble *columns*, and append the walker history to *histfile*.
+    If a *pool* is given the groups are resampled in parallel blocks.
+    """
+
+    ens = system.ensemble
+    order, starts, counts = ens.groupby(*columns)
+    weights = ens.weights[order]
+    with instrument.span('split_merge'):
+        if pool is None:
+            parents, weights = split_merge(weights, starts, counts, targetwalkers, rng)
+        else:
+            parents, weights = parallel_split_merge(weights, starts, counts, targetwalkers, rng, pool, blocksize)
+    rows   = order[parents]
+    newens = ens.restart(rows, weights)
+
+    with instrument.span('walker history'), open(histfile, 'a') as fd:
+        hist = np.column_stack((newens.initids, ens.ids[rows], newens.ids))
+        np.savetxt(fd, hist, fmt='%d', delimiter=',')
+
+    return system.clone(ensemble=newens)
+
+
+class BatchOneColor(OneColor):
+
+    """
+    Vectorized OneColor: all cells are resampled at once with split_merge.
+    The random stream is seeded with *seed* for reproducibility.
+    """
+
+    def __init__(self, targetwalkers, seed=None):
+        OneColor.__init__(self, targetwalkers)
+        self.seed = seed
+        self.rng  = np.random.RandomState(seed)
+
+    def resample(self, system):
+        print time.asctime(), 'Resampling', len(system.ensemble), 'walkers'
+        return batch_resample(system, ('assignments',), self.targetwalkers, self.rng, self.histfile)
+
+
 class MultiColor(OneColor):
 
     def __init__(self, nwalkers, partition):
@@ -170,12 +346,13 @@ class MultiColor(OneColor):
         self.partition   = partition
         ncolors          = partition.ncolors
         self.transitions = np.zeros((ncolors, ncolors))
-	self.iteration = 1
+        self.iteration = 1
+        self._pending_transitions = np.zeros((ncolors, ncolors))
 
         self.cellweights_path = os.path.join(OUTPUT_DIR, 'cell-weights.csv')
         makedirs_parent(self.cellweights_path)
-	of = open(self.cellweights_path,'a')
-	of.write('%iteration,cellid,color,total_weight \n')
+        of = open(self.cellweights_path,'a')
+        of.write('%iteration,cellid,color,total_weight \n')
         of.close()
 
         self.tmat_path = os.path.join(OUTPUT_DIR, 'color-transition-matrix.csv')
@@ -192,51 +369,84 @@ class MultiColor(OneColor):
 
     def resample(self, system):
 
-        ### update colors
+        trans     = self._update_colors(system)
+        self.transitions = np.append(self.transitions,trans,axis=0)
+        newsystem = self._resample_colors(system)
+        self._save_cell_weights(system, newsystem)
+        self.iteration += 1
+
+        self.save_transitions(self.tmat_path)
+
+        return newsystem
+
+    def resample_cell(self, system):
+        self._pending_transitions += self._update_colors(system)
+        newsystem = self._resample_colors(system)
+        self._save_cell_weights(system, newsystem)
+        return newsystem
+
+    def end_iteration(self, system):
+        self.transitions = np.append(self.transitions, self._pending_transitions, axis=0)
+        self._pending_transitions = np.zeros_like(self._pending_transitions)
+        self.iteration += 1
+
+        self.save_transitions(self.tmat_path)
+
+    @instrument.instrumented('update colors')
+    def _update_colors(self, system):
+        """
+        Recolor the walkers that entered a core.
+        Returns the weight of the color transitions
+        """
         ncolors          = self.partition.ncolors
         trans = np.zeros((ncolors,ncolors))
 
-        for w in system.walkers:
-            cell     = system.cell(w.assignment)
-            oldcolor = w.color
-            newcolor = cell.core
+        ens      = system.ensemble
+        oldcolor = ens.colors.copy()
 
-            # sanity check: all walkers must have a color, but not all cells have a core.
-            assert w.color is not None
-            assert w.color >= 0
+        # sanity check: all walkers must have a color, but not all cells have a core.
+        assert (oldcolor >= 0).all()
 
-            if not cell.core == aweclasses.DEFAULT_CORE and not w.color == cell.core:
-                oldcolor = w.color
-                newcolor = cell.core
-                print 'Updating color:', w, oldcolor, '->', newcolor
-                w.color = newcolor
-            else:
-                oldcolor = newcolor = w.color
+        cores    = system.cores(ens.assignments)
+        recolor  = (cores != aweclasses.DEFAULT_CORE) & (cores != oldcolor)
+        newcolor = np.where(recolor, cores, oldcolor)
+        if recolor.any():
+            print 'Updating color of', recolor.sum(), 'walkers'
+            ens.colors = newcolor
 
-            trans[oldcolor, newcolor] += w.weight
-        self.transitions = np.append(self.transitions,trans,axis=0)
+        np.add.at(trans, (oldcolor, newcolor), ens.weights)
+        return trans
 
-        ### resample individual colors using OneColor algorithm
-        newsystem = aweclasses.System(topology=system.topology)
+    def _resample_colors(self, system):
+        """
+        Resample individual colors using OneColor algorithm
+        """
+        newsystem = system.clone(cells=False)
         for color in system.colors:
             thiscolor  = system.filter_by_color(color)
-            print time.asctime(), 'Resampling color', color, len(thiscolor.walkers), 'walkers'
+            print time.asctime(), 'Resampling color', color, len(thiscolor.ensemble), 'walkers'
             resampled  = OneColor.resample(self, thiscolor)
             newsystem += resampled
-
-        of = open(self.cellweights_path,'a')
-        for cell in newsystem.cells:
-	    thiscell = system.filter_by_cell(cell)
-	    for color in thiscell.colors:
-	        thiscolor = thiscell.filter_by_color(color)
-		of.write(str(self.iteration)+','+str(cell.id)+','+str(color)+','+str(sum(thiscolor.weights))+'\n')
-	of.close()
-	self.iteration += 1
-
-        self.save_transitions(self.tmat_path)
-
         return newsystem
 
+    @instrument.instrumented('cell weights')
+    def _save_cell_weights(self, system, newsystem):
+        """
+        Save the total weight of each color in the cells of *newsystem*, before resampling
+        """
+        ens = system.ensemble
+        order, starts, counts = ens.groupby('assignments', 'colors')
+        cells   = ens.assignments[order[starts]]
+        colors  = ens.colors[order[starts]]
+        weights = np.add.reduceat(ens.weights[order], starts) if len(order) > 0 else np.zeros(0)
+        keep    = np.in1d(cells, [c.id for c in newsystem.cells])
+
+        rows = np.column_stack((np.repeat(self.iteration, keep.sum()), cells[keep], colors[keep]))
+        with open(self.cellweights_path, 'a') as of:
+            for row, weight in zip(rows.tolist(), weights[keep].tolist()):
+                of.write('%d,%d,%d,%s\n' % (row[0], row[1], row[2], weight))
+
+    @instrument.instrumented('color transitions')
     def save_transitions(self, path):
         print time.asctime(), 'Saving transition matrix to', repr(path)
         fd = open(path, 'w')
@@ -246,6 +456,57 @@ class MultiColor(OneColor):
         finally:
             fd.close()
 
+class BatchMultiColor(MultiColor):
+
+    """
+    Vectorized MultiColor: the cells of all colors are resampled at once
+    with split_merge.  The random stream is seeded with *seed* for
+    reproducibility.
+    """
+
+    def __init__(self, nwalkers, partition, seed=None):
+        MultiColor.__init__(self, nwalkers, partition)
+        self.seed = seed
+        self.rng  = np.random.RandomState(seed)
+
+    def _resample_colors(self, system):
+        print time.asctime(), 'Resampling', len(system.ensemble), 'walkers'
+        return batch_resample(system, ('colors', 'assignments'), self.targetwalkers, self.rng, self.histfile)
+
+
+class ParallelMultiColor(BatchMultiColor):
+
+    """
+    BatchMultiColor with the (color, cell) groups resampled in blocks of
+    *blocksize* cells on a pool of *processes* worker processes.
+    """
+
+    def __init__(self, nwalkers, partition, seed=None, processes=None, blocksize=1024):
+        BatchMultiColor.__init__(self, nwalkers, partition, seed=seed)
+        self.processes = processes
+        self.blocksize = blocksize
+        self._pool     = None
+
+    def __getstate__(self):
+        """
+        The process pool cannot be pickled, it is recreated on demand
+        """
+        odict = self.__dict__.copy()
+        odict['_pool'] = None
+        return odict
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def _resample_colors(self, system):
+        print time.asctime(), 'Resampling', len(system.ensemble), 'walkers in blocks of', self.blocksize, 'cells'
+        return batch_resample(system, ('colors', 'assignments'), self.targetwalkers, self.rng, self.histfile,
+                              pool=self.pool, blocksize=self.blocksize)
+
+
 class SuperCell(MultiColor):
     def __init__(self,nwalkers,partition,cellmapf):
         MultiColor.__init__(self,nwalkers,partition)
@@ -254,13 +515,13 @@ class SuperCell(MultiColor):
             self.cellmap.append(int(line))
 
     def resample(self,system):
-        cellmap = self.cellmap
-        for w in system.walkers:
-            w.assignment = cellmap[w.assignment]
+        cellmap = np.array(self.cellmap)
+        ens = system.ensemble
+        ens.assignments = cellmap[ens.assignments]
         newsystem = MultiColor.resample(self,system)
         tmat = os.path.join(OUTPUT_DIR, 'transition-matrix.csv')
         makedirs_parent(tmat)
-        MultiColor.save_transitions(tmat)
+        self.save_transitions(tmat)
         return newsystem
 
 class IPlotter(IResampler):
@@ -292,6 +553,7 @@ class ISaver(IResampler):
         self.datfile   = datfile
         self.iteration = 0
 
+    @instrument.instrumented('save weights')
     @typecheck(aweclasses.System, mode=str)
     def save(self, system, mode='a'):
         if self.iteration == 0:
@@ -319,6 +581,14 @@ class ISaver(IResampler):
 
         return newsystem
 
+    def resample_cell(self, system):
+        return self.resampler.resample_cell(system)
+
+    def end_iteration(self, system):
+        self.resampler.end_iteration(system)
+        self.iteration += 1
+        self.save(system, mode='a')
+
 class SaveWeights(ISaver):
 
     def __init__(self, resampler, datfile=None):
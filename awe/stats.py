@@ -13,8 +13,15 @@ from util import typecheck
 import numpy as np
 
 import time as systime
-import gzip
+import Queue
+import atexit
+import bisect
+import math
 import os
+import struct
+import threading
+import zlib
+from collections import deque
 
 
 class Timer(object):
@@ -65,6 +72,9 @@ class time:
     @staticmethod
     def time():
         global _TIMER
+        ### started by the first call
+        if not _TIMER.isrunning():
+            _TIMER.start()
         t = _TIMER.elapsed(units='s')
         return t
 
@@ -72,6 +82,8 @@ class time:
     @staticmethod
     def timer():
         global _TIMER
+        if not _TIMER.isrunning():
+            _TIMER.start()
         return _TIMER
 
 
@@ -94,15 +106,16 @@ class ExtendableArray(object):
     def get(self):
         return self._vals[:self._count]
 
-    def _realloc(self):
+    def _realloc(self, n=1):
         """
-        Reallocates space if the current size and the underlying size are equal
+        Reallocates space if the underlying size cannot hold *n* more values
         """
 
-        if self._count == len(self._vals):
+        if self._count + n > len(self._vals):
 
-            x     = len(self._vals)
-            alloc = x * self._factor
+            alloc = max(len(self._vals), 1)
+            while alloc < self._count + n:
+                alloc *= self._factor
             self._size0 = alloc
             vals2 = self._initialize()
             vals2[:self._count] = self._vals[:self._count]
@@ -111,7 +124,7 @@ class ExtendableArray(object):
 
     def append(self, *values):
 
-        self._realloc()
+        self._realloc(len(values))
         i = self._count
         j = i + len(values)
         self._vals[i:j] = np.array(values)
@@ -147,42 +160,193 @@ class ExtendableArray(object):
         return repr(self._vals[:self._count])
             
 
+class P2Quantile(object):
+
+    """
+    Running estimate of the *p* quantile in constant memory, with the P^2
+    algorithm of Jain and Chlamtac (1985): five markers whose heights are
+    moved by a piecewise-parabolic interpolation as values arrive
+    """
+
+    ### the largest step of a batch, relative to the values seen
+    fraction = 0.1
+
+    def __init__(self, p):
+        assert 0 < p < 1
+        self.p        = p
+        self._heights = list()
+        self._pos     = [0, 1, 2, 3, 4]
+        self._desired = [0, 2*p, 4*p, 2 + 2*p, 4]
+        self._incr    = [0, p/2., p, (1 + p)/2., 1]
+
+    def __len__(self):
+        return self._pos[4] + 1 if len(self._heights) == 5 else len(self._heights)
+
+    @property
+    def value(self):
+        q = self._heights
+        if len(q) == 0:
+            return float('nan')
+        if len(q) < 5:
+            return float(np.percentile(q, 100 * self.p))
+        return q[2]
+
+    def update(self, x):
+        q, n = self._heights, self._pos
+
+        if len(q) < 5:
+            bisect.insort(q, x)
+            return
+
+        ### the cell of the markers x falls in
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+
+        for i in xrange(k + 1, 5):
+            n[i] += 1
+        for i in xrange(5):
+            self._desired[i] += self._incr[i]
+
+        ### move the middle markers towards their desired positions
+        for i in xrange(1, 4):
+            d = self._desired[i] - n[i]
+            if d >= 1 and n[i+1] - n[i] > 1 or d <= -1 and n[i-1] - n[i] < -1:
+                d = 1 if d > 0 else -1
+                h = q[i] + d / float(n[i+1] - n[i-1]) * \
+                    ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / float(n[i+1] - n[i]) +
+                     (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / float(n[i] - n[i-1]))
+                if not q[i-1] < h < q[i+1]:
+                    h = q[i] + d * (q[i+d] - q[i]) / float(n[i+d] - n[i])
+                q[i]  = h
+                n[i] += d
+
+    def extend(self, values):
+        """
+        Add a batch of *values*: the markers they pass are counted for the
+        whole batch, then each middle marker takes a single parabolic step
+        of as many positions as it lags behind.  One value is a P^2 update.
+        A large batch is taken in steps of at most *fraction* of the values
+        seen so far, which the interpolation between the markers stands for.
+        """
+        x = np.asarray(values, dtype=float).ravel()
+
+        if len(self._heights) < 5:
+            k = 5 - len(self._heights)
+            for v in x[:k].tolist():
+                bisect.insort(self._heights, v)
+            x = x[k:]
+
+        while len(x) > 0:
+            k = max(1, int(self.fraction * len(self)))
+            if k == 1:
+                self.update(float(x[0]))
+            else:
+                self._step(x[:k])
+            x = x[k:]
+
+    def _step(self, x):
+        q, n = self._heights, self._pos
+
+        ### the cells of the markers the values fall in, the extremes are markers
+        q[0] = min(q[0], float(x.min()))
+        q[4] = max(q[4], float(x.max()))
+        below = np.cumsum(np.bincount(np.searchsorted(q[1:4], x, side='right'), minlength=4))
+
+        for i in xrange(1, 5):
+            n[i] += int(below[i-1])
+        for i in xrange(5):
+            self._desired[i] += len(x) * self._incr[i]
+
+        ### move the middle markers towards their desired positions, between their neighbours
+        for i in xrange(1, 4):
+            d = int(self._desired[i] - n[i])
+            d = max(min(d, n[i+1] - n[i] - 1), n[i-1] - n[i] + 1)
+            if d == 0: continue
+            h = q[i] + d / float(n[i+1] - n[i-1]) * \
+                ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / float(n[i+1] - n[i]) +
+                 (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / float(n[i] - n[i-1]))
+            if not q[i-1] < h < q[i+1]:
+                s = 1 if d > 0 else -1
+                h = q[i] + d * (q[i+s] - q[i]) / float(n[i+s] - n[i])
+            q[i]  = h
+            n[i] += d
+
+
+### quantiles tracked by default
+QUANTILES = (0.5, 0.95, 0.99)
+
 class Statistics(object):
 
     """
-    Keep track of running statistics as the program runs
+    Keep track of running statistics as the program runs: count, mean,
+    variance, extrema and the estimates of some *quantiles*, in constant
+    memory.  The values themselves are not kept.
     """
 
-    def __init__(self):
+    def __init__(self, quantiles=QUANTILES):
 
         self._num    = 0
         self._mean   = 0.
         self._m2     = 0.
+        self._min    = float('inf')
+        self._max    = float('-inf')
 
-        self._values = ExtendableArray() # keep track of the actual values for plots
+        self._quantiles = [P2Quantile(p) for p in quantiles]
 
     num  = property(lambda self: self._num)
-    mean = property(lambda self: self._mean)
-    var  = property(lambda self: self._m2 / float(self._num))
+    mean = property(lambda self: self._mean if self._num > 0 else float('nan'))
+    var  = property(lambda self: self._m2 / float(self._num) if self._num > 0 else float('nan'))
     std  = property(lambda self: math.sqrt(self.var))
-
-    @property
-    def values(self):
-        return self._values.get()
+    min  = property(lambda self: self._min)
+    max  = property(lambda self: self._max)
 
     def update(self, *values):
 
-        self._values.append(*values)
+        if not values: return
+        x = np.asarray(values, dtype=float)
+
+        ### merge the moments of the batch with the running ones (Chan et al.)
+        n     = len(x)
+        mean  = x.mean()
+        total = self._num + n
+        delta = mean - self._mean
+        self._m2   = self._m2 + ((x - mean)**2).sum() + delta**2 * self._num * n / float(total)
+        self._mean = self._mean + delta * n / float(total)
+        self._num  = total
 
-        for t in values:
-            self._num += 1
-            delta      = t - self._mean
-            self._mean = self._mean + delta / float(self._num)
-            self._m2   = self._m2 + delta * (t - self._mean)
+        self._min = min(self._min, x.min())
+        self._max = max(self._max, x.max())
 
+        for q in self._quantiles:
+            q.extend(x)
+
+    def quantile(self, p):
+        """
+        The estimate of the *p* quantile, which must be one of those tracked
+        """
+        for q in self._quantiles:
+            if q.p == p:
+                return q.value
+        raise ValueError, 'The %s quantile is not tracked: %s' % (p, [q.p for q in self._quantiles])
+
+    def summary(self):
+        """
+        dict of the aggregates, the quantiles as p50, p95, ...
+        """
+        s = dict(num=self.num, mean=self.mean, std=self.std, min=self.min, max=self.max)
+        for q in self._quantiles:
+            s['p%g' % (100 * q.p)] = q.value
+        return s
 
     def __str__(self):
-        return 'N = %s mean = %s std = %s' % (self.num, self.mean, self.std)
+        quantiles = ' '.join('p%g = %s' % (100 * q.p, q.value) for q in self._quantiles)
+        return 'N = %s mean = %s std = %s %s' % (self.num, self.mean, self.std, quantiles)
 
 
 
@@ -192,22 +356,29 @@ class WQStats(object):
     Keep track of the WQ statistics
     """
 
-    def __init__(self, logger=None):
+    ### the aggregates of the task results
+    TASK_STATISTICS = ('computation_time', 'total_transfer_time', 'turnaround_time', 'total_bytes_transferred')
 
-        self.logger = logger or StatsLogger()
+    def __init__(self, logger=None, window=1000, snapshot='debug/task_stats.npz', interval=60):
 
-        self._task_times             = ExtendableArray()  # keep track of the times values are added
-        self._wq_times               = ExtendableArray()
+        self.logger = logger or MetricsLogger()
 
         ### task stats
         self.computation_time        = Statistics()
         self.total_bytes_transferred = Statistics()
         self.total_transfer_time     = Statistics()
-        self.task_life_time          = Statistics()       # WQ Task.finish_time - Task.submit_time
+        self.turnaround_time         = Statistics()       # WQ Task.finish_time - Task.submit_time
+
+        ### execution times in seconds of the latest successful tasks, for the replication policy
+        self.execution_times         = deque(maxlen=window)
 
+        ### the aggregates are saved to *snapshot* every *interval* seconds
+        self.snapshot                = snapshot
+        self.interval                = interval
+        self._saved                  = systime.time()
 
 
-    @typecheck(workqueue.WQ.Task)
+    @typecheck(workqueue.TASK_TYPES)
     def task(self, task):
         """
         Update the running statistics with a task result
@@ -246,46 +417,82 @@ class WQStats(object):
         self.logger.update (t, component, 'total_transfer_time',
                             task.total_transfer_time                                  / 10.**6)
 
-        self.logger.update (t, component, 'turnaround_time'    ,
-                            (task.finish_time           - task.submit_time          ) / 10.**6)
+        turnaround = (task.finish_time - task.submit_time) / 10.**6
+        self.logger.update (t, component, 'turnaround_time'    , turnaround)
 
+        self.computation_time.update(comp_time / 10.**6)
+        self.total_transfer_time.update(task.total_transfer_time / 10.**6)
+        self.turnaround_time.update(turnaround)
+        self.total_bytes_transferred.update(task.total_bytes_transferred)
 
+        if task.result == 0 and task.return_status == 0:
+            self.execution_times.append(comp_time / 10.**6)
 
-    def save(self, wqstats, taskstats):
+        if self.snapshot and t - self._saved >= self.interval:
+            self.save()
+
+    def execution_quantile(self, q):
         """
-        @param wqstats: path to save the wq stats to
-        @param taskstats: path to save the task stats to
+        The *q* quantile of the recent execution times, in seconds
         """
+        return np.percentile(self.execution_times, 100 * q)
 
-        with open(wqstats, 'w') as fd:
-            self._save_wq_stats(fd)
 
-        with open(taskstats, 'w') as fd:
-            self._save_task_stats(fd)
 
+    def staging(self, unique, shared):
+        """
+        Log the bytes of the content-addressed task inputs: *unique* were
+        new, *shared* were identical to an input of another outstanding
+        task and are not sent again to a worker that has them
+        """
+        t = systime.time()
+        self.logger.update(t, 'STAGING', 'unique bytes', unique)
+        self.logger.update(t, 'STAGING', 'shared bytes', shared)
 
-    def _save_attrs(self, fd, name, times, attrs):
-        print 'Saving', name, 'data to', fd.name
-        data = dict()
-        data['time'] = times
-        print '\t', 'time'
-        for a in attrs:
-            print '\t', a
-            data[a] = getattr(self, a).values
-        np.savez(fd, **data)
+    def ingest(self, stage, count, elapsed):
+        """
+        Log the throughput of a stage of result ingestion
+        (receive, decode, apply) over *count* results in *elapsed* seconds
+        """
+        t = systime.time()
+        self.logger.update(t, 'INGEST', '%s count' % stage, count)
+        self.logger.update(t, 'INGEST', '%s time'  % stage, elapsed)
+        if elapsed > 0:
+            self.logger.update(t, 'INGEST', '%s throughput' % stage, count / elapsed)
 
-    def _save_task_stats(self, fd):
-        attrs = 'computation_time total_bytes_transferred total_transfer_time task_life_time'.split()
 
-        self._save_attrs(fd, 'task', self._task_times.get(), attrs)
+    def summary(self):
+        """
+        The aggregates of each task statistic, as dicts of
+        num, mean, std, min, max, p50, p95, p99
+        """
+        return dict((name, getattr(self, name).summary()) for name in self.TASK_STATISTICS)
+
+    def save(self, path=None):
+        """
+        Save a snapshot of the task statistics to the .npz file at *path*,
+        by default *snapshot*.  It has the time it was taken and the
+        aggregates of each statistic as <statistic>_<aggregate>, for
+        instance turnaround_time_p95.  The value of each task is in the
+        metrics log.
+        """
+
+        path = path or self.snapshot
+        prefix = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(prefix):
+            os.makedirs(prefix)
 
-    def _save_wq_stats(self, fd):
-        attrs =  'workers_ready workers_busy tasks_running tasks_waiting tasks_complete'.split()
-        attrs += 'total_tasks_dispatched total_tasks_complete total_workers_joined'.split()
-        attrs += 'total_workers_removed total_bytes_sent total_bytes_received'.split()
-        attrs += 'total_send_time total_receive_time'.split()
+        data = dict(time = systime.time())
+        for name in self.TASK_STATISTICS:
+            for key, value in getattr(self, name).summary().iteritems():
+                data['%s_%s' % (name, key)] = value
 
-        self._save_attrs(fd, 'wq', self._wq_times.get(), attrs)
+        ### readers of a live run never see a partial snapshot
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fd:
+            np.savez(fd, **data)
+        os.rename(tmp, path)
+        self._saved = systime.time()
 
 
 
@@ -293,19 +500,17 @@ class Timings(object):
 
     def __init__(self):
         self.timer = Timer()
-        self.times = ExtendableArray()
         self.stats = Statistics()
 
     @property
     def data(self):
-        return self.times.get(), self.stats.values
+        return self.stats.summary()
 
     def start(self):
         self.timer.start()
 
     def stop(self):
         self.timer.stop()
-        self.times.append(systime.time())
         self.stats.update(self.timer.elapsed())
 
 
@@ -318,7 +523,7 @@ class AWEStats(object):
         self.resample  = Timer()
         self.barrier   = Timer()
 
-        self.logger    = logger or StatsLogger()
+        self.logger    = logger or MetricsLogger()
 
     @typecheck(str, Timings)
     def _timeit(self, state, timings, name):
@@ -345,6 +550,24 @@ class AWEStats(object):
     def time_barrier(self, state):
         self._timeit(state, self.barrier, 'barrier time')
 
+    def cell_barrier(self, elapsed):
+        """
+        Log how long the walkers of a cell waited for the last one to
+        return before the cell was resampled (pipelined iterations)
+        """
+        self.logger.update(systime.time(), 'AWE', 'cell barrier time', elapsed)
+
+    def checkpoint(self, nbytes, elapsed):
+        """
+        Log the size and duration of a checkpoint
+        """
+        t = systime.time()
+        self.logger.update(t, 'AWE', 'checkpoint bytes', nbytes)
+        self.logger.update(t, 'AWE', 'checkpoint time' , elapsed)
+
+    def recover(self, elapsed):
+        self.logger.update(systime.time(), 'AWE', 'recovery time', elapsed)
+
     def close(self):
         self.logger.close()
 
@@ -352,36 +575,288 @@ class AWEStats(object):
         self.logger.open()
 
 
-class StatsLogger (object):
+METRICS_MAGIC = 'AWEMET01'
+METRICS_CHUNK = struct.Struct('<4sIIIII')   # "CHNK", nrecords, nmetrics, nstrings, nbytes, crc32
+
 
-    def __init__(self, path='debug/stats.log.gz', buffersize=9):
+class MetricsLogger (object):
+
+    """
+    Binary, columnar log of timestamped metrics.
+
+    A metric is a (component, name) pair.  Each update appends a (time,
+    metric, value) record to NumPy columns in memory; full buffers, and
+    buffers older than *interval* seconds, are handed to a background
+    thread that compresses them and appends them to the file as a chunk.
+    Nothing is formatted or compressed on the caller's thread.
+
+    The values of a metric are floats, or strings if its first value
+    other than None was one.  The strings are kept in a table of the chunk
+    and the value of the record is their index in it.  None is recorded
+    as NaN in either case, and read back as NaN or None.
+
+    File format (little endian):
+        magic "AWEMET01"
+        chunks of
+            header  METRICS_CHUNK: "CHNK", nrecords, nmetrics, nstrings, nbytes, crc32
+            nbytes  zlib compressed:
+                float64 times   [nrecords]
+                uint32  metrics [nrecords]   index in the metrics of the chunk
+                float64 values  [nrecords]
+                uint8   isstring[nmetrics]
+                uint32  length of each metric name and string
+                the metric names "component\\0name", then the strings
+
+    Each chunk is self-contained: a log can be appended to after a
+    restart, and a chunk cut short by a crash only loses its own records.
+    Use read_metrics or load_metric to read it back.
+    """
+
+    def __init__(self, path='debug/metrics.dat', buffersize=4096, interval=30, level=1):
 
         prefix = os.path.dirname(os.path.abspath(os.path.expanduser(path)))
         if not os.path.exists(prefix):
             os.makedirs(prefix)
 
-        self._fd = None
-        self._path = path
+        self._path       = path
         self._buffersize = buffersize
+        self._interval   = interval
+        self._level      = level
 
+        self._thread = None
         self.open()
+        atexit.register(self.close)
 
     @property
     def path(self): return self._path
 
-    @typecheck(float, str, str)
+    def _reset(self):
+        self._times   = np.empty(self._buffersize, dtype='<f8')
+        self._ids     = np.empty(self._buffersize, dtype='<u4')
+        self._values  = np.empty(self._buffersize, dtype='<f8')
+        self._strings = list()
+        self._count   = 0
+        self._since   = systime.time()
+
+    def _register(self, key, isstring):
+        self._metrics[key] = len(self._names), isstring
+        self._names.append((key, isstring))
+        return self._metrics[key]
+
+    def _retype(self, key, isstring):
+        ### the first value other than None of a metric only logged as None so far
+        mid, _ = self._metrics[key]
+        self._metrics[key] = mid, isstring
+        self._names[mid]   = key, isstring
+        self._untyped.discard(key)
+        return self._metrics[key]
+
     def update(self, t, component, name, val):
-        s = '%f %s %s %s\n' % (t, component, name, val)
-        self._fd.write(s)
+        key = component, name
+        try:
+            mid, isstring = self._metrics[key]
+        except KeyError:
+            mid, isstring = self._register(key, isinstance(val, basestring))
+            if val is None:
+                self._untyped.add(key)
+        else:
+            if val is not None and key in self._untyped:
+                mid, isstring = self._retype(key, isinstance(val, basestring))
 
-    def output(self, val):
-        self._fd.write(str(val))
+        i = self._count
+        if val is None:
+            self._values[i] = np.nan
+        elif isstring:
+            self._values[i] = len(self._strings)
+            self._strings.append(str(val))
+        else:
+            self._values[i] = val
+        self._times[i] = t
+        self._ids[i]   = mid
+        self._count    = i + 1
+
+        if self._count == self._buffersize or systime.time() - self._since > self._interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered records to the background thread
+        """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+        if self._count > 0:
+            n = self._count
+            self._queue.put((self._times[:n], self._ids[:n], self._values[:n], self._strings, self._names[:]))
+            self._reset()
+
+    def _chunk(self, times, ids, values, strings, names):
+        used, local = np.unique(ids, return_inverse=True)
+        metrics     = ['%s\0%s' % names[m][0] for m in used]
+        isstring    = np.array([names[m][1] for m in used], dtype='<u1')
+        lengths     = np.array(map(len, metrics + strings), dtype='<u4')
+
+        payload = ''.join([times.tostring(), local.astype('<u4').tostring(), values.tostring(),
+                           isstring.tostring(), lengths.tostring()] + metrics + strings)
+        payload = zlib.compress(payload, self._level)
+        header  = METRICS_CHUNK.pack('CHNK', len(times), len(metrics), len(strings), len(payload),
+                                     zlib.crc32(payload) & 0xffffffff)
+        return header + payload
+
+    def _write(self, queue):
+        fd = open(self._path, 'ab')
+        if os.path.getsize(self._path) == 0:
+            fd.write(METRICS_MAGIC)
+        while True:
+            chunk = queue.get()
+            if chunk is None: break
+            try:
+                fd.write(self._chunk(*chunk))
+                fd.flush()
+            except Exception, e:
+                self._error = e
+        fd.close()
 
     def close(self):
-        if self._fd is not None:
-            self._fd.close()
-            self._fd = None
+        if self._thread is not None:
+            self.flush()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
 
     def open(self):
-        if self._fd is None:
-            self._fd = gzip.GzipFile(self._path, 'ab')
+        if self._thread is None:
+            self._metrics = dict()   # (component, name) -> (index, isstring)
+            self._names   = list()   # index -> ((component, name), isstring)
+            self._untyped = set()    # (component, name) only logged as None
+            self._error   = None
+            self._reset()
+            self._queue  = Queue.Queue()
+            self._thread = threading.Thread(target=self._write, args=(self._queue,), name='MetricsLogger')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __getstate__(self):
+        """
+        The thread and buffers are not pickled: close the logger before
+        """
+        return dict(_path       = self._path,
+                    _buffersize = self._buffersize,
+                    _interval   = self._interval,
+                    _level      = self._level)
+
+    def __setstate__(self, odict):
+        self.__dict__.update(odict)
+        self._thread = None
+        self.open()
+        atexit.register(self.close)
+
+
+class Metrics(object):
+
+    """
+    The records of a metrics log, read at once
+    """
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        if not data.startswith(METRICS_MAGIC):
+            raise ValueError, '%s is not a metrics log' % path
+
+        self.path     = path
+        self._ids     = dict()   # (component, name) -> index
+        self._isstring = list()
+        strings = list()
+        times, ids, values = [], [], []
+
+        pos = len(METRICS_MAGIC)
+        while pos + METRICS_CHUNK.size <= len(data):
+            magic, n, nmetrics, nstrings, nbytes, crc = METRICS_CHUNK.unpack_from(data, pos)
+            pos += METRICS_CHUNK.size
+            payload = data[pos:pos + nbytes]
+            pos += nbytes
+            if magic != 'CHNK' or len(payload) < nbytes or zlib.crc32(payload) & 0xffffffff != crc:
+                print 'WARNING: %s is truncated after %d records' % (path, sum(map(len, times)))
+                break
+            payload = zlib.decompress(payload)
+
+            offset  = 0
+            columns = []
+            for dtype, count in [('<f8', n), ('<u4', n), ('<f8', n), ('<u1', nmetrics), ('<u4', nmetrics + nstrings)]:
+                columns.append(np.frombuffer(payload, dtype=dtype, count=count, offset=offset))
+                offset += columns[-1].nbytes
+            t, local, v, isstring, lengths = columns
+
+            bounds = offset + np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+            fields = [payload[a:b] for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+            gids = np.empty(nmetrics, dtype=np.int64)
+            for i, metric in enumerate(fields[:nmetrics]):
+                gids[i] = self._id(tuple(metric.split('\0', 1)), bool(isstring[i]))
+
+            ### the None values are NaN and stay so
+            v = v.copy()
+            v[isstring.astype(bool)[local]] += len(strings)
+            strings.extend(fields[nmetrics:])
+
+            times.append(t)
+            ids.append(gids[local])
+            values.append(v)
+
+        self.times  = np.concatenate(times)  if times  else np.zeros(0)
+        self.ids    = np.concatenate(ids)    if ids    else np.zeros(0, dtype=np.int64)
+        self.values = np.concatenate(values) if values else np.zeros(0)
+        self._strings = np.array(strings, dtype=object)
+
+    def _id(self, key, isstring):
+        if key not in self._ids:
+            self._ids[key] = len(self._isstring)
+            self._isstring.append(isstring)
+        elif isstring:
+            ### the earlier chunks only had None values
+            self._isstring[self._ids[key]] = True
+        return self._ids[key]
+
+    @property
+    def names(self):
+        """
+        The (component, name) of the metrics, in the order they were first logged
+        """
+        return sorted(self._ids, key=self._ids.get)
+
+    def __contains__(self, key):
+        return tuple(key) in self._ids
+
+    def __len__(self):
+        return len(self.times)
+
+    def get(self, component, name):
+        """
+        The times and values of a metric, as arrays in the order they
+        were logged.  The values of a string metric are an object array,
+        with None where None was logged.
+        """
+        key = component, name
+        if key not in self._ids:
+            raise KeyError, 'No metric %s %s in %s' % (component, name, self.path)
+        mask   = self.ids == self._ids[key]
+        values = self.values[mask]
+        if self._isstring[self._ids[key]]:
+            null   = np.isnan(values)
+            index  = np.where(null, 0, values).astype(np.int64)
+            values = self._strings[index] if len(self._strings) else np.empty(len(values), dtype=object)
+            values[null] = None
+        return self.times[mask], values
+
+
+def read_metrics(path):
+    return Metrics(path)
+
+def load_metric(path, component, name):
+    """
+    The times and values of a metric of the log at *path*
+    """
+    return Metrics(path).get(component, name)
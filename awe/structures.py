@@ -10,12 +10,78 @@ See the file COPYING for details.
 from util import typecheck, returns
 import io
 
-import prody
-
 import numpy as np
 
 import os
 
+
+_prody = None
+
+def load_prody():
+    """
+    The prody module, imported on first use since it is slow to import
+    """
+    global _prody
+    if _prody is None:
+        import prody
+
+        ### compatibility with different versions of prody
+        try:
+            prody.setVerbosity('error')
+        except AttributeError:
+            prody.confProDy(verbosity='error')
+
+        _prody = prody
+    return _prody
+
+class PDBTemplate(object):
+
+    """
+    The text of a PDB file with the coordinate columns of the ATOM and
+    HETATM records left to be filled in.  Everything else (atom and
+    residue names, chains, ...) is rendered once, so writing a
+    structure with new coordinates does not go through ProDy.
+    """
+
+    FIELD = 8     # width of each '%8.3f' coordinate field
+    START = 30    # column of the x coordinate
+
+    def __init__(self, pdbstring):
+        lines   = pdbstring.splitlines(True)
+        offsets = []
+        pos     = 0
+        for line in lines:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                offsets.append(pos + PDBTemplate.START)
+            pos += len(line)
+
+        width          = 3 * PDBTemplate.FIELD
+        self._buffer   = bytearray(pdbstring)
+        self._natoms   = len(offsets)
+        self._columns  = np.array(offsets, dtype=np.intp)[:,np.newaxis] + np.arange(width)
+        self._format   = '%8.3f' * (3 * self._natoms)
+
+    @property
+    def natoms(self): return self._natoms
+
+    @returns(str)
+    def render(self, coords):
+        """
+        The PDB text with *coords* (natoms x 3) in the coordinate columns
+        """
+        coords = np.asarray(coords)
+        if coords.shape != (self._natoms, 3):
+            raise ValueError, 'Expected coordinates of shape %s, got %s' % ((self._natoms, 3), coords.shape)
+
+        fields = self._format % tuple(coords.ravel().tolist())
+        if len(fields) != self._columns.size:
+            raise ValueError, 'Coordinates do not fit in the %d column PDB fields' % PDBTemplate.FIELD
+
+        view = np.frombuffer(self._buffer, dtype=np.uint8)
+        view[self._columns] = np.frombuffer(fields, dtype=np.uint8).reshape(self._columns.shape)
+        return str(self._buffer)
+
+
 class PDB(object):
 
     def __init__(self, string=None, pdb=None):
@@ -28,16 +94,17 @@ class PDB(object):
         else:
             self._pdb = None
 
+        self._template = None
+
+    ### a prody.AtomGroup
     @staticmethod
-    @returns(prody.AtomGroup)
     def _from_str(string):
         ss = io.StringStream(string)
-        return prody.parsePDBStream(ss)
+        return load_prody().parsePDBStream(ss)
 
     @staticmethod
-    @returns(prody.AtomGroup)
     def _from_file(path):
-        return prody.parsePDB(path)
+        return load_prody().parsePDB(path)
 
     def __getstate__(self):
         """
@@ -48,6 +115,7 @@ class PDB(object):
         pdbstring = str(self)
         odict = self.__dict__.copy()
         odict['_pdb'] = pdbstring
+        odict['_template'] = None
         return odict
 
     def __setstate__(self, odict):
@@ -57,11 +125,12 @@ class PDB(object):
         """
         pdbstring = odict['_pdb']
         odict['_pdb'] = PDB._from_str(pdbstring)
+        odict.setdefault('_template', None)
         self.__dict__.update(odict)
 
     def __str__(self):
         ss = io.StringStream()
-        prody.writePDBStream(ss, self._pdb)
+        load_prody().writePDBStream(ss, self._pdb)
         return ss.read()
 
     @property
@@ -77,3 +146,12 @@ class PDB(object):
     def copy(self):
         return PDB(pdb=self._pdb.copy())
 
+    @returns(PDBTemplate)
+    def template(self):
+        """
+        The PDBTemplate of this structure, rendered on first use
+        """
+        if self._template is None:
+            self._template = PDBTemplate(str(self))
+        return self._template
+
@@ -0,0 +1,209 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+"""
+Binary walker format used to send walkers to and from the workers.
+
+A walker is a fixed little-endian header followed by the raw float32
+coordinates:
+
+  magic 'AWEW', version, id, initid, cellid, assignment, color, weight, natoms, ndim
+
+A walker reference has the magic 'AWER' and is followed by the sha1 hex
+digest of its coordinates instead.  The coordinates are sent separately
+as the cached file 'blob.<digest>', so walkers starting from the same
+coordinates share the file on a worker.
+
+On the master the coordinates are read with numpy.frombuffer.  The
+worker runs this file as a script (see execute-task.sh) to convert
+between the binary format and the PDB files gromacs reads and writes.
+The script only needs the python standard library, and this module
+must stay importable by python 2 and 3 without numpy.
+"""
+
+import array
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MAGIC     = b'AWEW'
+REFERENCE = b'AWER'
+VERSION   = 1
+HEADER    = struct.Struct('<4sIqqqqqdII')
+COORDS    = '<f4'
+DIGEST    = 40           # length of a sha1 hex digest
+BLOB      = 'blob.%s'    # name of the coordinates of a reference
+
+_NONE   = -1    # a missing cellid or assignment
+
+FIELDS  = ('id', 'initid', 'cellid', 'assignment', 'color', 'weight', 'natoms', 'ndim')
+
+
+class TransportException (Exception): pass
+
+
+def pack_header(wid, initid, cellid, assignment, color, weight, natoms, ndim, magic=MAGIC):
+    return HEADER.pack(magic, VERSION, wid, initid,
+                       _NONE if cellid     is None else cellid,
+                       _NONE if assignment is None else assignment,
+                       color,
+                       float('nan') if weight is None else weight,
+                       natoms, ndim)
+
+def unpack_header(buf):
+    """
+    Returns a dict of the header fields at the start of *buf*.  The
+    'blob' field is the digest of the coordinates of a reference, None
+    if the coordinates follow the header.
+    """
+    values = HEADER.unpack_from(buf)
+    if values[0] not in (MAGIC, REFERENCE):
+        raise TransportException('Not a binary walker: bad magic %r' % values[0])
+    if values[1] != VERSION:
+        raise TransportException('Unsupported binary walker version %d' % values[1])
+    header = dict(zip(FIELDS, values[2:]))
+    for name in ('cellid', 'assignment'):
+        if header[name] == _NONE:
+            header[name] = None
+    header['blob'] = None
+    if values[0] == REFERENCE:
+        header['blob'] = buf[HEADER.size:HEADER.size + DIGEST].decode('ascii')
+    return header
+
+
+def pack_walker(walker, coords=None):
+    """
+    Serialize *walker* with its *coords* (default: the starting coordinates)
+    """
+    if coords is None:
+        coords = walker.start
+    coords = np.asarray(coords, dtype=COORDS)
+    natoms, ndim = coords.shape
+    header = pack_header(walker.id, walker.initid, walker.cellid, walker.assignment,
+                         walker.color, walker.weight, natoms, ndim)
+    return header + coords.tostring()
+
+def pack_coords(coords):
+    """
+    The raw coordinates sent as the blob of a reference
+    """
+    return np.asarray(coords, dtype=COORDS).tostring()
+
+def pack_reference(walker, digest, coords=None):
+    """
+    Serialize *walker*, whose *coords* (default: the starting
+    coordinates) are sent as the blob with *digest*
+    """
+    if coords is None:
+        coords = walker.start
+    natoms, ndim = np.shape(coords)
+    header = pack_header(walker.id, walker.initid, walker.cellid, walker.assignment,
+                         walker.color, walker.weight, natoms, ndim, magic=REFERENCE)
+    return header + digest.encode('ascii')
+
+def unpack_walker(buf):
+    """
+    Returns (header, coords), the coordinates being a read-only
+    (natoms, ndim) float32 view of *buf*
+    """
+    header = unpack_header(buf)
+    if header['blob'] is not None:
+        raise TransportException('Walker %d is a reference to blob %s' % (header['id'], header['blob']))
+    coords = np.frombuffer(buf, dtype=COORDS, count=header['natoms'] * header['ndim'], offset=HEADER.size)
+    return header, coords.reshape((header['natoms'], header['ndim']))
+
+
+### worker side: standard library only
+
+def _read(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+def _coords_array(buf, header):
+    """
+    The coordinates following the *header* in *buf*, or in the blob it refers to
+    """
+    offset = HEADER.size
+    if header['blob'] is not None:
+        buf, offset = _read(BLOB % header['blob']), 0
+    coords = array.array('f')
+    n      = header['natoms'] * header['ndim']
+    coords.fromstring(buf[offset:offset + 4 * n]) if sys.version_info[0] < 3 else \
+        coords.frombytes(buf[offset:offset + 4 * n])
+    if sys.byteorder == 'big':
+        coords.byteswap()
+    return coords
+
+def _atom_lines(lines):
+    return [i for i, l in enumerate(lines) if l.startswith('ATOM') or l.startswith('HETATM')]
+
+def to_pdb(topology, walkerpath, pdbpath):
+    """
+    Write the coordinates of the binary walker at *walkerpath* into the
+    atom records of the *topology* PDB file
+    """
+    buf    = _read(walkerpath)
+    header = unpack_header(buf)
+    coords = _coords_array(buf, header)
+
+    with open(topology) as fd:
+        lines = fd.readlines()
+    atoms = _atom_lines(lines)
+    if len(atoms) != header['natoms']:
+        raise TransportException('Topology has %d atoms but walker %d has %d' % (len(atoms), header['id'], header['natoms']))
+
+    for k, i in enumerate(atoms):
+        l = lines[i]
+        x, y, z = coords[3*k:3*k+3]
+        lines[i] = '%s%8.3f%8.3f%8.3f%s' % (l[:30], x, y, z, l[54:])
+
+    with open(pdbpath, 'w') as fd:
+        fd.writelines(lines)
+
+def from_pdb(walkerpath, pdbpath, outpath):
+    """
+    Write a binary walker with the header of the walker at *walkerpath*
+    and the coordinates of the PDB file at *pdbpath*
+    """
+    header = unpack_header(_read(walkerpath))
+
+    with open(pdbpath) as fd:
+        lines = fd.readlines()
+    coords = array.array('f')
+    for i in _atom_lines(lines):
+        l = lines[i]
+        coords.extend((float(l[30:38]), float(l[38:46]), float(l[46:54])))
+    if sys.byteorder == 'big':
+        coords.byteswap()
+
+    natoms = len(coords) // 3
+    out    = pack_header(header['id'], header['initid'], header['cellid'], header['assignment'],
+                         header['color'], header['weight'], natoms, 3)
+    with open(outpath, 'wb') as fd:
+        fd.write(out)
+        fd.write(coords.tostring() if sys.version_info[0] < 3 else coords.tobytes())
+
+
+def _main(args):
+    usage = 'USAGE: %s to-pdb <topology.pdb> <walker.bin> <out.pdb> | from-pdb <walker.bin> <in.pdb> <out.bin>'
+    if len(args) == 5 and args[1] == 'to-pdb':
+        to_pdb(*args[2:])
+    elif len(args) == 5 and args[1] == 'from-pdb':
+        from_pdb(*args[2:])
+    else:
+        sys.stderr.write(usage % args[0] + '\n')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv))
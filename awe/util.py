@@ -8,10 +8,32 @@ See the file COPYING for details.
 
 
 import traceback
+import types
+import sys
 import os
 
 class TypeException (Exception): pass
 
+
+### The typecheck/returns decorators check the types of the arguments and
+### results.  With AWE_TYPECHECK=0 in the environment they return the
+### undecorated function instead, see also configure.
+TYPECHECK = os.environ.get('AWE_TYPECHECK', '1').lower() not in ('0', 'false', 'no', 'off')
+
+_CHECKED = dict()     # checking wrapper -> the function it wraps
+_SWAPPED = list()     # (owner, name, checked value) replaced by set_typecheck(False)
+
+
+def istype(value, expected):
+    """
+    The type of *value* is *expected*, or one of them if *expected* is a
+    tuple or a list (which may be extended after the check is declared)
+    """
+    typ = type(value)
+    if type(expected) in (tuple, list):
+        return typ in expected
+    return typ is expected
+
 class _typecheck(object):
 
     def __init__(self, method=True):
@@ -27,11 +49,12 @@ class _typecheck(object):
         return self
 
     def typecheck(self, value, expected, name='', arg=-1):
-        typ = type(value)
-        if typ is not expected:
-             raise TypeException, '%s expected: %s, but got: %s' % (name or 'param %s' % arg, expected, typ)
+        if not istype(value, expected):
+             raise TypeException, '%s expected: %s, but got: %s' % (name or 'param %s' % arg, expected, type(value))
 
     def __call__(self, fn):
+        if not TYPECHECK: return fn
+
         def wrapped(*args, **kws):
  
             try:
@@ -55,6 +78,7 @@ class _typecheck(object):
 
         wrapped.func_name = fn.func_name
         wrapped.func_doc = fn.func_doc
+        _CHECKED[wrapped] = fn
         return wrapped
 
 class returns(object):
@@ -65,10 +89,11 @@ class returns(object):
     def expected(self): return self._expected
 
     def typecheck(self, value):
-        typ = type(value)
-        return typ is self.expected
+        return istype(value, self.expected)
 
     def __call__(self, fn):
+        if not TYPECHECK: return fn
+
         def wrapped(*args, **kws):
             result = fn(*args, **kws)
             if self.typecheck(result):
@@ -82,6 +107,7 @@ class returns(object):
 
         wrapped.func_name = fn.func_name
         wrapped.func_doc = '%s -> %s\n\n%s' % (fn.func_name, self.expected, fn.func_doc or '')
+        _CHECKED[wrapped] = fn
         return wrapped
 
 
@@ -97,6 +123,56 @@ def typecheckfn(*args, **kws):
     return tc
 
 
+def _unchecked(fn):
+    while fn in _CHECKED:
+        fn = _CHECKED[fn]
+    return fn
+
+def set_typecheck(enabled):
+    """
+    Turn the checks of typecheck/returns on or off.  Turning them off
+    also replaces the methods, functions and properties of the awe
+    modules already decorated by the undecorated ones, so that they cost
+    nothing; turning them back on restores those.  Functions decorated
+    while the checks were off are never checked.
+    """
+    global TYPECHECK
+    TYPECHECK = bool(enabled)
+
+    if TYPECHECK:
+        for owner, name, value in reversed(_SWAPPED):
+            setattr(owner, name, value)
+        del _SWAPPED[:]
+        return
+
+    for module in sys.modules.values():
+        if module is None or not (module.__name__ == 'awe' or module.__name__.startswith('awe.')):
+            continue
+        owners = [module] + [c for c in vars(module).values()
+                             if isinstance(c, type) and c.__module__ == module.__name__]
+        for owner in owners:
+            for name, value in vars(owner).items():
+                if isinstance(value, property) and value.fget in _CHECKED:
+                    unchecked = property(_unchecked(value.fget), value.fset, value.fdel, value.__doc__)
+                elif isinstance(value, types.FunctionType) and value in _CHECKED:
+                    unchecked = _unchecked(value)
+                else:
+                    continue
+                _SWAPPED.append((owner, name, value))
+                setattr(owner, name, unchecked)
+
+def configure(typecheck=None):
+    """
+    Global settings of AWE:
+
+      *typecheck* : check the types of the arguments and results of the
+                    decorated functions (see set_typecheck), on unless
+                    AWE_TYPECHECK=0 is in the environment
+    """
+    if typecheck is not None:
+        set_typecheck(typecheck)
+
+
 def deprecated(fn):
     def wrapped(*args, **kws):
         print 'WARNING: call to deprecated function: %s' % fn.func_name
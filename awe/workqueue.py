@@ -8,11 +8,13 @@ See the file COPYING for details.
 
 
 import awe
+import instrument
+import localqueue
+import replication
+import transport
 
-import work_queue as WQ
-
-import os, tarfile, tempfile, time, shutil, traceback, random
-from collections import defaultdict
+import os, tarfile, tempfile, time, shutil, traceback, random, hashlib
+from collections import defaultdict, deque
 
 
 ### A process can only support a single WorkQueue instance
@@ -28,12 +30,44 @@ WORKER_WEIGHTS_NAME = 'weight.dat'
 WORKER_COLOR_NAME   = 'color.dat'
 WORKER_CELL_NAME    = 'cell.dat'
 WORKER_RESULTS_NAME = 'results.tar'
+WORKER_WALKER_BINARY  = 'walker.bin'
+WORKER_TOPOLOGY_NAME  = 'topology.pdb'
+WORKER_CONVERTER_NAME = 'awe-walker.py'
+WORKER_TOP_CELLS_NAME = 'top-cells'
+WORKER_FRAMES_NAME    = 'assign-frames'
 
 RESULT_POSITIONS    = 'structure2.pdb'
 RESULT_WEIGHTS      = 'weight.dat'
 RESULT_COLOR        = 'color.dat'
 RESULT_CELL         = 'cell2.dat'
 RESULT_NAME         = 'results.tar'
+RESULT_WALKER       = 'structure2.bin'
+RESULT_TOP          = 'cell2.top'
+RESULT_FRAMES       = 'cell2.frames'
+
+
+### the task classes of the available backends, work_queue.Task once it is imported
+TASK_TYPES = [localqueue.Task]
+
+### the work_queue module, imported by the first master using it
+WQ = None
+
+def work_queue_module():
+    """
+    Import the work_queue module and add its Task to TASK_TYPES.
+    Raises WorkQueueException if it cannot be imported.
+    """
+    global WQ
+    if WQ is None:
+        try:
+            import work_queue
+        except ImportError, e:
+            raise WorkQueueException, 'Cannot import the work_queue module (%s). ' \
+                'Check the CCTools installation and PYTHONPATH, or run the tasks ' \
+                'on this machine with the local backend (awe-wq --backend local)' % e
+        WQ = work_queue
+        TASK_TYPES.insert(0, WQ.Task)
+    return WQ
 
 
 class WorkQueueException       (Exception): pass
@@ -89,9 +123,10 @@ class Config(object):
 
     def __init__(self):
 
+        self.backend         = 'workqueue'     # or 'local', never chosen implicitly
         self.name            = ''
-        self.port            = WQ.WORK_QUEUE_DEFAULT_PORT
-        self.schedule        = WQ.WORK_QUEUE_SCHEDULE_TIME
+        self.port            = None # WORK_QUEUE_DEFAULT_PORT
+        self.schedule        = None # WORK_QUEUE_SCHEDULE_TIME
         self.exclusive       = True
         self.catalog         = False
         self.debug           = ''
@@ -99,6 +134,8 @@ class Config(object):
         self.fastabort       = 3
         self.restarts        = 95 # until restarts are handled on a per-iteration basis
         self.maxreps         = 9
+        self.replication     = 'straggler'  # or 'least'
+        self.straggler_quantile = 0.9
         self.waittime        = 10 # in seconds
         self.wq_logfile      = 'debug/wq.log'
         self.wqstats_logfile = 'debug/wq-stats.log'
@@ -106,6 +143,13 @@ class Config(object):
         self.summaryfile     = ''
 	self.capacity        = False
 
+        ### the local backend
+        self.local_workers      = 1
+        self.local_latency      = 0.  # mean, in seconds
+        self.local_failure_rate = 0.
+        self.local_sandbox      = None
+        self.local_seed         = None
+
         self._executable = None
         self._cache = set()
 
@@ -124,12 +168,30 @@ class Config(object):
             wqf = WQFile(path, base=base, cached=True, remotepath=remotepath)
             self._cache.add(wqf)
 
+    def _mk_replication(self):
+        if self.replication == 'straggler':
+            return replication.Straggler(quantile=self.straggler_quantile)
+        elif self.replication == 'least':
+            return replication.LeastReplicated()
+        else:
+            raise WorkQueueException, 'Unknown replication policy %r: valid: {straggler|least}' % self.replication
+
     def _mk_wq(self):
         global _AWE_WORK_QUEUE
         if _AWE_WORK_QUEUE is not None:
             ### warn
             awe.log('WARNING: using previously created WorkQueue instance')
+        elif self.backend == 'local':
+            _AWE_WORK_QUEUE = localqueue.LocalQueue(workers      = self.local_workers,
+                                                    latency      = self.local_latency,
+                                                    failure_rate = self.local_failure_rate,
+                                                    sandbox      = self.local_sandbox,
+                                                    seed         = self.local_seed)
+            awe.log('Running %d local workers in %s' % (self.local_workers, _AWE_WORK_QUEUE.sandbox))
+        elif self.backend != 'workqueue':
+            raise WorkQueueException, 'Unknown backend %r: valid: {workqueue|local}' % self.backend
         else:
+            work_queue_module()
             if self.debug:
                 WQ.set_debug_flag(self.debug)
                 if self.wq_logfile:
@@ -139,11 +201,11 @@ class Config(object):
             if self.name:
                 self.catalog = True
             wq = WQ.WorkQueue(name      = self.name,
-                              port      = self.port,
+                              port      = self.port if self.port is not None else WQ.WORK_QUEUE_DEFAULT_PORT,
                               shutdown  = self.shutdown,
                               catalog   = self.catalog,
                               exclusive = self.exclusive)
-            wq.specify_algorithm(self.schedule)
+            wq.specify_algorithm(self.schedule if self.schedule is not None else WQ.WORK_QUEUE_SCHEDULE_TIME)
             if self.monitor: 
                 wq.enable_monitoring(self.summaryfile)
 
@@ -160,70 +222,313 @@ class Config(object):
             if typ is float or typ is int:
                 wq.activate_fast_abort(self.fastabort)
 
-            _AWE_WORK_QUEUE = wq
+            _AWE_WORK_QUEUE = WorkQueueBackend(wq)
 
         awe.util.makedirs_parent(self.wqstats_logfile)
         _AWE_WORK_QUEUE.specify_log(self.wqstats_logfile)
         return _AWE_WORK_QUEUE
 
 
+class IBackend(object):
+
+    """
+    Interface of the task execution engines behind WorkQueue.
+    The methods follow the work_queue.WorkQueue API.
+    """
+
+    @property
+    def stats(self):
+        """
+        An object with the workers_* and tasks_* counters of work_queue
+        """
+        raise NotImplementedError
+
+    def new_task(self, command):
+        """
+        Returns a task running *command* in its sandbox
+        """
+        raise NotImplementedError
+
+    def submit(self, task):
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        """
+        Returns a completed task, or None after *timeout* seconds
+        """
+        raise NotImplementedError
+
+    def cancel_by_tasktag(self, tag):
+        """
+        Returns the cancelled task, or None if no task has *tag*
+        """
+        raise NotImplementedError
+
+    def empty(self):
+        raise NotImplementedError
+
+    def clear(self, running=None):
+        """
+        Release the references kept to completed tasks, all of them
+        unless some tasks are still *running*
+        """
+        raise NotImplementedError
+
+    def specify_log(self, path):
+        raise NotImplementedError
+
+    def avoid_hosts(self, task, hosts):
+        """
+        Do not run *task* on any of *hosts* if another worker is available.
+        Backends that cannot place tasks may ignore this.
+        """
+        pass
+
+    def invalidate_cache_file(self, name):
+        """
+        The cached input *name* is no longer needed by any task
+        """
+        pass
+
+
+class WorkQueueBackend(IBackend):
+
+    """
+    Run tasks with a work_queue.WorkQueue master
+    """
+
+    def __init__(self, wq):
+        self.wq = wq
+
+    name  = property(lambda self: self.wq.name)
+    port  = property(lambda self: self.wq.port)
+    stats = property(lambda self: self.wq.stats)
+
+    def new_task(self, command):
+        return WQ.Task(command)
+
+    def submit(self, task):
+        return self.wq.submit(task)
+
+    def wait(self, timeout):
+        return self.wq.wait(timeout)
+
+    def cancel_by_tasktag(self, tag):
+        return self.wq.cancel_by_tasktag(tag)
+
+    def empty(self):
+        return self.wq.empty()
+
+    def clear(self, running=None):
+        if running is None:
+            self.wq._task_table.clear()
+            return
+        keep = set(id(task) for task in running)
+        for taskid, task in self.wq._task_table.items():
+            if id(task) not in keep:
+                del self.wq._task_table[taskid]
+
+    def specify_log(self, path):
+        self.wq.specify_log(path)
+
+    def avoid_hosts(self, task, hosts):
+        """
+        The work_queue API has no way to keep a task off a worker, so
+        replicas may run on the host of the straggler they duplicate
+        """
+        pass
+
+    def invalidate_cache_file(self, name):
+        """
+        Only some versions of work_queue can drop a cached file from the workers
+        """
+        invalidate = getattr(self.wq, 'invalidate_cache_file', None)
+        if invalidate is not None:
+            invalidate(name)
+
+
+class _Bucket(object):
+
+    """
+    A set of tags supporting O(1) add, discard, and random choice
+    """
+
+    def __init__(self):
+        self._tags  = []
+        self._index = dict()
+
+    def add(self, tag):
+        if tag not in self._index:
+            self._index[tag] = len(self._tags)
+            self._tags.append(tag)
+
+    def discard(self, tag):
+        i = self._index.pop(tag, None)
+        if i is None: return
+        last = self._tags.pop()
+        if i < len(self._tags):
+            self._tags[i]    = last
+            self._index[last] = i
+
+    def choice(self):
+        return random.choice(self._tags)
+
+    def __contains__(self, tag):
+        return tag in self._index
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __iter__(self):
+        return iter(self._tags)
+
+
+class BlobCache(object):
+
+    """
+    Content-addressed task inputs.  A blob is sent as a cached buffer
+    named by its sha1 digest, so the workers keep a single copy of
+    identical inputs, such as the starting coordinates of the walkers
+    split from the same parent.  A blob is invalidated once no
+    outstanding task refers to it.
+
+    *unique* and *shared* count the bytes of the blobs staged since the
+    last *reset* that were new and that were already referred to by
+    another task: the latter need not be sent again to a worker that
+    already has them.
+    """
+
+    def __init__(self, name=transport.BLOB):
+        self._name   = name
+        self._refs   = dict()              # digest -> number of references by outstanding tasks
+        self._tags   = defaultdict(list)   # tag    -> digests
+        self.unique  = 0
+        self.shared  = 0
+
+    def __len__(self):
+        return len(self._refs)
+
+    def stage(self, task, data):
+        """
+        Add *data* to *task* as a blob.  Returns its digest.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        count  = self._refs.get(digest, 0)
+        if count:
+            self.shared += len(data)
+        else:
+            self.unique += len(data)
+        self._refs[digest] = count + 1
+        self._tags[task.tag].append(digest)
+        task.specify_buffer(data, self._name % digest, cache=True)
+        return digest
+
+    def release(self, tag):
+        """
+        The tasks with *tag* are done.  Returns the names of the blobs no
+        longer referred to.
+        """
+        names = []
+        for digest in self._tags.pop(tag, []):
+            self._refs[digest] -= 1
+            if self._refs[digest] == 0:
+                del self._refs[digest]
+                names.append(self._name % digest)
+        return names
+
+    def reset(self):
+        self.unique = 0
+        self.shared = 0
+
+
 class TagSet(object):
+
+    """
+    The tags of the outstanding tasks, grouped by how many times each
+    was replicated.  The count of a tag is kept in a dict and the tags
+    of each count in a bucket, so add, discard and select do not depend
+    on the number of tags.  The number of buckets is bounded by the
+    number of replicas.
+    """
+
     def __init__(self, maxreps=5):
-        self._tags = defaultdict(set)
+        self._counts  = dict()               # tag   -> count
+        self._buckets = defaultdict(_Bucket) # count -> tags
+        self._min     = None                 # smallest count, None if unknown
         self._maxreps = maxreps
 
+    def _minimum(self):
+        if self._min is None and self._buckets:
+            self._min = min(self._buckets.iterkeys())
+        return self._min
+
+    maxreps = property(lambda self: self._maxreps)
+
     def can_duplicate(self):
-        valid = filter(lambda k: k < self._maxreps, self._tags.iterkeys())
-        return len(valid) > 0
+        m = self._minimum()
+        return m is not None and m < self._maxreps
 
     def clear(self):
-        self._tags.clear()
+        self._counts.clear()
+        self._buckets.clear()
+        self._min = None
 
     def clean(self):
-        for k in self._tags.keys():
-            if len(self._tags[k]) < 1:
-                del self._tags[k]
-
-    def _find_tag_group(self, tag):
-        for group, tags in self._tags.iteritems():
-            if tag in tags:
-                return group
-        return None
+        """
+        Empty groups are removed as they empty, kept for compatibility
+        """
+        pass
+
+    def _remove(self, tag, count):
+        bucket = self._buckets[count]
+        bucket.discard(tag)
+        if len(bucket) == 0:
+            del self._buckets[count]
+            if count == self._min:
+                self._min = None
+
+    def _insert(self, tag, count):
+        self._counts[tag] = count
+        self._buckets[count].add(tag)
+        if self._min is not None and count < self._min:
+            self._min = count
 
     def add(self, tag, startcount=0):
-        key = self._find_tag_group(tag)
-
-        ### add the tag to the appropriate group, removing it from previous one
-        if key is None:
-            self._tags[startcount].add(tag)
+        """
+        Add a new *tag* with *startcount*, or increment the count of a known one
+        """
+        count = self._counts.get(tag)
+        if count is None:
+            self._insert(tag, startcount)
         else:
-            self._tags[key+1].add(tag)
-            self._tags[key  ].discard(tag)
-
-        ### delete the group if it became empty
-        if key is not None and len(self._tags[key]) == 0:
-            del self._tags[key]
-
+            self._remove(tag, count)
+            self._insert(tag, count + 1)
 
     def select(self):
-        if len(self) > 0:
-            count  = 1
-            minkey = min(self._tags.keys())
-            assert len(self._tags[minkey]) > 0, str(minkey) + ', ' + str(self._tags[minkey])
-            return random.sample(self._tags[minkey], count)[0]
-        else:
+        """
+        A random tag among the least replicated ones, or None
+        """
+        m = self._minimum()
+        if m is None:
             return None
+        return self._buckets[m].choice()
 
     def discard(self, tag, key=None):
-        key = key or self._find_tag_group(tag)
-        if key is not None:
-            self._tags[key].discard(tag)
+        count = self._counts.pop(tag, None)
+        if count is not None:
+            self._remove(tag, count)
+
+    def count(self, tag):
+        return self._counts.get(tag)
 
     def __len__(self):
-        return reduce(lambda s, k: s + len(self._tags[k]), self._tags.iterkeys(), 0 )
+        return len(self._counts)
+
+    def __contains__(self, tag):
+        return tag in self._counts
 
     def __str__(self):
-        d = dict([(k,len(s)) for k,s in self._tags.iteritems()])
+        d = dict([(k,len(s)) for k,s in self._buckets.iteritems()])
         return '<TagSet(maxreps=%s): %s>' % (self._maxreps, d)
 
 
@@ -236,20 +541,28 @@ class WorkQueue(object):
         self.cfg    = cfg
         self.wq     = self.cfg._mk_wq()
         self._tagset = TagSet(maxreps=self.cfg.maxreps)
+        self._policy = self.cfg._mk_replication()
+        self._tasks  = defaultdict(list)   # tag -> submitted tasks
+        self.blobs   = BlobCache()
 
-        self.stats  = awe.stats.WQStats(logger=statslogger)
+        self.statslogger      = statslogger      or awe.stats.MetricsLogger()
+        self.taskoutputlogger = taskoutputlogger or awe.stats.MetricsLogger(path='debug/task_output.dat', buffersize=256)
+
+        self.stats  = awe.stats.WQStats(logger=self.statslogger)
 
         self.tmpdir = tempfile.mkdtemp(prefix='awe-tmp.')
 
         self.restarts = dict()
 
-        self.statslogger      = statslogger      or awe.stats.StatsLogger(buffersize=42)
-        self.taskoutputlogger = taskoutputlogger or awe.stats.StatsLogger(path='debug/task_output.log.gz', buffersize=42)
+        ### called with each successful task as it returns
+        self.task_listeners = []
 
     @property
     def empty(self):
         return self.wq.empty()
 
+    tagset = property(lambda self: self._tagset)
+
     def __getstate__(self):
         """
         SwigPyObjects cannot be pickles, so remove the underlying WorkQueue object
@@ -258,6 +571,8 @@ class WorkQueue(object):
         self.taskoutputlogger.close()
         odict = self.__dict__.copy()
         del odict['wq']
+        odict['_tasks'] = defaultdict(list)
+        odict['task_listeners'] = []
         return odict
 
     def __setstate__(self, odict):
@@ -265,6 +580,12 @@ class WorkQueue(object):
         Since SwigPyObjects are not pickleable, we just recreate the WorkQueue object from the configuration
         """
         self.__dict__.update(odict)
+        if '_policy' not in odict:
+            self._policy = self.cfg._mk_replication()
+            self._tasks  = defaultdict(list)
+            self.stats.execution_times = deque(maxlen=1000)
+        if 'blobs' not in odict:
+            self.blobs = BlobCache()
         self.statslogger.open()
         self.taskoutputlogger.open()
 
@@ -274,13 +595,14 @@ class WorkQueue(object):
         shutil.rmtree(self.tmpdir)
 
 
-    @awe.typecheck(WQ.Task)
+    @awe.typecheck(TASK_TYPES)
+    @instrument.instrumented('task stats')
     def update_task_stats(self, task):
         self.stats.task(task)
 
     def new_task(self):
         cmd = self.cfg.executable.remotepath
-        task = WQ.Task('./' + cmd)
+        task = self.wq.new_task('./' + cmd)
 
         ### executable
         self.cfg.executable.add_to_task(task)
@@ -291,12 +613,32 @@ class WorkQueue(object):
 
         return task
 
-    @awe.typecheck(WQ.Task)
+    @awe.typecheck(TASK_TYPES)
+    @instrument.instrumented('wq.submit')
     def submit(self, task):
         self._tagset.add(task.tag)
+        self._policy.submitted(task.tag)
+
+        ### keep replicas (and restarts) away from the hosts already running the tag
+        tasks = self._tasks[task.tag]
+        hosts = set(t.host for t in tasks if t.host)
+        if hosts:
+            self.wq.avoid_hosts(task, hosts)
+        tasks[:] = [t for t in tasks if t is not task] + [task]
+
         return self.wq.submit(task)
 
-    @awe.typecheck(WQ.Task)
+    def started(self, tag):
+        """
+        When the latest task with *tag* was dispatched (in seconds since
+        the epoch), None if it is still waiting for a worker
+        """
+        tasks = self._tasks.get(tag)
+        if not tasks or not tasks[-1].send_input_start:
+            return None
+        return tasks[-1].send_input_start / 10.**6
+
+    @awe.typecheck(TASK_TYPES)
     def restart(self, task):
         if task.tag not in self.restarts:
             self.restarts[task.tag] = 0
@@ -312,6 +654,7 @@ class WorkQueue(object):
         else:
             return False
 
+    @instrument.instrumented('wait')
     def wait(self, *args, **kws):
         return self.wq.wait(*args, **kws)
 
@@ -326,23 +669,65 @@ class WorkQueue(object):
 
     def discard_tag(self, tagtext):
         self._tagset.discard(tagtext)
+        self._policy.discard(tagtext)
+        self._tasks.pop(tagtext, None)
+        for name in self.blobs.release(tagtext):
+            self.wq.invalidate_cache_file(name)
+
+    def retire_tag(self, tagtext):
+        """
+        Stop replicating *tagtext*, whose result is back but not loaded
+        yet.  Its tasks and blobs are kept until discard_tag, and a
+        restart tracks it again.
+        """
+        self._tagset.discard(tagtext)
+        self._policy.discard(tagtext)
+
+    def stage_blob(self, task, data):
+        """
+        Add *data* to *task* as a content-addressed cached input (see
+        BlobCache).  Returns its digest.
+        """
+        return self.blobs.stage(task, data)
+
+    def log_staging(self):
+        """
+        Log the bytes of the blobs staged since the last call
+        """
+        self.stats.staging(self.blobs.unique, self.blobs.shared)
+        self.blobs.reset()
 
     def cancel_tag(self, tagtext):
         while self.wq.cancel_by_tasktag(tagtext):
             pass
 
     def select_tag(self):
-        self._tagset.clean()
-        return self._tagset.select()
+        """
+        The tag of the task to replicate, chosen by the replication policy
+        """
+        return self._policy.select(self)
 
     def clear_tags(self):
         self._tagset.clear()
+        self._tasks.clear()
+        self._policy = self.cfg._mk_replication()
 
     def clear(self):
+        self.log_staging()
         self.clear_tags()
 
         # force clearing to allow GC, otherwise linear memory growth
-        self.wq._task_table.clear()
+        self.wq.clear()
+
+    def clear_completed(self):
+        """
+        Like clear, but for the completed tasks only: the tags, tasks and
+        blobs of the running ones are kept.  For pipelined iterations,
+        which never wait for every task.
+        """
+        self.log_staging()
+        self.restarts = dict((tag, n) for tag, n in self.restarts.iteritems() if tag in self._tasks)
+        self.wq.clear(running=[task for tasks in self._tasks.itervalues() for task in tasks])
 
     def tasks_in_queue(self):
         return self.wq.stats.tasks_running + self.wq.stats.tasks_waiting
@@ -355,6 +740,45 @@ class WorkQueue(object):
             and self._tagset.can_duplicate()
 
 
+    @instrument.instrumented('received')
+    def _received(self, task):
+        """
+        Log the output of a returned *task* and resubmit it if it failed.
+        Returns True if its result should be loaded.
+        """
+        self.update_task_stats(task)
+        # print time.asctime(), 'Received result. %d tasks remaining in iteration.' % self.tasks_in_queue()
+
+        t = time.time()
+        self.taskoutputlogger.update(t, 'TASK', 'tag'   , task.tag)
+        self.taskoutputlogger.update(t, 'TASK', 'output', task.output)
+
+        if task.result == 0:
+
+            if not task.return_status == 0 and not self.restart(task):
+                raise WorkQueueWorkerException, \
+                    self.taskoutput(task) + '\n\nTask %s failed with %d' % (task.tag, task.return_status)
+
+            if task.return_status == 0:
+                for listener in self.task_listeners:
+                    listener(task)
+            return True
+
+        elif not self.restart(task):
+            raise WorkQueueException, 'Task exceeded maximum number of resubmissions for %s\n\n%s' % \
+                (task.tag, self.taskoutput(task))
+
+        return False
+
+    def _load_failed(self, task, ex):
+        """
+        Sometimes a task fails, but still returns.  Attempt to restart these.
+        """
+        if not self.restart(task):
+            raise WorkQueueException, \
+                self.taskoutput(task) + '\n\nMaster failed: could not load resultfile:\n %s: %s\n\n%s' % \
+                (ex.__class__.__name__, ex, traceback.format_exc())
+
     def recv(self, marshall):
 
         # print time.asctime(), 'waiting for task'
@@ -362,41 +786,72 @@ class WorkQueue(object):
 
             task = self.wait(self.cfg.waittime)
 
-            if task:
-                self.update_task_stats(task)
-                # print time.asctime(), 'Received result. %d tasks remaining in iteration.' % self.tasks_in_queue()
-
-                self.taskoutputlogger.output("<====== WQ: START task %s output ======>\n" % task.tag)
-                self.taskoutputlogger.output(task.output)
-                self.taskoutputlogger.output("<====== WQ: END task %s output ======>\n"   % task.tag)
+            if not task or not self._received(task):
+                continue
 
-            if task and task.result == 0:
+            try:
+                result = marshall(task)
+            except Exception, ex:
+                self._load_failed(task, ex)
+                continue
 
-                if not task.return_status == 0 and not self.restart(task):
-                    raise WorkQueueWorkerException, \
-                        self.taskoutput(task) + '\n\nTask %s failed with %d' % (task.tag, task.return_status)
+            self.cancel_tag(task.tag)
+            self.discard_tag(task.tag)
+            return result
 
+    def recv_batches(self, decode, pool, batchsize=64):
+        """
+        Receive results until no task is left, decoding them concurrently.
+
+        Each successful task is handed to *pool* (a multiprocessing.Pool)
+        as soon as it returns, which runs *decode*(task.tag) returning a
+        list of results.  Yields the results of at most *batchsize* tasks
+        at a time, in the order the tasks returned.  At most *batchsize*
+        tasks are received between batches, so batches are handed back
+        while tasks keep returning.  Tasks may be submitted between
+        batches.
+        """
 
+        pending  = deque()     # (task, AsyncResult, submission time)
+        received = 0
+        waited   = 0.
+
+        while not self.empty or pending:
+
+            for _ in xrange(batchsize):
+                if self.empty: break
+                t0   = time.time()
+                task = self.wait(0 if pending else self.cfg.waittime)
+                if not task: break
+                received += 1
+                waited   += time.time() - t0
+                if self._received(task):
+                    ### other replicas would overwrite the result being decoded
+                    self.cancel_tag(task.tag)
+                    self.retire_tag(task.tag)
+                    pending.append((task, pool.apply_async(decode, (task.tag,)), time.time()))
+
+            if not pending: continue
+            pending[0][1].wait(0.05)
+
+            batch   = []
+            ntasks  = 0
+            decoded = 0.
+            while pending and pending[0][1].ready() and ntasks < batchsize:
+                task, result, t0 = pending.popleft()
+                decoded += time.time() - t0
                 try:
-                    result = marshall(task)
+                    batch.extend(result.get())
+                    ntasks += 1
                 except Exception, ex:
-
-                    ### sometimes a task fails, but still returns.
-                    ##+ attempt to restart these
-                    if not self.restart(task):
-                        raise WorkQueueException, \
-                            self.taskoutput(task) + '\n\nMaster failed: could not load resultfile:\n %s: %s\n\n%s' % \
-                            (ex.__class__.__name__, ex, traceback.format_exc())
-                    else:
-                        continue
-
-                self.cancel_tag(task.tag)
+                    self._load_failed(task, ex)
+                    continue
                 self.discard_tag(task.tag)
-                return result
 
-            elif task and not task.result == 0:
-                if not self.restart(task):
-                    raise WorkQueueException, 'Task exceeded maximum number of resubmissions for %s\n\n%s' % \
-                        (task.tag, self.taskoutput(task))
+            if received:
+                self.stats.ingest('receive', received, waited)
+                received, waited = 0, 0.
 
-            else: continue
+            if batch:
+                self.stats.ingest('decode', len(batch), decoded)
+                yield batch
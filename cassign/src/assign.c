@@ -54,36 +54,343 @@ exit_t load_atomindices (const char *mndxpath, gsl_vector **target) {
 
 
 
+/* the rmsd between cell c and the centered structure */
+static double cell_rmsd (const celldata *cells, const size_t c, const structure_t *structure) {
+  return theobald_rmsd (cells->cells[c].data, cells->norms[c], structure->coords, structure->norm, cells->ncoords);
+}
+
+/* the distance between two cells, to build the index */
+static double cell_pair_rmsd (size_t i, size_t j, void *ctx) {
+  const celldata *cells = (const celldata*) ctx;
+  const structure_t cell = { cells->cells[j].data, cells->norms[j] };
+  return cell_rmsd (cells, i, &cell);
+}
+
+typedef struct {
+  const celldata    *cells;
+  const structure_t *structure;
+} rmsd_query;
+
+/* the distance from the structure to a cell, the same as the scan computes */
+static double cell_query_rmsd (size_t c, void *ctx) {
+  const rmsd_query *query = (const rmsd_query*) ctx;
+  return cell_rmsd (query->cells, c, query->structure);
+}
+
+structure_t center_structure_coords (gsl_matrix *coords) {
+  assert (coords->size2 == 3 && coords->tda == 3);
+  double centroid[3];
+  const double norm = theobald_center (coords->data, coords->size1, centroid);
+  const structure_t structure = { coords->data, norm };
+  return structure;
+}
+
+uint64_t cells_fingerprint (const celldata *cells) {
+  const uint64_t shape[3] = { cells->ncells, cells->ncoords, cells->ndims };
+  uint64_t hash = vptree_fingerprint (VPTREE_FINGERPRINT_INIT, shape, sizeof(shape));
+  for (size_t c=0; c<cells->ncells; c++) {
+    for (size_t r=0; r<cells->ncoords; r++) {
+      for (size_t d=0; d<cells->ndims; d++) {
+	const double v = celldata_get_value (cells, c, r, d);
+	hash = vptree_fingerprint (hash, &v, sizeof(v));
+      }}}
+  return hash;
+}
+
+int assign_scan (const celldata *cells, const structure_t *structure, double *minrmsd, double *maxrmsd) {
+  int assignment = 0;
+  *minrmsd = DBL_MAX;
+  *maxrmsd = -1;
+  for (int c=0; c<cells->ncells; c++) {
+    const double rmsd = cell_rmsd (cells, c, structure);
+    if (rmsd < *minrmsd) {
+      *minrmsd = rmsd;
+      assignment = c;
+    }
+    if (rmsd > *maxrmsd ) { *maxrmsd = rmsd; }
+  }
+  return assignment;
+}
+
+int assign_indexed (const celldata *cells, const vptree *tree, const structure_t *structure, double *minrmsd, size_t *ncomputed) {
+  rmsd_query query = { cells, structure };
+  return (int) vptree_nearest (tree, cell_query_rmsd, &query, minrmsd, ncomputed);
+}
+
+size_t assign_top (const celldata *cells, const vptree *tree, const structure_t *structure, const size_t k,
+		   size_t *top, double *rmsds, size_t *ncomputed) {
+  rmsd_query query = { cells, structure };
+  if (tree != NULL) {
+    return vptree_knearest (tree, cell_query_rmsd, &query, k, top, rmsds, ncomputed);
+  }
+  *ncomputed = cells->ncells;
+  return vptree_scan (cells->ncells, cell_query_rmsd, &query, k, top, rmsds);
+}
+
+exit_t save_top (const char *path, const size_t *top, const double *rmsds, const size_t n) {
+  FILE *file = fopen (path, "wb");
+  if (file == NULL) { return exitPATH_NOT_FOUND; }
+
+  exit_t status = exitOK;
+  for (size_t i=0; i<n; i++) {
+    /* little endian on the hosts AWE runs on */
+    const int32_t cell = (int32_t) top[i];
+    const float   rmsd = (float) rmsds[i];
+    if (fwrite (&cell, sizeof(int32_t), 1, file) != 1 ||
+	fwrite (&rmsd, sizeof(float),   1, file) != 1)
+      { status = exitFAILURE; break; }
+  }
+
+  if (fclose (file) != 0) { status = exitFAILURE; }
+  return status;
+}
+
+
+/* the cells with the selected atoms, centered */
+celldata* load_cells (const char *cells_file, const char *cell_ndx_file) {
+  celldata *cell_data, *newcells;
+  gsl_vector *cell_indices;
+
+  celldata_load_file (cells_file, &cell_data);
+  if (load_atomindices (cell_ndx_file, &cell_indices) != exitOK) {
+    printf ("Could not load the cell atom indices from %s\n", cell_ndx_file);
+    exit (EXIT_FAILURE);
+  }
+  celldata_get_rows (cell_data, cell_indices, &newcells);
+  celldata_center (newcells, cell_data, cell_indices);
+  return newcells;
+}
+
+/* the index of the cells, or NULL if it was built over other cells */
+vptree* load_index (const char *index_file, const celldata *cells) {
+  vptree *tree;
+  if (vptree_load (index_file, &tree) != exitOK) {
+    printf ("~> Cannot read cell index %s: scanning every cell\n", index_file);
+    return NULL;
+  }
+  if (tree->npoints != cells->ncells || tree->fingerprint != cells_fingerprint (cells)) {
+    printf ("~> Cell index %s does not match the cells: scanning every cell\n", index_file);
+    vptree_free (tree);
+    return NULL;
+  }
+  return tree;
+}
+
+
+int build_index (const char *cells_file, const char *cell_ndx_file, const char *index_file) {
+  celldata *cells = load_cells (cells_file, cell_ndx_file);
+
+  printf ("~> Building the index of %lu cells\n", cells->ncells);
+  const clock_t t0 = clock ();
+  vptree *tree;
+  vptree_build (cells->ncells, cell_pair_rmsd, cells, &tree);
+  tree->fingerprint = cells_fingerprint (cells);
+  printf ("~> Built in %.3f s\n", (double) (clock () - t0) / CLOCKS_PER_SEC);
+
+  if (vptree_save (tree, index_file) != exitOK) {
+    char emsg[50];
+    sprintf (emsg, "Could not write: %s\n", index_file);
+    perror (emsg);
+    exit (EXIT_FAILURE);
+  }
+  printf ("~> Saved cell index to: %s\n", index_file);
+  exit (EXIT_SUCCESS);
+}
+
+/* a uniform number in [-1, 1) */
+static double benchmark_noise (uint64_t *state) {
+  *state = *state * 6364136223846793005ULL + 1442695040888963407ULL;
+  return (double) (*state >> 11) / 4503599627370496.0 - 1;
+}
+
+#define BENCHMARK_TOP 5
+
+/**
+   Assign *nqueries* structures, made by perturbing the cells, by
+   scanning the cells and with the index, checking that both agree,
+   also on the BENCHMARK_TOP nearest cells.
+ */
+int benchmark (const char *cells_file, const char *cell_ndx_file, const char *index_file, const int nqueries) {
+  celldata *cells = load_cells (cells_file, cell_ndx_file);
+  vptree *tree = load_index (index_file, cells);
+  if (tree == NULL) { exit (EXIT_FAILURE); }
+
+  uint64_t state = 42;
+  gsl_matrix *coords = gsl_matrix_alloc (cells->ncoords, cells->ndims);
+  double tscan = 0, tindex = 0;
+  size_t ncomputed = 0;
+  int mismatches = 0;
+
+  for (int q=0; q<nqueries; q++) {
+    const cell_t cell = celldata_get_cell (cells, (size_t) q * cells->ncells / nqueries);
+    for (size_t r=0; r<cells->ncoords; r++) {
+      for (size_t d=0; d<cells->ndims; d++) {
+	gsl_matrix_set (coords, r, d, gsl_matrix_get (&cell, r, d) + 0.05 * benchmark_noise (&state));
+      }}
+
+    const structure_t structure = center_structure_coords (coords);
+
+    double minscan, maxscan, minindex;
+    size_t n;
+    clock_t t0 = clock ();
+    const int a = assign_scan (cells, &structure, &minscan, &maxscan);
+    tscan += clock () - t0;
+
+    t0 = clock ();
+    const int b = assign_indexed (cells, tree, &structure, &minindex, &n);
+    tindex += clock () - t0;
+    ncomputed += n;
+
+    if (a != b) {
+      printf ("~> Mismatch for query %d: scan = %d (%f) index = %d (%f)\n", q, a, minscan, b, minindex);
+      mismatches ++;
+    }
+
+    /* and the same nearest cells */
+    size_t topscan[BENCHMARK_TOP], topindex[BENCHMARK_TOP], nscan, nindex, m;
+    double dscan[BENCHMARK_TOP], dindex[BENCHMARK_TOP];
+    nscan  = assign_top (cells, NULL, &structure, BENCHMARK_TOP, topscan,  dscan,  &m);
+    nindex = assign_top (cells, tree, &structure, BENCHMARK_TOP, topindex, dindex, &m);
+    if (nscan != nindex || memcmp (topscan, topindex, nscan * sizeof(size_t)) != 0) {
+      printf ("~> Mismatch of the %d nearest cells for query %d\n", BENCHMARK_TOP, q);
+      mismatches ++;
+    }
+  }
+
+  printf ("ncells %lu queries %d scan_ms %.3f index_ms %.3f rmsds %.1f mismatches %d\n",
+	  cells->ncells, nqueries,
+	  1000 * tscan  / CLOCKS_PER_SEC / nqueries,
+	  1000 * tindex / CLOCKS_PER_SEC / nqueries,
+	  (double) ncomputed / nqueries, mismatches);
+  exit (mismatches == 0 ? EXIT_SUCCESS : EXIT_FAILURE);
+}
+
+
+void runlength_push (runlength *rle, const int cell) {
+  if (rle->count > 0 && cell == rle->cell) {
+    rle->count ++;
+    return;
+  }
+  runlength_flush (rle);
+  rle->cell  = cell;
+  rle->count = 1;
+}
+
+void runlength_flush (runlength *rle) {
+  if (rle->count == 0) return;
+  if (fwrite (&rle->cell, sizeof(int32_t), 1, rle->file) != 1 ||
+      fwrite (&rle->count, sizeof(int32_t), 1, rle->file) != 1) {
+    perror ("Could not write the frame assignments");
+    exit (EXIT_FAILURE);
+  }
+  rle->nruns ++;
+  rle->count = 0;
+}
+
+xdrframe* assign_frames (const celldata *cells, const vptree *tree, const char *xtc_file, const gsl_vector *xtc_indices,
+			 const char *frames_file) {
+  xdrstream *stream;
+  if (xdrstream_open (xtc_file, &stream) != exdrOK) { exit (EXIT_FAILURE); }
+
+  runlength rle = { fopen (frames_file, "wb"), 0, 0, 0 };
+  if (rle.file == NULL) {
+    char emsg[50];
+    sprintf (emsg, "Could not open for writing: %s\n", frames_file);
+    perror (emsg);
+    exit (EXIT_FAILURE);
+  }
+
+  xdrframe *frame;
+  xdrframe_init (&frame, xtc_indices->size);
+
+  printf ("~> Assigning every frame%s...\n", tree != NULL ? " with the cell index" : "");
+  size_t ncomputed = 0;
+  while (xdrstream_next (stream) == exdrOK) {
+    xdrframe_select_rvec (stream->x, xtc_indices, frame);
+    const structure_t structure = center_structure_coords (frame->coords);
+
+    int assignment;
+    double minrmsd, maxrmsd;
+    size_t n = cells->ncells;
+    if (tree != NULL) { assignment = assign_indexed (cells, tree, &structure, &minrmsd, &n); }
+    else              { assignment = assign_scan (cells, &structure, &minrmsd, &maxrmsd); }
+    ncomputed += n;
+    runlength_push (&rle, assignment);
+  }
+  runlength_flush (&rle);
+
+  if (stream->frames == 0) {
+    printf ("~> No frames in: %s\n", xtc_file);
+    exit (EXIT_FAILURE);
+  }
+  printf ("~> Assigned %lu frames to %lu runs of cells, %.1f rmsds per frame\n",
+	  stream->frames, rle.nruns, (double) ncomputed / stream->frames);
+  printf ("~> Saved frame assignments to: %s\n", frames_file);
+
+  fclose (rle.file);
+  xdrstream_close (stream);
+  return frame;
+}
+
+
+void usage (const char *name) {
+  printf ("USAGE: %s [--top <k> <top output>] [--frames <frames output>] <cells> <cell atom indices> <xtc> <xtc atom indices> <output> [<cell index>]\n", name);
+  printf ("       %s --build-index <cells> <cell atom indices> <cell index>\n", name);
+  printf ("       %s --benchmark <cells> <cell atom indices> <cell index> [<queries>]\n", name);
+  exit (EXIT_FAILURE);
+}
+
+
 int main (int argc, char *argv[]) {
 
+  if (argc > 1 && strcmp (argv[1], "--build-index") == 0) {
+    if (argc != 5) { usage (argv[0]); }
+    return build_index (argv[2], argv[3], argv[4]);
+  }
+
+  if (argc > 1 && strcmp (argv[1], "--benchmark") == 0) {
+    if (argc != 5 && argc != 6) { usage (argv[0]); }
+    return benchmark (argv[2], argv[3], argv[4], argc == 6 ? atoi (argv[5]) : 100);
+  }
+
+  /* also write the k nearest cells and their rmsds, and the cell of every frame */
+  size_t topk = 0;
+  const char *top_file = NULL, *frames_file = NULL;
+  while (argc > 1 && strncmp (argv[1], "--", 2) == 0) {
+    if (strcmp (argv[1], "--top") == 0) {
+      if (argc < 4 || atoi (argv[2]) < 1) { usage (argv[0]); }
+      topk     = atoi (argv[2]);
+      top_file = argv[3];
+      argv += 3;
+      argc -= 3;
+    }
+    else if (strcmp (argv[1], "--frames") == 0) {
+      if (argc < 3) { usage (argv[0]); }
+      frames_file = argv[2];
+      argv += 2;
+      argc -= 2;
+    }
+    else { usage (argv[0]); }
+  }
+
+  if (argc != 6 && argc != 7) { usage (argv[0]); }
+
   const char
     *cells_file    = argv[1], //"Gens.dat",
     *cell_ndx_file = argv[2], //"AtomIndices.dat",
     *xtc_file      = argv[3], //"traj.xtc",
     *xtc_ndx_file  = argv[4], //"AtomIndices.dat",
-    *out_file      = argv[5]; //"cell2.dat";
+    *out_file      = argv[5], //"cell2.dat";
+    *index_file    = argc == 7 ? argv[6] : NULL; //"cells.vpt"
 
   printf ("~> Cells file: %s\n", cells_file);
   printf ("~> Xtc file: %s\n", xtc_file);
 
-  celldata* cell_data;
-  xdrframe* frame;
-  gsl_vector *cell_indices, *xtc_indices;
-
-  celldata_load_file (cells_file, &cell_data);
-  load_atomindices (cell_ndx_file, &cell_indices);
-  printf ("~> Cell Atom Indices: ");
-  gsl_vector_printf (cell_indices);
-  printf ("\n");
-
+  gsl_vector *xtc_indices;
 
+  celldata *newcells = load_cells (cells_file, cell_ndx_file);
   printf ("~> Loaded cells: ");
-  celldata_printinfo (cell_data);
-  printf ("\n");
-
-  xdrframe_last_in_xtc (xtc_file, &frame);
-
-  xdrframe_printsummary (frame);
+  celldata_printinfo (newcells);
   printf ("\n");
 
   load_atomindices (xtc_ndx_file, &xtc_indices);
@@ -91,44 +398,69 @@ int main (int argc, char *argv[]) {
   gsl_vector_printf (xtc_indices);
   printf ("\n");
 
-  celldata *newcells;
+  if (newcells->ncoords != xtc_indices->size) {
+    printf ("Number of atoms mismatch after selecting atom indices: cell = %lu structure = %lu\n", newcells->ncoords, xtc_indices->size);
+    exit (1);
+  }
+
+  vptree *tree = index_file != NULL ? load_index (index_file, newcells) : NULL;
+
   xdrframe *newframe;
-  celldata_get_rows (cell_data, cell_indices, &newcells);
-  xdrframe_select_atoms (frame, xtc_indices , &newframe);
+  if (frames_file != NULL) {
+    newframe = assign_frames (newcells, tree, xtc_file, xtc_indices, frames_file);
+  }
+  else {
+    xdrframe* frame;
+    xdrframe_last_in_xtc (xtc_file, &frame);
 
-  if (newcells->ncoords != newframe->natoms) {
-    printf ("Number of atoms mismatch after selecting atom indices: cell = %lu structure = %lu\n", newcells->ncoords, newframe->natoms);
-    exit (1);
+    xdrframe_printsummary (frame);
+    printf ("\n");
+
+    xdrframe_select_atoms (frame, xtc_indices , &newframe);
   }
 
-  printf ("~> Using: ");
-  celldata_printinfo (newcells);
-  printf ("\n");
   printf ("~> Using: ");
   xdrframe_printsummary (newframe);
   printf ("\n");
-  
 
-  printf ("~> Computing rmsds...\n");
-  int assignment = 0;
-  double
-    minrmsd = DBL_MAX,
-    maxrmsd = -1;
-  int asns = 0;
-  for (int c=0; c<cell_data->ncells; c++) {
-    const gsl_matrix cell = celldata_get_cell (newcells, c);
-    const gsl_matrix *coords = newframe->coords;
-    const double rmsd = compute_rmsd (&cell, coords);
-    printf ("~~> rmsd to cell %3d: %8.5f\n", c, rmsd);
-    if (rmsd < minrmsd) {
-      minrmsd = rmsd;
-      assignment = c;
-      asns ++;
+  const structure_t structure = center_structure_coords (newframe->coords);
+
+  int assignment;
+  double minrmsd;
+  if (topk > 0) {
+    size_t *top = (size_t*) malloc (topk * sizeof(size_t)), ncomputed;
+    double *rmsds = (double*) malloc (topk * sizeof(double));
+    printf ("~> Computing the %lu nearest cells...\n", topk);
+    const size_t n = assign_top (newcells, tree, &structure, topk, top, rmsds, &ncomputed);
+    assignment = (int) top[0];
+    minrmsd    = rmsds[0];
+    printf ("~> Assignment: %d rmsds computed: %lu of %lu\n", assignment, ncomputed, newcells->ncells);
+    printf ("~> minrmsd: %f\n", minrmsd);
+
+    printf ("~> Saving %lu nearest cells to: %s\n", n, top_file);
+    if (save_top (top_file, top, rmsds, n) != exitOK) {
+      char emsg[50];
+      sprintf (emsg, "Could not write: %s\n", top_file);
+      perror (emsg);
+      exit (EXIT_FAILURE);
     }
-    if (rmsd > maxrmsd ) { maxrmsd = rmsd; }
+    free (top);
+    free (rmsds);
+  }
+  else if (tree != NULL) {
+    size_t ncomputed;
+    printf ("~> Searching the cell index %s...\n", index_file);
+    assignment = assign_indexed (newcells, tree, &structure, &minrmsd, &ncomputed);
+    printf ("~> Assignment: %d rmsds computed: %lu of %lu\n", assignment, ncomputed, newcells->ncells);
+    printf ("~> minrmsd: %f\n", minrmsd);
+  }
+  else {
+    double maxrmsd;
+    printf ("~> Computing rmsds...\n");
+    assignment = assign_scan (newcells, &structure, &minrmsd, &maxrmsd);
+    printf ("~> Assignment: %d\n", assignment);
+    printf ("~> minrmsd: %f maxrmsd: %f\n", minrmsd, maxrmsd);
   }
-  printf ("~> Assignment: %d jumps: %d\n", assignment, asns);
-  printf ("~> minrmsd: %f maxrmsd: %f\n", minrmsd, maxrmsd);
 
 
   printf ("~> Saving assignment to: %s\n", out_file);
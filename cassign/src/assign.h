@@ -5,6 +5,8 @@
 #include "xdr_util.h"
 #include "rmsd_calc.h"
 #include "gsl_util.h"
+#include "vptree.h"
+#include "theobald_rmsd.h"
 
 #include <gsl/gsl_vector.h>
 #include <gsl/gsl_vector.h>
@@ -16,11 +18,69 @@
 #include <string.h>
 #include <stddef.h>
 #include <assert.h>
+#include <stdint.h>
+#include <time.h>
 
 
 
 exit_t load_atomindices (const char *mndxpath, gsl_vector **target);
 
+/* centered coordinates, row-major natoms x 3, and their squared norm */
+typedef struct {
+  const double *coords;
+  double        norm;
+} structure_t;
+
+/* center the coordinates in place */
+structure_t center_structure_coords (gsl_matrix *coords);
+
+uint64_t cells_fingerprint (const celldata *cells);
+
+/* the nearest cell by computing the rmsd to every cell */
+int assign_scan (const celldata *cells, const structure_t *structure, double *minrmsd, double *maxrmsd);
+
+/* the same cell as assign_scan, searching the index of the cells */
+int assign_indexed (const celldata *cells, const vptree *tree, const structure_t *structure, double *minrmsd, size_t *ncomputed);
+
+/**
+   The *k* nearest cells and their rmsds, nearest first and ties to the
+   lowest cell, searching the index if *tree* is not NULL.  Returns
+   their number, less than *k* if there are fewer cells.
+ */
+size_t assign_top (const celldata *cells, const vptree *tree, const structure_t *structure, const size_t k,
+		   size_t *top, double *rmsds, size_t *ncomputed);
+
+/**
+   Write the nearest cells as given by assign_top to *path*, one record
+   per cell, nearest first (little endian):
+       int32   cell
+       float32 rmsd
+ */
+exit_t save_top (const char *path, const size_t *top, const double *rmsds, const size_t n);
+
+/**
+   The cells of consecutive frames, written as runs of one cell (little
+   endian):
+       int32 cell
+       int32 count    number of consecutive frames in the cell
+ */
+typedef struct {
+  FILE   *file;
+  int32_t cell, count;
+  size_t  nruns;
+} runlength;
+
+void runlength_push  (runlength *rle, const int cell);
+void runlength_flush (runlength *rle);
+
+/**
+   Assign every frame of the xtc file, reading one frame at a time, and
+   write the runs of their cells to *frames_file*.  Returns the last
+   frame, centered.
+ */
+xdrframe* assign_frames (const celldata *cells, const vptree *tree, const char *xtc_file, const gsl_vector *xtc_indices,
+			 const char *frames_file);
+
 
 
 
@@ -2,10 +2,16 @@
 #define _CELLDATA_C_
 
 #include "celldata.h"
+#include "theobald_rmsd.h"
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 
 celldata* celldata_alloc () {
-  return (celldata*) malloc (sizeof(celldata));
+  return (celldata*) calloc (1, sizeof(celldata));
 }
 
 void celldata_init (celldata** data, const size_t ncells, const size_t ncoords, const size_t ndims) {
@@ -25,6 +31,7 @@ void celldata_init (celldata** data, const size_t ncells, const size_t ncoords,
 
 cell_t celldata_get_cell (const celldata* data, const size_t cell) {
   assert (cell < data->ncells);
+  assert (data->cells != NULL);
   return data->cells[cell];
 }
 
@@ -34,6 +41,9 @@ vector_t celldata_get_coords (const celldata* data, const size_t cell, const siz
 }
 
 double celldata_get_value (const celldata* data, const size_t cell, const size_t coord, const size_t dim) {
+  if (data->mapped != NULL) {
+    return data->mapped[(cell * data->ncoords + coord) * data->ndims + dim];
+  }
   cell_t *mat = &data->cells[cell];
   return gsl_matrix_get (mat, coord, dim);
 }
@@ -55,8 +65,74 @@ void celldata_printf (const celldata* cells) {
   }
 }
 
+static size_t celldata_align8 (const size_t n) {
+  return (n + 7) / 8 * 8;
+}
+
+exit_t celldata_map_file (const char* path, celldata** data) {
+  const int fd = open (path, O_RDONLY);
+  if (fd < 0) { return exitPATH_NOT_FOUND; }
+
+  struct stat st;
+  if (fstat (fd, &st) != 0 || st.st_size < CELLS_HEADER) {
+    close (fd);
+    return exitCELLS_HEADER;
+  }
+
+  void *map = mmap (NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+  close (fd);
+  if (map == MAP_FAILED) { return exitFAILURE; }
+
+  const char *bytes = (const char*) map;
+  uint32_t version;
+  uint64_t shape[3];
+  memcpy (&version, bytes + 4, sizeof(version));
+  memcpy (shape, bytes + 8, sizeof(shape));
+
+  const size_t
+    ncoords   = shape[0] * shape[1] * shape[2],
+    centroids = celldata_align8 (CELLS_HEADER + ncoords * sizeof(float)),
+    norms     = centroids + shape[0] * shape[2] * sizeof(double),
+    size      = norms + shape[0] * sizeof(double);
+
+  if (memcmp (bytes, CELLS_MAGIC, 4) != 0 || version != CELLS_VERSION || (size_t) st.st_size != size) {
+    munmap (map, st.st_size);
+    return exitCELLS_HEADER;
+  }
+
+  printf("ncells = %lu ncoords = %lu ndims = %lu\n", shape[0], shape[1], shape[2]);
+  *data = celldata_alloc ();
+  (*data)->ncells    = shape[0];
+  (*data)->ncoords   = shape[1];
+  (*data)->ndims     = shape[2];
+  (*data)->mapped    = (const float*)  (bytes + CELLS_HEADER);
+  (*data)->centroids = (const double*) (bytes + centroids);
+  (*data)->filenorms = (const double*) (bytes + norms);
+  (*data)->map       = map;
+  (*data)->mapsize   = st.st_size;
+
+  return exitOK;
+}
+
 exit_t celldata_load_file (const char* path, celldata** data) {
 
+  /* binary files are mapped */
+  FILE *probe = fopen (path, "rb");
+  if (probe != NULL) {
+    char magic[4];
+    const int binary = fread (magic, 1, 4, probe) == 4 && memcmp (magic, CELLS_MAGIC, 4) == 0;
+    fclose (probe);
+    if (binary) {
+      printf ("Mapping binary cells file\n");
+      const exit_t status = celldata_map_file (path, data);
+      if (status != exitOK) {
+	printf ("Failed to map %s: %s\n", path, exit_message[status]);
+	exit (EXIT_FAILURE);
+      }
+      return exitOK;
+    }
+  }
+
   int BUFFER_SIZE = 100;
   char buffer [BUFFER_SIZE];
   int ncells, ncoords, ndims;
@@ -158,14 +234,53 @@ exit_t celldata_get_rows (const celldata *cells, const vector_t *atomindices, ce
   assert (atomindices->size <= cells->ncoords);
   celldata_init (newcells, cells->ncells, atomindices->size, cells->ndims);
 
+  /* by value, so that only the selected atoms of a mapped file are read */
   for (int cid=0; cid<cells->ncells; cid++) {
-    const cell_t oldcell = celldata_get_cell (cells, cid);
-    cell_t *newcell;
-    gsl_matrix_get_rows (&oldcell, atomindices, &newcell);
-    celldata_set_cell (*newcells, cid, newcell);
+    for (int i=0; i<atomindices->size; i++) {
+      const size_t r = gsl_vector_get (atomindices, i);
+      assert (r < cells->ncoords);
+      for (int d=0; d<cells->ndims; d++) {
+	celldata_set_value (*newcells, cid, i, d, celldata_get_value (cells, cid, r, d));
+      }}
   }
 
   return exitOK;
-}  
+}
+
+static int celldata_all_rows (const celldata *source, const vector_t *atomindices) {
+  if (atomindices->size != source->ncoords) return 0;
+  for (size_t i=0; i<atomindices->size; i++) {
+    if (gsl_vector_get (atomindices, i) != i) return 0;
+  }
+  return 1;
+}
+
+exit_t celldata_center (celldata *cells, const celldata *source, const vector_t *atomindices) {
+  assert (cells->cells != NULL);
+  assert (cells->ndims == 3);
+
+  const int precomputed = source->filenorms != NULL && celldata_all_rows (source, atomindices);
+
+  cells->norms = (double*) malloc (cells->ncells * sizeof(double));
+  for (size_t c=0; c<cells->ncells; c++) {
+    cell_t *cell = &cells->cells[c];
+    assert (cell->tda == cells->ndims);
+
+    if (precomputed) {
+      const double *centroid = source->centroids + c * cells->ndims;
+      for (size_t r=0; r<cells->ncoords; r++) {
+	for (size_t d=0; d<cells->ndims; d++) {
+	  cell->data[r * cell->tda + d] -= centroid[d];
+	}}
+      cells->norms[c] = source->filenorms[c];
+    }
+    else {
+      double centroid[3];
+      cells->norms[c] = theobald_center (cell->data, cells->ncoords, centroid);
+    }
+  }
+
+  return exitOK;
+}
 
 #endif
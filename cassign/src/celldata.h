@@ -8,12 +8,44 @@
 
 #include <assert.h>
 #include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+
+/**
+   The cells are read from a text file (a header and one value per
+   line) or from a binary file written by awe-import-gens, which is
+   mapped in memory instead of parsed:
+
+       char    magic[4]       "AWEC"
+       uint32  version        1
+       uint64  ncells, ncoords, ndims
+       (zeros up to byte 64)
+       float32 coords    [ncells][ncoords][ndims]
+       (zeros up to a multiple of 8 bytes)
+       float64 centroids [ncells][ndims]
+       float64 norms     [ncells]     squared norm of the centered coordinates
+
+   in little endian byte order.
+ */
+
+#define CELLS_MAGIC   "AWEC"
+#define CELLS_VERSION 1
+#define CELLS_HEADER  64
 
 typedef gsl_matrix cell_t;
 
 typedef struct {
   size_t ncells, ncoords, ndims;
-  cell_t *cells;
+  cell_t *cells;                   /* NULL if the coordinates are mapped */
+
+  double *norms;                   /* squared norms of the cells once centered, else NULL */
+
+  /* binary files */
+  const float  *mapped;            /* coordinates */
+  const double *centroids;
+  const double *filenorms;
+  void         *map;
+  size_t        mapsize;
 } celldata;
 
 cell_t cell_t_malloc (const size_t ncoords, const size_t ndims);
@@ -38,4 +70,11 @@ exit_t celldata_load_file (const char* path, celldata** data);
 
 exit_t celldata_get_rows (const celldata *cells, const vector_t *atomindices, celldata **newcells);
 
+/**
+   Move the centroid of each cell of *cells*, the *atomindices* of
+   *source*, to the origin and set their norms.  The centroids and
+   norms of a binary file are used if all its atoms are selected.
+ */
+exit_t celldata_center (celldata *cells, const celldata *source, const vector_t *atomindices);
+
 #endif
@@ -0,0 +1,89 @@
+#include "theobald_rmsd.h"
+
+
+#define THEOBALD_MAXITER   50
+#define THEOBALD_PRECISION 1e-11
+
+
+double theobald_center (double *coords, const size_t natoms, double centroid[3]) {
+  centroid[0] = centroid[1] = centroid[2] = 0;
+  for (size_t i=0; i<natoms; i++) {
+    for (int d=0; d<3; d++) { centroid[d] += coords[3*i+d]; }
+  }
+  for (int d=0; d<3; d++) { centroid[d] /= natoms; }
+
+  for (size_t i=0; i<natoms; i++) {
+    for (int d=0; d<3; d++) { coords[3*i+d] -= centroid[d]; }
+  }
+  return theobald_inner_product (coords, natoms);
+}
+
+double theobald_inner_product (const double *coords, const size_t natoms) {
+  double g = 0;
+  for (size_t i=0; i<3*natoms; i++) { g += coords[i] * coords[i]; }
+  return g;
+}
+
+
+double theobald_rmsd (const double *a, const double ga, const double *b, const double gb, const size_t natoms) {
+
+  /* the inner product matrix S = a' b */
+  double S[3][3] = { {0,0,0}, {0,0,0}, {0,0,0} };
+  for (size_t i=0; i<natoms; i++) {
+    const double *x = a + 3*i, *y = b + 3*i;
+    for (int r=0; r<3; r++) {
+      for (int c=0; c<3; c++) {
+	S[r][c] += x[r] * y[c];
+      }}
+  }
+
+  const double
+    Sxx = S[0][0], Sxy = S[0][1], Sxz = S[0][2],
+    Syx = S[1][0], Syy = S[1][1], Syz = S[1][2],
+    Szx = S[2][0], Szy = S[2][1], Szz = S[2][2];
+
+  const double
+    Sxx2 = Sxx * Sxx, Syy2 = Syy * Syy, Szz2 = Szz * Szz,
+    Sxy2 = Sxy * Sxy, Syz2 = Syz * Syz, Sxz2 = Sxz * Sxz,
+    Syx2 = Syx * Syx, Szy2 = Szy * Szy, Szx2 = Szx * Szx;
+
+  const double
+    SyzSzymSyySzz2      = 2.0 * (Syz * Szy - Syy * Szz),
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2,
+    Sxy2Sxz2Syx2Szx2    = Sxy2 + Sxz2 - Syx2 - Szx2,
+    SxzpSzx = Sxz + Szx, SyzpSzy = Syz + Szy, SxypSyx = Sxy + Syx,
+    SyzmSzy = Syz - Szy, SxzmSzx = Sxz - Szx, SxymSyx = Sxy - Syx,
+    SxxpSyy = Sxx + Syy, SxxmSyy = Sxx - Syy;
+
+  /* the characteristic polynomial x^4 + c2 x^2 + c1 x + c0 of the key matrix */
+  const double c2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2);
+
+  const double c1 =
+    8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx) -
+    8.0 * (Sxx * Syy * Szz + Syz * Szx * Sxy + Szy * Syx * Sxz);
+
+  const double c0 =
+    Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+    + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+    + (-(SxzpSzx) * (SyzmSzy) + (SxymSyx) * (SxxmSyy - Szz)) * (-(SxzmSzx) * (SyzpSzy) + (SxymSyx) * (SxxmSyy + Szz))
+    + (-(SxzpSzx) * (SyzpSzy) - (SxypSyx) * (SxxpSyy - Szz)) * (-(SxzmSzx) * (SyzmSzy) - (SxypSyx) * (SxxpSyy + Szz))
+    + (+(SxypSyx) * (SyzpSzy) + (SxzpSzx) * (SxxmSyy + Szz)) * (-(SxymSyx) * (SyzmSzy) + (SxzpSzx) * (SxxpSyy + Szz))
+    + (+(SxypSyx) * (SyzmSzy) + (SxzmSzx) * (SxxmSyy - Szz)) * (-(SxymSyx) * (SyzpSzy) + (SxzmSzx) * (SxxpSyy - Szz));
+
+  /* Newton's method from (ga + gb) / 2, an upper bound of the largest eigenvalue */
+  const double e0 = (ga + gb) / 2.0;
+  double lambda = e0;
+  for (int i=0; i<THEOBALD_MAXITER; i++) {
+    const double
+      old   = lambda,
+      x2    = lambda * lambda,
+      b     = (x2 + c2) * lambda,
+      a     = b + c1,
+      delta = (a * lambda + c0) / (2.0 * x2 * lambda + b + a);
+    lambda -= delta;
+    if (fabs (lambda - old) < fabs (THEOBALD_PRECISION * lambda)) break;
+  }
+
+  const double msd = 2.0 * (e0 - lambda) / natoms;
+  return msd > 0 ? sqrt (msd) : 0;
+}
@@ -0,0 +1,35 @@
+#ifndef _THEOBALD_RMSD_H_
+#define _THEOBALD_RMSD_H_
+
+#include <stddef.h>
+#include <math.h>
+
+/**
+   The rmsd after the optimal superposition of two centered structures
+   with the quaternion characteristic polynomial (QCP) method.
+
+   The rmsd follows from the largest eigenvalue of the 4x4 key matrix
+   built from the 3x3 inner product matrix of the structures, found
+   with Newton's method on its characteristic polynomial.  This is the
+   rmsd kabsch_rmsd computes, without the rotation and without any
+   allocation, and the squared norms of the structures can be computed
+   once per structure.
+
+   The coordinates are row-major natoms x 3 arrays.
+
+   References:
+     1) Theobald DL. Rapid calculation of RMSDs using a quaternion-based characteristic polynomial. Acta Cryst A 2005;61:478-480.
+     2) Liu P, Agrafiotis DK, Theobald DL. Fast determination of the optimal rotational matrix for macromolecular superpositions. J Comput Chem 2010;31:1561-1563.
+ */
+
+/* move the centroid of the coordinates to the origin, returns their squared norm */
+double theobald_center (double *coords, const size_t natoms, double centroid[3]);
+
+/* the squared norm of the centered coordinates */
+double theobald_inner_product (const double *coords, const size_t natoms);
+
+/* the rmsd between the centered *a* and *b* of squared norms *ga* and *gb* */
+double theobald_rmsd (const double *a, const double ga, const double *b, const double gb, const size_t natoms);
+
+
+#endif
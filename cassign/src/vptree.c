@@ -0,0 +1,234 @@
+#include "vptree.h"
+
+#include <float.h>
+
+
+typedef struct {
+  size_t point;
+  double dist;
+} vpitem;
+
+static int vpitem_compare (const void *a, const void *b) {
+  const vpitem
+    *x = (const vpitem*) a,
+    *y = (const vpitem*) b;
+  if (x->dist < y->dist) return -1;
+  if (x->dist > y->dist) return  1;
+  return (x->point > y->point) - (x->point < y->point);
+}
+
+
+/* build the subtree over the n items, returns its node */
+static int64_t vptree_build_node (vptree *tree, int64_t *next, vpitem *items, const size_t n, vptree_pair_fn dist, void *ctx) {
+
+  if (n == 0) return VPTREE_NONE;
+
+  const int64_t id = (*next)++;
+  vpnode *node = &tree->nodes[id];
+
+  /* the items come sorted by their distance to the parent vantage
+     point: the last one is on the boundary of the set, which makes a
+     good vantage point */
+  const size_t m = n - 1;
+  node->point = items[m].point;
+
+  for (size_t i=0; i<m; i++) {
+    items[i].dist = dist (node->point, items[i].point, ctx);
+  }
+  qsort (items, m, sizeof(vpitem), vpitem_compare);
+
+  const size_t half = m / 2;
+  node->inside_lo  = half > 0 ? items[0].dist        : 0;
+  node->inside_hi  = half > 0 ? items[half-1].dist   : 0;
+  node->outside_lo = m > half ? items[half].dist     : 0;
+  node->outside_hi = m > half ? items[m-1].dist      : 0;
+
+  const int64_t inside  = vptree_build_node (tree, next, items,        half,     dist, ctx);
+  const int64_t outside = vptree_build_node (tree, next, items + half, m - half, dist, ctx);
+  tree->nodes[id].inside  = inside;
+  tree->nodes[id].outside = outside;
+
+  return id;
+}
+
+exit_t vptree_build (const size_t npoints, vptree_pair_fn dist, void *ctx, vptree **tree) {
+
+  *tree = (vptree*) malloc (sizeof(vptree));
+  (*tree)->npoints     = npoints;
+  (*tree)->fingerprint = 0;
+  (*tree)->nodes       = (vpnode*) malloc (npoints * sizeof(vpnode));
+
+  vpitem *items = (vpitem*) malloc (npoints * sizeof(vpitem));
+  for (size_t i=0; i<npoints; i++) {
+    items[i].point = i;
+    items[i].dist  = 0;
+  }
+
+  int64_t next = 0;
+  vptree_build_node (*tree, &next, items, npoints, dist, ctx);
+  assert (next == npoints);
+
+  free (items);
+  return exitOK;
+}
+
+
+/* lower bound of the distance from the query to the points whose
+   distances to the vantage point are in [lo, hi] */
+static double vptree_bound (const double d, const double lo, const double hi) {
+  double b = 0;
+  if (lo - d > b) b = lo - d;
+  if (d - hi > b) b = d - hi;
+  return b;
+}
+
+/* the k best so far, sorted by distance then point */
+typedef struct {
+  size_t  k, n;
+  size_t *points;
+  double *dists;
+} vpbest;
+
+static void vpbest_insert (vpbest *best, const size_t point, const double d) {
+  size_t i;
+  if (best->n < best->k) {
+    i = best->n++;
+  }
+  else {
+    i = best->k - 1;
+    if (d > best->dists[i] || (d == best->dists[i] && point > best->points[i])) return;
+  }
+  while (i > 0 && (d < best->dists[i-1] || (d == best->dists[i-1] && point < best->points[i-1]))) {
+    best->points[i] = best->points[i-1];
+    best->dists [i] = best->dists [i-1];
+    i--;
+  }
+  best->points[i] = point;
+  best->dists [i] = d;
+}
+
+/* distance to the k-th best, which the bounds of a subtree are checked against */
+static double vpbest_worst (const vpbest *best) {
+  return best->n < best->k ? DBL_MAX : best->dists[best->k - 1];
+}
+
+static void vptree_search (const vptree *tree, const int64_t id, vptree_query_fn dist, void *ctx,
+			   vpbest *best, size_t *ncomputed) {
+
+  if (id == VPTREE_NONE) return;
+
+  const vpnode *node = &tree->nodes[id];
+  const double d = dist (node->point, ctx);
+  (*ncomputed) ++;
+
+  vpbest_insert (best, node->point, d);
+
+  const double
+    bin  = vptree_bound (d, node->inside_lo,  node->inside_hi),
+    bout = vptree_bound (d, node->outside_lo, node->outside_hi);
+
+  /* the closer half first, so that the other one is more likely pruned */
+  const int64_t
+    first  = bin <= bout ? node->inside  : node->outside,
+    second = bin <= bout ? node->outside : node->inside;
+  const double
+    bfirst  = bin <= bout ? bin  : bout,
+    bsecond = bin <= bout ? bout : bin;
+
+  double worst = vpbest_worst (best);
+  if (bfirst <= worst + VPTREE_SLACK * (1 + worst))
+    vptree_search (tree, first, dist, ctx, best, ncomputed);
+
+  worst = vpbest_worst (best);
+  if (bsecond <= worst + VPTREE_SLACK * (1 + worst))
+    vptree_search (tree, second, dist, ctx, best, ncomputed);
+}
+
+size_t vptree_knearest (const vptree *tree, vptree_query_fn dist, void *ctx, const size_t k,
+			size_t *points, double *dists, size_t *ncomputed) {
+  vpbest best = { k, 0, points, dists };
+  *ncomputed  = 0;
+  if (k > 0) {
+    vptree_search (tree, tree->npoints > 0 ? 0 : VPTREE_NONE, dist, ctx, &best, ncomputed);
+  }
+  return best.n;
+}
+
+size_t vptree_scan (const size_t npoints, vptree_query_fn dist, void *ctx, const size_t k,
+		    size_t *points, double *dists) {
+  vpbest best = { k, 0, points, dists };
+  if (k > 0) {
+    for (size_t i=0; i<npoints; i++) {
+      vpbest_insert (&best, i, dist (i, ctx));
+    }
+  }
+  return best.n;
+}
+
+size_t vptree_nearest (const vptree *tree, vptree_query_fn dist, void *ctx, double *mindist, size_t *ncomputed) {
+  size_t best = SIZE_MAX;
+  *mindist    = DBL_MAX;
+  vptree_knearest (tree, dist, ctx, 1, &best, mindist, ncomputed);
+  return best;
+}
+
+
+exit_t vptree_save (const vptree *tree, const char *path) {
+  FILE *file = fopen (path, "wb");
+  if (file == NULL) { return exitPATH_NOT_FOUND; }
+
+  exit_t status = exitOK;
+  if (fwrite (VPTREE_MAGIC, 1, 8, file) != 8 ||
+      fwrite (&tree->npoints, sizeof(uint64_t), 1, file) != 1 ||
+      fwrite (&tree->fingerprint, sizeof(uint64_t), 1, file) != 1 ||
+      fwrite (tree->nodes, sizeof(vpnode), tree->npoints, file) != tree->npoints)
+    { status = exitFAILURE; }
+
+  if (fclose (file) != 0) { status = exitFAILURE; }
+  return status;
+}
+
+exit_t vptree_load (const char *path, vptree **tree) {
+  FILE *file = fopen (path, "rb");
+  if (file == NULL) { return exitPATH_NOT_FOUND; }
+
+  char magic[8];
+  uint64_t npoints, fingerprint;
+  if (fread (magic, 1, 8, file) != 8 || memcmp (magic, VPTREE_MAGIC, 8) != 0 ||
+      fread (&npoints, sizeof(uint64_t), 1, file) != 1 ||
+      fread (&fingerprint, sizeof(uint64_t), 1, file) != 1) {
+    fclose (file);
+    return exitFAILURE;
+  }
+
+  *tree = (vptree*) malloc (sizeof(vptree));
+  (*tree)->npoints     = npoints;
+  (*tree)->fingerprint = fingerprint;
+  (*tree)->nodes       = (vpnode*) malloc (npoints * sizeof(vpnode));
+
+  if (fread ((*tree)->nodes, sizeof(vpnode), npoints, file) != npoints) {
+    fclose (file);
+    vptree_free (*tree);
+    *tree = NULL;
+    return exitFAILURE;
+  }
+
+  fclose (file);
+  return exitOK;
+}
+
+void vptree_free (vptree *tree) {
+  if (tree == NULL) return;
+  free (tree->nodes);
+  free (tree);
+}
+
+
+uint64_t vptree_fingerprint (uint64_t hash, const void *data, const size_t nbytes) {
+  const unsigned char *bytes = (const unsigned char*) data;
+  for (size_t i=0; i<nbytes; i++) {
+    hash ^= bytes[i];
+    hash *= 1099511628211ULL;
+  }
+  return hash;
+}
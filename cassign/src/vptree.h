@@ -0,0 +1,94 @@
+#ifndef _VPTREE_H_
+#define _VPTREE_H_
+
+#include "exit_codes.h"
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <assert.h>
+
+/**
+   A vantage-point tree over n points of a metric space, used to find
+   the nearest cell of a structure without computing the distance to
+   every cell.
+
+   Each node is a vantage point and splits the points below it at the
+   median of their distances to it.  A node keeps the range of those
+   distances for each half, so that the triangle inequality
+
+       d(q,x) >= max (lo - d(q,v), d(q,v) - hi)
+
+   bounds the distance from a query q to any point x of a half whose
+   distances to the vantage point v are in [lo, hi].  A half is only
+   searched if its bound is not larger than the best distance so far,
+   which makes the search exact: it returns the point the brute force
+   scan returns, the first one among ties.
+
+   The points are given by the distance functions, so the tree does not
+   depend on how the coordinates are stored.
+
+   Index file (native byte order):
+       magic "AWEVPT01"
+       uint64 npoints
+       uint64 fingerprint   of the points the tree was built over
+       vpnode nodes[npoints]
+ */
+
+#define VPTREE_MAGIC "AWEVPT01"
+#define VPTREE_NONE  -1
+
+/* relative slack on the bounds for the rounding of the distances */
+#define VPTREE_SLACK 1e-9
+
+typedef double (*vptree_pair_fn)  (size_t i, size_t j, void *ctx);  /* distance between points i and j */
+typedef double (*vptree_query_fn) (size_t i, void *ctx);            /* distance from the query to point i */
+
+typedef struct {
+  int64_t point;                    /* vantage point */
+  int64_t inside, outside;          /* children, VPTREE_NONE if empty */
+  double  inside_lo,  inside_hi;    /* distances of the points below inside  to the vantage point */
+  double  outside_lo, outside_hi;   /* distances of the points below outside to the vantage point */
+} vpnode;
+
+typedef struct {
+  uint64_t npoints;
+  uint64_t fingerprint;
+  vpnode  *nodes;                   /* nodes[0] is the root */
+} vptree;
+
+
+exit_t vptree_build (const size_t npoints, vptree_pair_fn dist, void *ctx, vptree **tree);
+
+/**
+   The nearest point to the query.  Sets *mindist to its distance and
+   *ncomputed to the number of distances computed.
+ */
+size_t vptree_nearest (const vptree *tree, vptree_query_fn dist, void *ctx, double *mindist, size_t *ncomputed);
+
+/**
+   The *k* nearest points to the query, nearest first, in *points* and
+   their distances in *dists*.  Returns their number, less than *k* if
+   the tree has fewer points.
+ */
+size_t vptree_knearest (const vptree *tree, vptree_query_fn dist, void *ctx, const size_t k,
+			size_t *points, double *dists, size_t *ncomputed);
+
+/* the same as vptree_knearest, computing the distance to each of the *npoints* points */
+size_t vptree_scan (const size_t npoints, vptree_query_fn dist, void *ctx, const size_t k,
+		    size_t *points, double *dists);
+
+exit_t vptree_save (const vptree *tree, const char *path);
+
+exit_t vptree_load (const char *path, vptree **tree);
+
+void vptree_free (vptree *tree);
+
+/* FNV-1a hash, to be chained over the points a tree is built over */
+uint64_t vptree_fingerprint (uint64_t hash, const void *data, const size_t nbytes);
+
+#define VPTREE_FINGERPRINT_INIT 14695981039346656037ULL
+
+
+#endif
@@ -83,6 +83,66 @@ int xdrframe_last_in_xtc (const char* filename, xdrframe** frame) {
 }
 
 
+void xdrframe_select_rvec (const rvec* x, const gsl_vector *indices, xdrframe *frame) {
+  assert (frame->natoms == indices->size);
+  assert (frame->coords->size2 == XDR_DIM);
+
+  for (int i=0; i<frame->natoms; i++) {
+    const int atom = (int) gsl_vector_get (indices, i);
+    for (int j=0; j<XDR_DIM; j++) {
+      gsl_matrix_set (frame->coords, i, j, x[atom][j]);
+    }}
+}
+
+
+int xdrstream_open (const char* filename, xdrstream** stream) {
+
+  printf ("~> Streaming frames from xtc file: %s\n", filename);
+
+  int natoms;
+  int result;
+  if ( (result = read_xtc_natoms ((char*)filename, &natoms) ) != exdrOK ) {
+    printf ("~> Error reading number of atoms from: %s\n", filename);
+    return result;
+  }
+
+  XDRFILE* file = xdrfile_open (filename, "r");
+  if (file == NULL) {
+    char emsg[50];
+    sprintf (emsg, "~> Error opening xtc file: %s", filename);
+    perror(emsg);
+    return exdrFILENOTFOUND;
+  }
+
+  printf ("~> Number of atoms: %d\n", natoms);
+
+  *stream = (xdrstream*) malloc (sizeof(xdrstream));
+  (*stream)->file   = file;
+  (*stream)->natoms = natoms;
+  (*stream)->step   = 0;
+  (*stream)->time   = 0;
+  (*stream)->x      = (xdr_vec*) malloc (natoms*sizeof(xdr_vec));
+  (*stream)->frames = 0;
+
+  return exdrOK;
+}
+
+int xdrstream_next (xdrstream* stream) {
+  xdr_matrix box;
+  float prec = XTC_PRECISION;
+  const int result = read_xtc (stream->file, stream->natoms, &stream->step, &stream->time, box, stream->x, &prec);
+  if (result == exdrOK) { stream->frames ++; }
+  return result;
+}
+
+void xdrstream_close (xdrstream* stream) {
+  if (stream == NULL) return;
+  xdrfile_close (stream->file);
+  free (stream->x);
+  free (stream);
+}
+
+
 exit_t xdrframe_select_atoms (const xdrframe *frame, const gsl_vector *indices, xdrframe **newframe) {
   assert (indices->size <= frame->natoms);
 
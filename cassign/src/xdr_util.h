@@ -22,6 +22,16 @@ typedef struct {
   gsl_matrix* coords;
 } xdrframe;
 
+/* reads the frames of an xtc file one at a time */
+typedef struct {
+  XDRFILE *file;
+  int      natoms;
+  int      step;
+  float    time;
+  xdr_vec *x;                       /* atoms of the current frame */
+  size_t   frames;                  /* number of frames read */
+} xdrstream;
+
 
 xdrframe* xdrframe_alloc (void);
 void xdrframe_init (xdrframe** frame, const size_t natoms);
@@ -32,6 +42,16 @@ int xdrframe_last_in_xtc (const char* filename, xdrframe** frame);
 
 exit_t xdrframe_select_atoms (const xdrframe *frame, const gsl_vector *indices, xdrframe **newframe);
 
+/* set *frame* to the atoms *indices* of x, without allocating */
+void xdrframe_select_rvec (const rvec* x, const gsl_vector *indices, xdrframe *frame);
+
+int  xdrstream_open  (const char* filename, xdrstream** stream);
+
+/* read the next frame into stream->x, returns exdrOK or exdrENDOFFILE after the last one */
+int  xdrstream_next  (xdrstream* stream);
+
+void xdrstream_close (xdrstream* stream);
+
 void xdrframe_printsummary (const xdrframe* frame);
 void xdrframe_printf (const xdrframe* frame);
 
@@ -0,0 +1,169 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+Incremental checkpoints: bases, journal and compaction.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+import awe
+from awe import assign
+from awe.checkpoint import IncrementalCheckpoint
+
+import numpy as np
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+
+NATOMS  = 3
+COLUMNS = ('ids', 'initids', 'cellids', 'assignments', 'colors', 'parentids', 'weights', 'hasend')
+
+
+def initial_system(rng, ncells=3, nwalkers=2):
+    system = awe.System(cells={})
+    for c in xrange(ncells):
+        system.add_cell(awe.Cell(c))
+        for _ in xrange(nwalkers):
+            system.add_walker(awe.Walker(start=rng.random_sample((NATOMS, 3)), assignment=c, color=c % 2,
+                                         weight=1. / (ncells * nwalkers), cellid=c))
+    return system
+
+
+def finish(system, cpt, wids, rng):
+    """
+    The results of the walkers *wids* come back: log them as AWE does
+    """
+    ncells = len(system.cells)
+    for wid in wids:
+        walker            = system.walker(wid)
+        walker.end        = rng.random_sample((NATOMS, 3))
+        walker.assignment = int(rng.randint(ncells))
+        if wid % 2:
+            top = np.zeros(2, dtype=assign.TOP_DTYPE)
+            top['cell'] = [walker.assignment, (walker.assignment + 1) % ncells]
+            top['rmsd'] = rng.random_sample(2)
+            walker.topcells = top
+        system.set_walker(walker)
+        cpt.log(walker)
+
+
+def resample(system, rng):
+    """
+    Restart a random choice of the finished walkers, keeping their number
+    """
+    ens     = system.ensemble
+    rows    = rng.choice(np.where(ens.hasend)[0], size=len(ens))
+    weights = np.repeat(ens.weights.sum() / len(rows), len(rows))
+    return system.clone(ensemble=ens.restart(rows, weights))
+
+
+def recover(path):
+    cpt   = IncrementalCheckpoint(path)
+    state = cpt.recover(lambda state, walker: state['system'].set_walker(walker))
+    return cpt, state
+
+
+class TestIncrementalCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='awe-test.')
+        self.path   = os.path.join(self.tmpdir, 'checkpoint')
+        self.rng    = np.random.RandomState(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameSystem(self, system, other):
+        self.assertEqual(sorted((c.id, c.core) for c in system.cells),
+                         sorted((c.id, c.core) for c in other.cells))
+
+        a, b = system.ensemble, other.ensemble
+        i, j = np.argsort(a.ids), np.argsort(b.ids)
+        for c in COLUMNS:
+            x, y = getattr(a, c)[i], getattr(b, c)[j]
+            self.assertTrue(((x == y) | ((x != x) & (y != y))).all(), c)
+        self.assertTrue((a.start[i] == b.start[j]).all())
+        ends = a.hasend[i]
+        self.assertTrue((a.end[i][ends] == b.end[j][ends]).all())
+
+        for wid in a.ids[ends]:
+            x, y = a.walker(wid).topcells, b.walker(wid).topcells
+            self.assertEqual(x is None, y is None, wid)
+            if x is not None:
+                self.assertEqual(x.tolist(), y.tolist(), wid)
+
+    def assertRecovers(self, state):
+        cpt, recovered = recover(self.path)
+        cpt.close()
+        self.assertEqual(recovered['iteration'], state['iteration'])
+        self.assertSameSystem(recovered['system'], state['system'])
+
+    def test_round_trip(self):
+        cpt    = IncrementalCheckpoint(self.path, compact=3)
+        system = initial_system(self.rng)
+        state  = dict(system=system, iteration=0)
+
+        for iteration in xrange(1, 8):
+            if iteration == 4:
+                system.add_cell(awe.Cell(len(system.cells), core=0))
+
+            state['iteration'] = iteration
+            cpt.checkpoint(state)
+            self.assertRecovers(state)
+
+            ### recovered with part of the results logged
+            wids = system.ensemble.ids.tolist()
+            finish(system, cpt, wids[:len(wids) // 2], self.rng)
+            self.assertRecovers(state)
+
+            finish(system, cpt, wids[len(wids) // 2:], self.rng)
+            system = resample(system, self.rng)
+            state['system'] = system
+
+        ### bases at the checkpoints 1 and 5, only the last one is kept
+        self.assertEqual(map(os.path.basename, glob.glob(os.path.join(self.path, 'base.*.npz'))), ['base.1.npz'])
+        cpt.close()
+
+    def test_truncated_journal(self):
+        cpt    = IncrementalCheckpoint(self.path, compact=3)
+        system = initial_system(self.rng)
+        state  = dict(system=system, iteration=1)
+        cpt.checkpoint(state)
+
+        wids = system.ensemble.ids.tolist()
+        finish(system, cpt, wids[:-1], self.rng)
+        expected = awe.System(cells=dict((c.id, c) for c in system.cells))
+        expected.ensemble.update(system.ensemble)
+        finish(system, cpt, wids[-1:], self.rng)
+        cpt.close()
+
+        ### the last result is cut short
+        journal = os.path.join(self.path, 'journal.pkl')
+        with open(journal, 'r+b') as fd:
+            fd.truncate(os.path.getsize(journal) - 5)
+
+        cpt, recovered = recover(self.path)
+        self.assertSameSystem(recovered['system'], expected)
+        self.assertTrue(recovered['system'].walker(wids[-1]).end is None)
+
+        ### the partial record is dropped, so the journal can be appended to
+        system = recovered['system']
+        finish(system, cpt, wids[-1:], self.rng)
+        system = resample(system, self.rng)
+        state  = dict(system=system, iteration=2)
+        cpt.checkpoint(state)
+        cpt.close()
+        self.assertRecovers(state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+The coordinate store and the columnar walker ensemble.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+import awe
+from awe.coordinates import CoordinateStore
+from awe.aweclasses import WalkerEnsemble
+
+import numpy as np
+
+import cPickle as pickle
+import unittest
+
+
+SHAPE = (4, 3)
+
+
+def frames(n, seed=0):
+    return np.random.RandomState(seed).random_sample((n,) + SHAPE)
+
+
+def walker(wid, assignment=0, weight=0.1, end=True, seed=None):
+    coords = frames(2, seed=wid if seed is None else seed)
+    return awe.Walker(start=coords[0], end=coords[1] if end else None, assignment=assignment,
+                      color=wid % 2, weight=weight, wid=wid, cellid=assignment, initid=wid)
+
+
+class TestCoordinateStore(unittest.TestCase):
+
+    def test_store_gather(self):
+        store  = CoordinateStore(SHAPE, capacity=4)
+        coords = frames(3)
+        slots  = store.store(coords)
+        self.assertEqual(store.nslots, 3)
+        self.assertTrue((store.gather(slots) == coords).all())
+        self.assertTrue((store[slots[1]] == coords[1]).all())
+
+        ### negative slots gather zeros
+        out = store.gather([slots[0], -1])
+        self.assertTrue((out[0] == coords[0]).all())
+        self.assertTrue((out[1] == 0).all())
+
+    def test_grow(self):
+        store  = CoordinateStore(SHAPE, capacity=2)
+        first  = store.store(frames(2, seed=1))
+        view   = store[first[0]]
+        more   = store.store(frames(5, seed=2))
+        self.assertTrue(store.nbytes >= 7 * np.prod(SHAPE) * 8)
+        self.assertEqual(len(set(first.tolist() + more.tolist())), 7)
+        self.assertTrue((store.gather(first) == frames(2, seed=1)).all())
+        self.assertTrue((store.gather(more) == frames(5, seed=2)).all())
+        self.assertTrue((view == frames(2, seed=1)[0]).all())
+
+    def test_refcount_and_reuse(self):
+        store = CoordinateStore(SHAPE, capacity=4)
+        slots = store.store(frames(3))
+        store.incref(slots[:1])
+        self.assertEqual(store.refcount(slots[0]), 2)
+
+        ### a slot is only freed by its last reference
+        store.decref(slots[:1])
+        self.assertEqual(store.nslots, 3)
+        store.decref(slots)
+        self.assertEqual(store.nslots, 0)
+
+        ### freed slots are reused before the file grows
+        capacity = store.nbytes
+        again    = store.store(frames(3, seed=5))
+        self.assertEqual(sorted(again.tolist()), sorted(slots.tolist()))
+        self.assertEqual(store.nbytes, capacity)
+        self.assertTrue((store.gather(again) == frames(3, seed=5)).all())
+
+        ### negative slots are ignored, releasing a free slot is an error
+        store.decref([-1])
+        store.decref(again[:1])
+        self.assertRaises(AssertionError, store.decref, again[:1])
+
+
+class TestWalkerEnsemble(unittest.TestCase):
+
+    def ensemble(self, n, capacity=2):
+        ens = WalkerEnsemble(capacity=capacity)
+        for i in xrange(n):
+            ens.set(walker(i, assignment=i % 3, weight=0.1 * (i + 1)))
+        return ens
+
+    def test_add_past_capacity(self):
+        ens = self.ensemble(10, capacity=2)
+        self.assertEqual(len(ens), 10)
+        self.assertEqual(ens.ids.tolist(), range(10))
+        self.assertEqual(ens.assignments.tolist(), [i % 3 for i in xrange(10)])
+        self.assertTrue(np.allclose(ens.weights, 0.1 * np.arange(1, 11)))
+        for i in xrange(10):
+            w = ens.walker(i)
+            self.assertTrue((w.start == frames(2, seed=i)[0]).all())
+            self.assertTrue((w.end   == frames(2, seed=i)[1]).all())
+        self.assertEqual(ens.store.nslots, 20)
+
+    def test_set_overwrites(self):
+        ens = self.ensemble(3)
+        ens.set(walker(1, assignment=2, weight=0.5, end=False, seed=9))
+        self.assertEqual(len(ens), 3)
+        w = ens.walker(1)
+        self.assertEqual(w.assignment, 2)
+        self.assertEqual(w.weight, 0.5)
+        self.assertTrue(w.end is None)
+        self.assertTrue((w.start == frames(2, seed=9)[0]).all())
+        self.assertEqual(ens.hasend.tolist(), [True, False, True])
+
+        ### the end of walker 1 was released
+        self.assertEqual(ens.store.nslots, 5)
+
+    def test_remove_and_reuse(self):
+        ens   = self.ensemble(5)
+        store = ens.store
+        ens.remove([1, 3])
+        self.assertEqual(len(ens), 3)
+        self.assertEqual(sorted(ens.ids.tolist()), [0, 2, 4])
+        self.assertFalse(1 in ens)
+        self.assertEqual(store.nslots, 6)
+        for i in [0, 2, 4]:
+            self.assertEqual(ens.walker(i).assignment, i % 3)
+            self.assertTrue((ens.walker(i).end == frames(2, seed=i)[1]).all())
+
+        ### new walkers take the freed slots
+        nbytes = store.nbytes
+        ens.set(walker(7))
+        ens.set(walker(8))
+        self.assertEqual(store.nslots, 10)
+        self.assertEqual(store.nbytes, nbytes)
+        self.assertTrue((ens.walker(7).start == frames(2, seed=7)[0]).all())
+        self.assertTrue((ens.walker(4).end   == frames(2, seed=4)[1]).all())
+
+    def test_missing_start(self):
+        ens = self.ensemble(2)
+        ens.set(awe.Walker(end=frames(1, seed=5)[0], assignment=0, weight=0.1, wid=5, cellid=0))
+        self.assertEqual(ens.startslots[-1], -1)
+        self.assertTrue(ens.walker(5).start is None)
+        self.assertTrue((ens.walker(5).end == frames(1, seed=5)[0]).all())
+        self.assertTrue(ens.walkers()[-1].start is None)
+        self.assertTrue((ens.walkers()[0].start == frames(2, seed=0)[0]).all())
+
+    def test_walkers_outlive_slots(self):
+        ens     = self.ensemble(3)
+        held    = ens.walker(1)
+        walkers = ens.walkers()
+
+        ### the freed slots of walker 1 are reused by walker 7
+        ens.remove([1])
+        ens.set(walker(7))
+        self.assertEqual(sorted(ens.startslots.tolist() + ens.endslots.tolist()), range(6))
+        for w in [held, walkers[1]]:
+            self.assertTrue((w.start == frames(2, seed=1)[0]).all())
+            self.assertTrue((w.end   == frames(2, seed=1)[1]).all())
+
+    def test_shared_slots_released(self):
+        ens   = self.ensemble(4)
+        store = ens.store
+
+        ### a selection shares the slots of its walkers
+        sub = ens.select(ens.assignments == 0)
+        self.assertEqual(sub.ids.tolist(), [0, 3])
+        self.assertEqual(store.refcount(sub.startslots[0]), 2)
+        del sub
+        self.assertEqual(store.refcount(ens.startslots[0]), 1)
+
+        ### restarted walkers start from the slot their parent ended in
+        rows = np.array([0, 0, 2])
+        new  = ens.restart(rows, np.array([0.05, 0.05, 0.3]))
+        self.assertEqual(new.parentids.tolist(), [0, 0, 2])
+        self.assertEqual(new.startslots.tolist(), ens.endslots[rows].tolist())
+        self.assertEqual(store.refcount(ens.endslots[0]), 3)
+        self.assertFalse(new.hasend.any())
+        self.assertEqual(store.nslots, 8)
+
+        ### the slots of the parents outlive their ensemble
+        ends = ens.end
+        del ens
+        self.assertEqual(store.nslots, 2)
+        self.assertTrue((new.start == ends[rows]).all())
+        del new
+        self.assertEqual(store.nslots, 0)
+
+    def test_columns(self):
+        ens = self.ensemble(4)
+        self.assertRaises(ValueError, ens.weights.__setitem__, 0, 1.)
+
+        walkers = ens.walkers()
+        self.assertTrue(ens.walkers() is walkers)
+
+        ens.colors = [1, 1, 0, 0]
+        self.assertEqual(ens.colors.tolist(), [1, 1, 0, 0])
+        self.assertFalse(ens.walkers() is walkers)
+        self.assertEqual([w.color for w in ens.walkers()], [1, 1, 0, 0])
+
+        version = ens.version
+        ens.finish([2], [1], frames(1, seed=3))
+        self.assertTrue(ens.version > version)
+        self.assertEqual(ens.walker(2).assignment, 1)
+
+    def test_groupby(self):
+        ens = self.ensemble(6)
+        order, starts, counts = ens.groupby('assignments')
+        self.assertEqual(counts.tolist(), [2, 2, 2])
+        self.assertEqual(ens.assignments[order].tolist(), [0, 0, 1, 1, 2, 2])
+
+    def test_pickle(self):
+        ens = self.ensemble(5)
+        ens.remove([2])
+        ens.set(walker(9, end=False))
+
+        copy = pickle.loads(pickle.dumps(ens, pickle.HIGHEST_PROTOCOL))
+        self.assertFalse(copy.store is ens.store)
+        self.assertEqual(copy.store.nslots, ens.store.nslots)
+        for c in ['ids', 'initids', 'cellids', 'assignments', 'colors', 'parentids', 'weights', 'hasend']:
+            self.assertEqual(getattr(copy, c).tolist(), getattr(ens, c).tolist(), c)
+        self.assertTrue((copy.start == ens.start).all())
+        self.assertTrue((copy.end[copy.hasend] == ens.end[ens.hasend]).all())
+
+        ### the copy keeps working
+        copy.set(walker(10))
+        self.assertEqual(len(copy), 6)
+        self.assertTrue((copy.walker(10).end == frames(2, seed=10)[1]).all())
+
+    def test_system_recovery(self):
+        system = awe.System(cells={})
+        for c in xrange(3):
+            system.add_cell(awe.Cell(c))
+        for i in xrange(6):
+            system.add_walker(walker(i, assignment=i % 3, weight=1. / 6))
+
+        copy = pickle.loads(pickle.dumps(system, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(sorted(c.id for c in copy.cells), [0, 1, 2])
+        self.assertEqual(copy.ensemble.ids.tolist(), system.ensemble.ids.tolist())
+        self.assertTrue(np.allclose(copy.weights, system.weights))
+        for w in copy.walkers:
+            self.assertTrue((w.end == system.walker(w.id).end).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+Pipelined iterations, driven with the local backend.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+import awe
+from awe import resample, transport, workqueue
+from awe.aweclasses import AWE
+
+import numpy as np
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+
+### the tests run in a temporary directory, where neither the submodules
+### of awe, imported on first use, nor the converter sent to the workers
+### are found relative to the source tree
+awe.__path__[:]    = map(os.path.abspath, awe.__path__)
+transport.__file__ = os.path.abspath(transport.__file__)
+
+NCELLS  = 4
+NATOMS  = 3
+TARGET  = 3
+
+### a worker moving each walker to a cell drawn from its id
+WORKER = '''#!%(python)s
+import glob, imp, random, sys, tarfile
+sys.modules['numpy'] = None     # as on the workers, and much faster to start
+transport = imp.load_source('transport', 'awe-walker.py')
+
+outputs = []
+for path in sorted(glob.glob('walker.bin.*')):
+    task, k = path.split('.')[-2:]
+    buf     = transport._read(path)
+    header  = transport.unpack_header(buf)
+    coords  = transport._coords_array(buf, header)
+    with open('structure2.bin.' + k, 'wb') as fd:
+        fd.write(transport.pack_header(header['id'], header['initid'], header['cellid'], header['assignment'],
+                                       header['color'], header['weight'], header['natoms'], header['ndim']))
+        fd.write(coords.tostring())
+    with open('cell2.dat.' + k, 'w') as fd:
+        fd.write('%%d\\n' %% random.Random(header['id']).randrange(%(ncells)d))
+    outputs += ['structure2.bin.' + k, 'cell2.dat.' + k]
+
+tar = tarfile.open('results.tar.' + task, 'w')
+for name in outputs:
+    tar.add(name)
+tar.close()
+'''
+
+
+class Topology(object):
+
+    """
+    The atoms the binary walkers are written into on the workers
+    """
+
+    def copy(self):
+        return self
+
+    def __str__(self):
+        return ''.join('ATOM  %5d  CA  ALA A%4d       0.000   0.000   0.000  1.00  0.00           C\n' % (i + 1, i + 1)
+                       for i in xrange(NATOMS))
+
+
+def initial_system(rng):
+    system = awe.System(topology=Topology(), cells={})
+    for c in xrange(NCELLS):
+        system.add_cell(awe.Cell(c))
+        for _ in xrange(TARGET):
+            system.add_walker(awe.Walker(start=rng.random_sample((NATOMS, 3)), assignment=c, color=0,
+                                         weight=1. / (NCELLS * TARGET), cellid=c))
+    return system
+
+
+class RecordingAWE(AWE):
+
+    """
+    Records the generations of the walkers resampled together
+    """
+
+    def _resample_cell(self, cid, generation):
+        ### walkers of other generations in the cell, running or waiting
+        others = set(g for c, g in self._pending.keys() + self._inbox.keys() if c == cid and g != generation)
+        self.resampled.append((generation, set(self._generation[wid] for wid in self._inbox[cid, generation]), others))
+        AWE._resample_cell(self, cid, generation)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd    = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp(prefix='awe-test.')
+        os.chdir(self.tmpdir)
+        self.outdir = resample.OUTPUT_DIR
+        resample.OUTPUT_DIR = self.tmpdir
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+        workqueue._AWE_WORK_QUEUE = None
+
+        worker = os.path.join(self.tmpdir, 'worker.py')
+        with open(worker, 'w') as fd:
+            fd.write(WORKER % dict(python=sys.executable, ncells=NCELLS))
+        os.chmod(worker, stat.S_IRWXU)
+
+        self.cfg = workqueue.Config()
+        self.cfg.backend            = 'local'
+        self.cfg.local_workers      = 4
+        self.cfg.local_failure_rate = 0.1
+        self.cfg.local_seed         = 1
+        self.cfg.waittime           = 1
+        self.cfg.execute(worker)
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        resample.OUTPUT_DIR = self.outdir
+        workqueue._AWE_WORK_QUEUE = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipeline(self, iterations, decode_workers):
+        system = initial_system(np.random.RandomState(5))
+        weight = system.weights.sum()
+        awe    = RecordingAWE(wqconfig=self.cfg, system=system, iterations=iterations, pipeline=True,
+                              resample=resample.SaveWeights(resample.BatchOneColor(TARGET, seed=3)),
+                              decode_workers=decode_workers)
+        awe.resampled = []
+        try:
+            awe.run()
+        finally:
+            if awe._decoder is not None:
+                awe._decoder.terminate()
+            awe.statslogger.close()
+            awe.wq.taskoutputlogger.close()
+
+        self.assertEqual(awe.iteration, iterations)
+        self.assertTrue(abs(awe.system.weights.sum() - weight) < 1e-9)
+
+        ### each generation is resampled on its own, and every one is resampled
+        for generation, generations, _ in awe.resampled:
+            self.assertEqual(generations, set([generation]))
+        self.assertEqual(sorted(set(g for g, _, _ in awe.resampled)), range(1, iterations + 1))
+
+        ### some cells held the walkers of several generations
+        self.assertTrue(any(others for _, _, others in awe.resampled))
+
+        ### nothing is left of the completed tasks and walkers
+        self.assertEqual(len(awe.wq._tasks), 0)
+        self.assertEqual(awe.wq.restarts, {})
+        self.assertEqual(awe._pending, {})
+        self.assertEqual(awe._inbox, {})
+        self.assertEqual(awe._cellwait, {})
+        self.assertEqual(awe._generation, {})
+        self.assertEqual(dict(awe._outstanding), {})
+        self.assertTrue(awe.wq.wq.stats.total_tasks_failed > 0)
+        return awe
+
+    def test_sequential(self):
+        self.run_pipeline(3, decode_workers=0)
+
+    def test_decoders(self):
+        self.run_pipeline(3, decode_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
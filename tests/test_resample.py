@@ -0,0 +1,176 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+The vectorized split/merge against the sequential OneColor.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+import awe
+from awe import resample
+
+import numpy as np
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+TARGET = 4
+TRIALS = 400
+
+
+def random_system(rng, ncells=3, natoms=2):
+    """
+    A System of 1 to 8 walkers of random weights in each of *ncells*
+    """
+    system = awe.System(cells={})
+    for c in xrange(ncells):
+        system.add_cell(awe.Cell(c))
+        for w in rng.random_sample(rng.randint(1, 9)):
+            system.add_walker(awe.Walker(start=rng.random_sample((natoms, 3)), end=rng.random_sample((natoms, 3)),
+                                         assignment=c, color=0, weight=0.01 + w, cellid=c))
+    return system
+
+
+def offspring(system, newsystem):
+    """
+    Number of new walkers restarted from each walker of *system*
+    """
+    ids    = system.ensemble.ids
+    counts = np.bincount(np.searchsorted(ids, newsystem.ensemble.parentids), minlength=len(ids))
+    assert (ids[np.searchsorted(ids, newsystem.ensemble.parentids)] == newsystem.ensemble.parentids).all()
+    return counts
+
+
+def cell_totals(system, ncells):
+    ens = system.ensemble
+    return np.bincount(ens.assignments, weights=ens.weights, minlength=ncells), \
+           np.bincount(ens.assignments, minlength=ncells)
+
+
+def segments(rng, nsegments):
+    counts  = rng.randint(1, 9, size=nsegments)
+    starts  = np.r_[0, np.cumsum(counts)[:-1]]
+    weights = 0.01 + rng.random_sample(counts.sum())
+    return weights, starts, counts
+
+
+class TestSplitMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='awe-test.')
+        self.outdir = resample.OUTPUT_DIR
+        resample.OUTPUT_DIR = self.tmpdir
+
+        ### the resamplers report each walker
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        resample.OUTPUT_DIR = self.outdir
+        shutil.rmtree(self.tmpdir)
+
+    def test_against_onecolor(self):
+        rng = np.random.RandomState(7)
+        for _ in xrange(5):
+            system = random_system(rng)
+            ncells = len(system.cells)
+            weight, count = cell_totals(system, ncells)
+
+            np.random.seed(rng.randint(2**31 - 1))
+            sequential = resample.OneColor(TARGET)
+            batch      = resample.BatchOneColor(TARGET, seed=rng.randint(2**31 - 1))
+
+            expected = np.zeros(len(system.ensemble))
+            for name, resampler in [('OneColor', sequential), ('BatchOneColor', batch)]:
+                mean = np.zeros(len(system.ensemble))
+                for _ in xrange(TRIALS):
+                    newsystem = resampler.resample(system)
+                    newweight, newcount = cell_totals(newsystem, ncells)
+
+                    ### each cell keeps its weight in TARGET walkers
+                    self.assertTrue(np.allclose(newweight, weight), name)
+                    self.assertEqual(newcount.tolist(), [TARGET] * ncells, name)
+                    mean += offspring(system, newsystem)
+                mean /= TRIALS
+
+                if name == 'OneColor':
+                    expected = mean
+                else:
+                    ### a walker is the parent of w / tw walkers on average
+                    self.assertTrue(np.abs(mean - expected).max() < 0.15,
+                                    'parent frequencies %s, OneColor %s' % (mean, expected))
+
+            tw = (weight / TARGET)[system.ensemble.assignments]
+            self.assertTrue(np.abs(expected - system.ensemble.weights / tw).max() < 0.15)
+
+    def test_parallel(self):
+        rng  = np.random.RandomState(11)
+        pool = multiprocessing.Pool(2)
+        try:
+            weights, starts, counts = segments(rng, 20)
+            segment = np.repeat(np.arange(len(starts)), counts)
+            tw      = np.bincount(segment, weights=weights) / TARGET
+
+            mean, pmean = np.zeros(len(weights)), np.zeros(len(weights))
+            for trial in xrange(TRIALS):
+                parents, newweights = resample.split_merge(weights, starts, counts, TARGET, np.random.RandomState(trial))
+                mean += np.bincount(parents, minlength=len(weights))
+
+                parents, newweights = resample.parallel_split_merge(weights, starts, counts, TARGET,
+                                                                    np.random.RandomState(trial), pool, blocksize=3)
+                pmean += np.bincount(parents, minlength=len(weights))
+
+                ### each segment keeps its weight in TARGET walkers
+                self.assertEqual(np.bincount(segment[parents]).tolist(), [TARGET] * len(starts))
+                self.assertTrue(np.allclose(np.bincount(segment[parents], weights=newweights), tw * TARGET))
+            mean  /= TRIALS
+            pmean /= TRIALS
+
+            self.assertTrue(np.abs(mean - pmean).max() < 0.15)
+            self.assertTrue(np.abs(pmean - weights / tw[segment]).max() < 0.15)
+
+            ### the result does not depend on the number of processes
+            serial = multiprocessing.Pool(1)
+            try:
+                a = resample.parallel_split_merge(weights, starts, counts, TARGET, np.random.RandomState(3), pool, blocksize=3)
+                b = resample.parallel_split_merge(weights, starts, counts, TARGET, np.random.RandomState(3), serial, blocksize=3)
+            finally:
+                serial.terminate()
+            self.assertEqual(a[0].tolist(), b[0].tolist())
+            self.assertEqual(a[1].tolist(), b[1].tolist())
+        finally:
+            pool.terminate()
+
+    def test_parallel_resampler(self):
+        rng    = np.random.RandomState(13)
+        system = random_system(rng, ncells=6)
+        ncells = len(system.cells)
+        weight, _ = cell_totals(system, ncells)
+
+        partition = awe.SinkStates()
+        partition.add(0, 0)
+        resampler = resample.ParallelMultiColor(TARGET, partition, seed=5, processes=2, blocksize=2)
+        try:
+            newsystem = resampler.resample(system)
+        finally:
+            resampler.pool.terminate()
+
+        newweight, newcount = cell_totals(newsystem, ncells)
+        self.assertTrue(np.allclose(newweight, weight))
+        self.assertEqual(newcount.tolist(), [TARGET] * ncells)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+from awe import stats
+
+import numpy as np
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestMetricsLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='awe-test.')
+        self.path   = os.path.join(self.tmpdir, 'metrics.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def log(self, records, buffersize=4096):
+        logger = stats.MetricsLogger(self.path, buffersize=buffersize)
+        for t, component, name, val in records:
+            logger.update(t, component, name, val)
+        logger.close()
+        return stats.read_metrics(self.path)
+
+    def test_numbers_and_strings(self):
+        metrics = self.log([(0, 'TASK', 'time', 1.5),
+                            (1, 'TASK', 'host', 'a'),
+                            (2, 'TASK', 'time', 2.5),
+                            (3, 'TASK', 'host', 'b')])
+        self.assertEqual(len(metrics), 4)
+        self.assertEqual(metrics.names, [('TASK', 'time'), ('TASK', 'host')])
+
+        times, values = metrics.get('TASK', 'time')
+        self.assertEqual(times.tolist(), [0, 2])
+        self.assertEqual(values.tolist(), [1.5, 2.5])
+
+        times, values = metrics.get('TASK', 'host')
+        self.assertEqual(times.tolist(), [1, 3])
+        self.assertEqual(values.tolist(), ['a', 'b'])
+
+    def test_none_then_string(self):
+        records = [(0, 'TASK', 'output', None),
+                   (1, 'TASK', 'output', 'done'),
+                   (2, 'TASK', 'output', None),
+                   (3, 'TASK', 'output', '')]
+
+        ### in one chunk, and with the None alone in the first chunk
+        for buffersize in [4096, 1]:
+            metrics = self.log(records, buffersize=buffersize)
+            times, values = metrics.get('TASK', 'output')
+            self.assertEqual(times.tolist(), [0, 1, 2, 3])
+            self.assertEqual(values.tolist(), [None, 'done', None, ''])
+            os.unlink(self.path)
+
+    def test_none_then_number(self):
+        metrics = self.log([(0, 'TASK', 'bytes', None),
+                            (1, 'TASK', 'bytes', 42)])
+        times, values = metrics.get('TASK', 'bytes')
+        self.assertTrue(np.isnan(values[0]))
+        self.assertEqual(values[1], 42)
+
+    def test_truncated(self):
+        self.log([(i, 'TASK', 'time', i) for i in xrange(10)], buffersize=5)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(size - 3)
+        times, values = stats.load_metric(self.path, 'TASK', 'time')
+        self.assertEqual(values.tolist(), range(5))
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.values = np.random.RandomState(2).exponential(size=20000)
+
+    def assertQuantiles(self, quantile, values, tolerance=0.01):
+        for p in stats.QUANTILES:
+            expected = np.percentile(values, 100 * p)
+            self.assertTrue(abs(quantile(p) - expected) < tolerance * expected,
+                            'p%g = %s, expected %s' % (100 * p, quantile(p), expected))
+
+    def test_batches(self):
+        ### one value at a time, and in batches of growing sizes
+        for size in [1, 10, 1000, len(self.values)]:
+            s = stats.Statistics()
+            for i in xrange(0, len(self.values), size):
+                s.update(*self.values[i:i+size])
+
+            self.assertEqual(s.num, len(self.values))
+            self.assertTrue(np.allclose([s.mean, s.std, s.min, s.max],
+                                        [self.values.mean(), self.values.std(), self.values.min(), self.values.max()]))
+            self.assertQuantiles(s.quantile, self.values)
+
+    def test_single_values(self):
+        ### a batch of one value is a P^2 update
+        a, b = stats.P2Quantile(0.95), stats.P2Quantile(0.95)
+        for v in self.values[:1000].tolist():
+            a.update(v)
+            b.extend([v])
+        self.assertEqual(a._heights, b._heights)
+        self.assertEqual(a._pos, b._pos)
+
+    def test_constant_memory(self):
+        s = stats.Statistics()
+        s.update(*self.values[:100])
+        state = repr(sorted(vars(s)))
+        sizes = [len(q._heights) for q in s._quantiles]
+        s.update(*self.values[100:])
+        self.assertEqual(repr(sorted(vars(s))), state)
+        self.assertEqual([len(q._heights) for q in s._quantiles], sizes)
+        self.assertFalse(any(isinstance(v, (stats.ExtendableArray, np.ndarray)) for v in vars(s).values()))
+
+    def test_few_values(self):
+        s = stats.Statistics()
+        self.assertTrue(np.isnan(s.quantile(0.5)))
+        s.update(3., 1., 2.)
+        self.assertEqual(s.quantile(0.5), 2.)
+        self.assertRaises(ValueError, s.quantile, 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+The replica index, the blob cache and the batched receive of the master.
+
+Run from the top of the source tree with
+    PYTHONPATH=trax python -m unittest discover tests
+"""
+
+from awe import localqueue, stats, workqueue
+from awe.workqueue import TagSet, BlobCache, _Bucket
+
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+
+def task(tag):
+    t = localqueue.Task('true')
+    t.specify_tag(tag)
+    return t
+
+
+class TestTagSet(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_empty(self):
+        tags = TagSet(maxreps=2)
+        self.assertEqual(tags.select(), None)
+        self.assertFalse(tags.can_duplicate())
+        tags.discard('missing')
+        self.assertEqual(len(tags), 0)
+
+        ### emptied by discarding its last tag
+        tags.add('a')
+        tags.discard('a')
+        tags.discard('a')
+        self.assertEqual(tags.select(), None)
+        self.assertFalse(tags.can_duplicate())
+        self.assertFalse('a' in tags)
+
+    def test_empty_bucket(self):
+        bucket = _Bucket()
+        bucket.discard('missing')
+        self.assertEqual(len(bucket), 0)
+        self.assertRaises(IndexError, bucket.choice)
+
+        bucket.add('a')
+        bucket.add('b')
+        bucket.discard('a')
+        self.assertEqual(list(bucket), ['b'])
+        self.assertEqual(bucket.choice(), 'b')
+
+    def test_select_least_replicated(self):
+        tags = TagSet(maxreps=3)
+        for tag in 'abc':
+            tags.add(tag)
+        tags.add('a')
+        tags.add('b')
+        self.assertEqual(tags.count('a'), 1)
+        self.assertEqual(tags.select(), 'c')
+
+        ### the bucket of the smallest count empties: select from the next one
+        tags.discard('c')
+        self.assertTrue(tags.select() in 'ab')
+        self.assertEqual(set(tags.select() for _ in xrange(50)), set('ab'))
+
+        ### every tag is replicated maxreps times
+        for tag in 'ab':
+            tags.add(tag)
+            tags.add(tag)
+        self.assertEqual(tags.count('a'), 3)
+        self.assertFalse(tags.can_duplicate())
+
+    def test_readd_discarded(self):
+        tags = TagSet(maxreps=3)
+        tags.add('a')
+        tags.add('a')
+        tags.add('b')
+        tags.discard('a')
+        self.assertFalse('a' in tags)
+
+        ### a discarded tag starts over
+        tags.add('a')
+        self.assertEqual(tags.count('a'), 0)
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(set(tags.select() for _ in xrange(50)), set('ab'))
+        tags.add('b')
+        self.assertEqual(tags.select(), 'a')
+
+    def test_clear(self):
+        tags = TagSet()
+        tags.add('a')
+        tags.clear()
+        self.assertEqual(len(tags), 0)
+        self.assertEqual(tags.select(), None)
+        tags.add('b', startcount=2)
+        self.assertEqual(tags.select(), 'b')
+        self.assertEqual(tags.count('b'), 2)
+
+
+class TestBlobCache(unittest.TestCase):
+
+    def test_identical_content(self):
+        blobs = BlobCache()
+        t1, t2, t3 = task('1'), task('2'), task('3')
+
+        ### a miss, then a hit on the same bytes
+        d1 = blobs.stage(t1, 'coordinates')
+        d2 = blobs.stage(t2, 'coordinates')
+        self.assertEqual(d1, d2)
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual((blobs.unique, blobs.shared), (11, 11))
+        self.assertEqual(t1._inputs, t2._inputs)
+        self.assertEqual(t1._inputs[0][2], 'blob.%s' % d1)
+        self.assertTrue(t1._inputs[0][3])
+
+        ### a miss on other bytes
+        d3 = blobs.stage(t3, 'other')
+        self.assertNotEqual(d3, d1)
+        self.assertEqual(len(blobs), 2)
+        self.assertEqual((blobs.unique, blobs.shared), (16, 11))
+
+        ### a blob is released with the last task that refers to it
+        self.assertEqual(blobs.release('1'), [])
+        self.assertEqual(blobs.release('2'), ['blob.%s' % d1])
+        self.assertEqual(blobs.release('2'), [])
+        self.assertEqual(blobs.release('3'), ['blob.%s' % d3])
+        self.assertEqual(len(blobs), 0)
+
+        ### staged again after its release, it is new
+        blobs.reset()
+        blobs.stage(task('4'), 'coordinates')
+        self.assertEqual((blobs.unique, blobs.shared), (11, 0))
+
+    def test_replicas(self):
+        ### the replicas of a task share its tag
+        blobs  = BlobCache()
+        digest = blobs.stage(task('1'), 'data')
+        blobs.stage(task('1'), 'data')
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(blobs.release('1'), ['blob.%s' % digest])
+        self.assertEqual(len(blobs), 0)
+
+
+class TestRecvBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='awe-test.')
+        path        = lambda name: os.path.join(self.tmpdir, name)
+
+        cfg = workqueue.Config()
+        cfg.backend         = 'local'
+        cfg.local_workers   = 4
+        cfg.local_sandbox   = path('sandbox')
+        cfg.wqstats_logfile = path('wq-stats.log')
+        cfg.waittime        = 1
+        workqueue._AWE_WORK_QUEUE = None
+        self.wq   = workqueue.WorkQueue(cfg, statslogger      = stats.MetricsLogger(path('metrics.dat')),
+                                         taskoutputlogger = stats.MetricsLogger(path('task_output.dat')))
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.wq.statslogger.close()
+        self.wq.taskoutputlogger.close()
+        workqueue._AWE_WORK_QUEUE = None
+        shutil.rmtree(self.tmpdir)
+
+    def submit(self, tags):
+        for tag in tags:
+            t = self.wq.wq.new_task('true')
+            t.specify_tag(tag)
+            self.wq.stage_blob(t, 'coordinates of %s' % tag)
+            self.wq.submit(t)
+
+    def test_failed_decode_restarts(self):
+        tracked = []
+        def decode(tag):
+            if tag == 'b' and not tracked:
+                ### while it is decoded, the task of b keeps its blob
+                tracked.append((len(self.wq.blobs), tag in self.wq._tasks))
+                raise IOError, 'truncated result'
+            return [tag]
+
+        self.submit('ab')
+        results  = []
+        restarts = []
+        for batch in self.wq.recv_batches(decode, self.pool, batchsize=1):
+            results.extend(batch)
+            if self.wq.restarts.get('b') and 'b' not in results:
+                restarts.append(('b' in self.wq.tagset, [name for _, _, name, _ in self.wq._tasks['b'][-1]._inputs]))
+
+        self.assertEqual(sorted(results), ['a', 'b'])
+        self.assertEqual(self.wq.restarts, {'b': 1})
+        self.assertEqual(tracked[0][1], True)
+        self.assertTrue(tracked[0][0] >= 1)
+
+        ### restarted with its blob, and tracked for replication again
+        for replicable, inputs in restarts:
+            self.assertTrue(replicable)
+            self.assertTrue(any(name.startswith('blob.') for name in inputs))
+        self.assertEqual(len(self.wq.blobs), 0)
+        self.assertEqual(len(self.wq.tagset), 0)
+
+    def test_batches_while_tasks_return(self):
+        tags = ['%02d' % i for i in xrange(40)]
+        self.submit(tags)
+        while self.wq.wq.stats.total_tasks_complete < len(tags):
+            time.sleep(0.01)
+
+        ### every task is waiting to be received: batches come back before the last one is
+        received = []
+        self.wq.task_listeners.append(lambda task: received.append(task.tag))
+        sizes = []
+        for batch in self.wq.recv_batches(lambda tag: [tag], self.pool, batchsize=8):
+            if not sizes:
+                self.assertTrue(len(received) < len(tags))
+            sizes.append(len(batch))
+        self.assertEqual(sum(sizes), len(tags))
+        self.assertTrue(max(sizes) <= 8)
+
+if __name__ == '__main__':
+    unittest.main()